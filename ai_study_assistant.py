@@ -5,21 +5,76 @@ A fully functional AI-powered study assistant for engineering and academic subje
 """
 
 import os
+import importlib.util
+import atexit
+import re
 import sys
 import json
+import time
 import sqlite3
-from datetime import datetime
+import base64
+import click
+import bisect
+import functools
+import cProfile
+import contextvars
+import csv
+import gzip
+import hashlib
+import hmac
+import io
+import math
+import zlib
+import threading
+import pstats
+import queue
+import random
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from typing import Dict, List, Optional
 from dataclasses import dataclass, asdict
 from pathlib import Path
 
 # Flask for web interface
-from flask import Flask, render_template_string, request, jsonify, session
+from flask import Blueprint, Flask, Response, current_app, g, render_template_string, request, jsonify, session, stream_with_context
 from flask_cors import CORS
+from urllib.parse import parse_qsl
+from werkzeug.datastructures import MultiDict
+from werkzeug.http import dump_cookie, parse_accept_header, parse_cookie, parse_etags
+from werkzeug.local import LocalProxy
 
-# AI integration (using OpenAI-compatible API)
-import openai
-import requests
+def lazy_import(name: str):
+    """Return a module that is only executed on first attribute access, or None if it is not installed"""
+    module = sys.modules.get(name)
+    if module is not None:
+        return module
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        return None
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+# Optional brotli compression for the index page
+brotli = lazy_import('brotli')
+
+# Optional NumPy for the local similarity index
+np = lazy_import('numpy')
+
+# Upstream HTTP client for the OpenAI-compatible API
+httpx = lazy_import('httpx')
+
+# File locks serializing similarity index writers across worker processes (not on Windows)
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
 
 # Configuration
 @dataclass
@@ -29,23 +84,696 @@ class Config:
     AI_API_KEY = os.environ.get('AI_API_KEY', 'your-api-key-here')
     AI_BASE_URL = os.environ.get('AI_BASE_URL', 'https://api.openai.com/v1')
     DEBUG = os.environ.get('DEBUG', 'True').lower() == 'true'
+    AI_MODEL = os.environ.get('AI_MODEL', 'gpt-3.5-turbo')
+    AI_TIMEOUT = float(os.environ.get('AI_TIMEOUT', '30'))
+    AI_CONNECT_TIMEOUT = float(os.environ.get('AI_CONNECT_TIMEOUT', '5'))
+    AI_MAX_CONCURRENCY = int(os.environ.get('AI_MAX_CONCURRENCY', '32'))
+    AI_MAX_CONNECTIONS = int(os.environ.get('AI_MAX_CONNECTIONS', '64'))
+    AI_KEEPALIVE_CONNECTIONS = int(os.environ.get('AI_KEEPALIVE_CONNECTIONS', '32'))
+    AI_MIN_TIMEOUT = float(os.environ.get('AI_MIN_TIMEOUT', '3'))
+    AI_MAX_RETRIES = int(os.environ.get('AI_MAX_RETRIES', '2'))
+    AI_RETRY_BUDGET_RATIO = float(os.environ.get('AI_RETRY_BUDGET_RATIO', '0.1'))
+    BREAKER_FAILURE_THRESHOLD = int(os.environ.get('BREAKER_FAILURE_THRESHOLD', '5'))
+    BREAKER_RECOVERY_TIME = float(os.environ.get('BREAKER_RECOVERY_TIME', '30'))
+    ANSWER_CACHE_SIZE = int(os.environ.get('ANSWER_CACHE_SIZE', '2048'))
+    ANSWER_CACHE_TTL = int(os.environ.get('ANSWER_CACHE_TTL', str(7 * 24 * 3600)))
+    SUBJECT_KEYWORDS_FILE = os.environ.get('SUBJECT_KEYWORDS_FILE')
+    SPLIT_STATIC_ASSETS = os.environ.get('SPLIT_STATIC_ASSETS', 'True').lower() == 'true'
+    CONTEXT_MAX_TURNS = int(os.environ.get('CONTEXT_MAX_TURNS', '6'))
+    CONTEXT_TOKEN_BUDGET = int(os.environ.get('CONTEXT_TOKEN_BUDGET', '1200'))
+    CONTEXT_SUMMARY_TOKENS = int(os.environ.get('CONTEXT_SUMMARY_TOKENS', '120'))
+    SIMILARITY_ENABLED = os.environ.get('SIMILARITY_ENABLED', 'True').lower() == 'true'
+    SIMILARITY_INDEX_DIR = os.environ.get('SIMILARITY_INDEX_DIR', os.path.join('instance', 'similarity'))
+    SIMILARITY_THRESHOLD = float(os.environ.get('SIMILARITY_THRESHOLD', '0.85'))
+    SIMILARITY_FALLBACK_THRESHOLD = float(os.environ.get('SIMILARITY_FALLBACK_THRESHOLD', '0.5'))
+    SIMILARITY_REFRESH_INTERVAL = float(os.environ.get('SIMILARITY_REFRESH_INTERVAL', '60'))
+    DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '16'))
+    BATCH_MAX_QUESTIONS = int(os.environ.get('BATCH_MAX_QUESTIONS', '500'))
+    BATCH_MAX_CONCURRENCY = int(os.environ.get('BATCH_MAX_CONCURRENCY', '8'))
+    CONVERSATION_QUEUE_SIZE = int(os.environ.get('CONVERSATION_QUEUE_SIZE', '10000'))
+    CONVERSATION_BATCH_SIZE = int(os.environ.get('CONVERSATION_BATCH_SIZE', '200'))
+    CONVERSATION_FLUSH_INTERVAL = float(os.environ.get('CONVERSATION_FLUSH_INTERVAL', '0.5'))
+    DB_BUSY_TIMEOUT_MS = int(os.environ.get('DB_BUSY_TIMEOUT_MS', '5000'))
+    DB_CACHE_SIZE_KB = int(os.environ.get('DB_CACHE_SIZE_KB', '20000'))
+    DB_MMAP_SIZE = int(os.environ.get('DB_MMAP_SIZE', str(256 * 1024 * 1024)))
+    ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+    TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0'))
+    TRACE_FORMAT = os.environ.get('TRACE_FORMAT', 'chrome')
+    TRACE_EXPORT_DIR = os.environ.get('TRACE_EXPORT_DIR', os.path.join('instance', 'traces'))
+    TRACE_MAX_BYTES = int(os.environ.get('TRACE_MAX_BYTES', str(64 * 1024 * 1024)))
+    TRACE_KEEP_FILES = int(os.environ.get('TRACE_KEEP_FILES', '5'))
+    PROFILE_MAX_SECONDS = float(os.environ.get('PROFILE_MAX_SECONDS', '60'))
+    AUTO_MIGRATE = os.environ.get('AUTO_MIGRATE', 'True').lower() == 'true'
+    ASGI_WSGI_THREADS = int(os.environ.get('ASGI_WSGI_THREADS', '64'))
+    RATE_LIMIT_BACKEND = os.environ.get('RATE_LIMIT_BACKEND', 'memory')
+    RATE_LIMIT_SESSION_PER_MINUTE = float(os.environ.get('RATE_LIMIT_SESSION_PER_MINUTE', '20'))
+    RATE_LIMIT_SESSION_BURST = float(os.environ.get('RATE_LIMIT_SESSION_BURST', '10'))
+    RATE_LIMIT_IP_PER_MINUTE = float(os.environ.get('RATE_LIMIT_IP_PER_MINUTE', '300'))
+    RATE_LIMIT_IP_BURST = float(os.environ.get('RATE_LIMIT_IP_BURST', '100'))
+    ADMISSION_MAX_CONCURRENT = int(os.environ.get('ADMISSION_MAX_CONCURRENT', '64'))
+    ADMISSION_MAX_QUEUE = int(os.environ.get('ADMISSION_MAX_QUEUE', '256'))
+    ADMISSION_TARGET_WAIT = float(os.environ.get('ADMISSION_TARGET_WAIT', '5'))
+    RETENTION_DAYS = float(os.environ.get('RETENTION_DAYS', '0'))
+    RETENTION_INTERVAL = float(os.environ.get('RETENTION_INTERVAL', '3600'))
+    RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', '2000'))
+    RETENTION_VACUUM_PAGES = int(os.environ.get('RETENTION_VACUUM_PAGES', '1000'))
+    ARCHIVE_DIR = os.environ.get('ARCHIVE_DIR', os.path.join('instance', 'archive'))
+    EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', '1000'))
+    IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', '10000'))
+    SESSION_FLUSH_INTERVAL = float(os.environ.get('SESSION_FLUSH_INTERVAL', '30'))
+
+# Metrics
+class Metrics:
+    """Prometheus-style counters, gauges and histograms kept in per-thread shards"""
+
+    DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+    def __init__(self):
+        self._meta: Dict[str, tuple] = {}
+        self._local = threading.local()
+        self._shards: List[tuple] = []
+        self._retired = self._new_shard()
+        self._collectors: List = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _new_shard() -> Dict:
+        return {'values': {}, 'histograms': {}}
+
+    def _shard(self) -> Dict:
+        shard = getattr(self._local, 'shard', None)
+        if shard is None:
+            # The only locked step: registering this thread's shard once
+            shard = self._local.shard = self._new_shard()
+            with self._lock:
+                # Retire finished threads here too, so churning threads cannot pile up between scrapes
+                self._retire_dead_shards()
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _retire_dead_shards(self):
+        """Fold shards of finished threads into the retired shard; call with _lock held"""
+        live = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                live.append((thread, shard))
+            else:
+                self._merge_into(self._retired, shard)
+        self._shards = live
+
+    def counter(self, name: str, help_text: str):
+        self._meta[name] = ('counter', help_text, None)
+
+    def gauge(self, name: str, help_text: str):
+        self._meta[name] = ('gauge', help_text, None)
+
+    def histogram(self, name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS):
+        self._meta[name] = ('histogram', help_text, tuple(buckets))
+
+    def collector(self, func):
+        """Register func() -> [(name, type, help, labels, value)] evaluated at scrape time"""
+        self._collectors.append(func)
+        return func
+
+    def inc(self, name: str, labels: tuple = (), value: float = 1):
+        """Add to a counter or gauge; labels are ((key, value), ...) pairs"""
+        values = self._shard()['values']
+        key = (name, labels)
+        values[key] = values.get(key, 0) + value
+
+    def observe(self, name: str, value: float, labels: tuple = ()):
+        histograms = self._shard()['histograms']
+        key = (name, labels)
+        series = histograms.get(key)
+        if series is None:
+            series = histograms[key] = [[0] * (len(self._meta[name][2]) + 1), 0.0]
+        series[0][bisect.bisect_left(self._meta[name][2], value)] += 1
+        series[1] += value
+
+    @contextmanager
+    def timer(self, name: str, labels: tuple = ()):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, labels)
+
+    def _merge(self) -> Dict:
+        with self._lock:
+            self._retire_dead_shards()
+            merged = self._new_shard()
+            self._merge_into(merged, self._retired)
+            for _, shard in self._shards:
+                self._merge_into(merged, shard)
+        return merged
+
+    @staticmethod
+    def _merge_into(target: Dict, shard: Dict):
+        values = target['values']
+        for key, value in list(shard['values'].items()):
+            values[key] = values.get(key, 0) + value
+        histograms = target['histograms']
+        for key, (counts, total) in list(shard['histograms'].items()):
+            series = histograms.get(key)
+            if series is None:
+                histograms[key] = [list(counts), total]
+            else:
+                series[0] = [a + b for a, b in zip(series[0], counts)]
+                series[1] += total
+
+    @staticmethod
+    def _labels(labels, extra: str = '') -> str:
+        parts = []
+        for key, value in labels:
+            value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            parts.append(f'{key}="{value}"')
+        if extra:
+            parts.append(extra)
+        return '{' + ','.join(parts) + '}' if parts else ''
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        merged = self._merge()
+        lines: List[str] = []
+        for name, (kind, help_text, buckets) in self._meta.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind == 'histogram':
+                for (series_name, labels), (counts, total) in sorted(merged['histograms'].items()):
+                    if series_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(buckets + (float('inf'),), counts):
+                        cumulative += count
+                        le = 'le="+Inf"' if bound == float('inf') else f'le="{bound!r}"'
+                        lines.append(f'{name}_bucket{self._labels(labels, le)} {cumulative}')
+                    lines.append(f'{name}_sum{self._labels(labels)} {total}')
+                    lines.append(f'{name}_count{self._labels(labels)} {cumulative}')
+            else:
+                for (series_name, labels), value in sorted(merged['values'].items()):
+                    if series_name == name:
+                        lines.append(f'{name}{self._labels(labels)} {value}')
+
+        for collect in self._collectors:
+            seen = set()
+            for name, kind, help_text, labels, value in collect():
+                if name not in seen:
+                    lines.append(f'# HELP {name} {help_text}')
+                    lines.append(f'# TYPE {name} {kind}')
+                    seen.add(name)
+                lines.append(f'{name}{self._labels(labels)} {value}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+metrics.histogram('http_request_duration_seconds', 'HTTP request latency by route until the response is returned')
+metrics.gauge('http_requests_in_flight', 'HTTP requests currently being handled')
+metrics.histogram('upstream_request_duration_seconds', 'Upstream /chat/completions latency per attempt')
+metrics.counter('upstream_responses_total', 'Upstream responses by status code (error for transport failures)')
+metrics.counter('answers_total', 'Answers served by source (upstream, cache, similarity, fallback, similarity_fallback)')
+metrics.histogram('detect_subject_duration_seconds', 'Subject classification time')
+metrics.histogram('sqlite_query_duration_seconds', 'SQLite read query time')
+metrics.histogram('sqlite_commit_duration_seconds', 'SQLite write transaction time including commit')
+metrics.counter('requests_shed_total', 'Question requests turned away by reason (rate_limited, queue_full, over_target, timeout)')
+metrics.histogram('admission_wait_seconds', 'Time queued requests waited for an admission slot')
+metrics.counter('export_rows_total', 'Conversation rows streamed by /api/export by format')
+
+# Tracing and profiling
+class Tracer:
+    """Sampled per-request spans exported as Chrome trace events or OTLP/JSON lines"""
+
+    FORMATS = ('chrome', 'otlp')
+
+    def __init__(self, export_dir: str, sample_rate: float = 0.0, export_format: str = 'chrome',
+                 max_bytes: int = 64 * 1024 * 1024, keep_files: int = 5):
+        self.export_dir = export_dir
+        self.max_bytes = max_bytes
+        self.keep_files = keep_files
+        self.sample_rate = 0.0
+        self.export_format = 'chrome'
+        self.configure(sample_rate, export_format)
+        self._current: contextvars.ContextVar = contextvars.ContextVar('trace_span', default=None)
+        self._lock = threading.Lock()
+        self.traces_exported = 0
+        self.spans_exported = 0
+
+    def configure(self, sample_rate: Optional[float] = None, export_format: Optional[str] = None):
+        """Change the sample rate or export format at runtime"""
+        if sample_rate is not None:
+            if not 0.0 <= sample_rate <= 1.0:
+                raise ValueError('sample_rate must be between 0 and 1')
+            self.sample_rate = sample_rate
+        if export_format is not None:
+            if export_format not in self.FORMATS:
+                raise ValueError(f"format must be one of: {', '.join(self.FORMATS)}")
+            self.export_format = export_format
+
+    @property
+    def export_path(self) -> str:
+        name = 'traces.json' if self.export_format == 'chrome' else 'traces.otlp.jsonl'
+        return os.path.join(self.export_dir, name)
+
+    def _open(self, trace: Dict, parent_id: Optional[str], name: str, attributes: Dict) -> Dict:
+        span = {
+            'trace': trace,
+            'span_id': os.urandom(8).hex(),
+            'parent_id': parent_id,
+            'name': name,
+            'start_ns': time.time_ns(),
+            'started': time.perf_counter_ns(),
+            'thread_id': threading.get_ident(),
+            'attributes': attributes
+        }
+        trace['spans'].append(span)
+        return span
+
+    @staticmethod
+    def _close(span: Dict):
+        span['duration_ns'] = time.perf_counter_ns() - span.pop('started')
+
+    def start_trace(self, name: str, **attributes):
+        """Open a root span if this request is sampled; pass the result to finish_trace"""
+        if self.sample_rate <= 0.0 or random.random() >= self.sample_rate:
+            return None
+        span = self._open({'trace_id': os.urandom(16).hex(), 'spans': []}, None, name, attributes)
+        return span, self._current.set(span)
+
+    def finish_trace(self, handle, **attributes):
+        """Close the root span and append the whole trace to the export file"""
+        if handle is None:
+            return
+        span, token = handle
+        span['attributes'].update(attributes)
+        self._close(span)
+        self._current.reset(token)
+        try:
+            self._export(span['trace'])
+        except OSError as e:
+            print(f"Error exporting trace: {e}")
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        """Nested span under the active one; does nothing when the request is not sampled"""
+        parent = self._current.get()
+        if parent is None:
+            yield None
+            return
+        span = self._open(parent['trace'], parent['span_id'], name, attributes)
+        token = self._current.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span['attributes']['error'] = type(e).__name__
+            raise
+        finally:
+            self._current.reset(token)
+            self._close(span)
+
+    def bind(self, coro):
+        """Carry the active span into a coroutine that will run on another thread's loop"""
+        parent = self._current.get()
+        if parent is None:
+            return coro
+
+        async def bound():
+            self._current.set(parent)
+            return await coro
+        return bound()
 
-# Initialize Flask app
-app = Flask(__name__)
-app.config.from_object(Config)
-CORS(app)
+    def _export(self, trace: Dict):
+        spans = [span for span in trace['spans'] if 'duration_ns' in span]
+        if self.export_format == 'chrome':
+            lines = [json.dumps(self._chrome_event(span), default=str) + ',\n' for span in spans]
+        else:
+            lines = [json.dumps(self._otlp_request(trace['trace_id'], spans), default=str) + '\n']
+        path = self.export_path
+        with self._lock:
+            os.makedirs(self.export_dir, exist_ok=True)
+            self._rotate(path)
+            is_new = not os.path.exists(path)
+            with open(path, 'a', encoding='utf-8') as f:
+                if is_new and self.export_format == 'chrome':
+                    # JSON array format; chrome://tracing and Perfetto accept it without the closing bracket
+                    f.write('[\n')
+                f.writelines(lines)
+            self.traces_exported += 1
+            self.spans_exported += len(spans)
+
+    def _rotate(self, path: str):
+        """Once the export file reaches max_bytes, shift it to .1, .2, ... and drop the oldest past keep_files"""
+        try:
+            if self.max_bytes <= 0 or os.path.getsize(path) < self.max_bytes:
+                return
+        except FileNotFoundError:
+            return
+        # Another worker may rotate the same files at the same moment; missing ones are skipped
+        for index in range(self.keep_files, 0, -1):
+            source = f'{path}.{index - 1}' if index > 1 else path
+            try:
+                os.replace(source, f'{path}.{index}')
+            except FileNotFoundError:
+                pass
+        if self.keep_files <= 0:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _chrome_event(span: Dict) -> Dict:
+        return {
+            'name': span['name'],
+            'cat': 'request',
+            'ph': 'X',
+            'ts': span['start_ns'] / 1000,
+            'dur': span['duration_ns'] / 1000,
+            'pid': os.getpid(),
+            'tid': span['thread_id'],
+            'args': dict(span['attributes'], trace_id=span['trace']['trace_id'])
+        }
+
+    @staticmethod
+    def _otlp_value(value) -> Dict:
+        if isinstance(value, bool):
+            return {'boolValue': value}
+        if isinstance(value, int):
+            return {'intValue': str(value)}
+        if isinstance(value, float):
+            return {'doubleValue': value}
+        return {'stringValue': str(value)}
+
+    def _otlp_request(self, trace_id: str, spans: List[Dict]) -> Dict:
+        """One ExportTraceServiceRequest in OTLP/JSON, as read by the collector's otlpjsonfile receiver"""
+        otlp_spans = []
+        for span in spans:
+            otlp_span = {
+                'traceId': trace_id,
+                'spanId': span['span_id'],
+                'name': span['name'],
+                'kind': 2 if span['parent_id'] is None else 1,
+                'startTimeUnixNano': str(span['start_ns']),
+                'endTimeUnixNano': str(span['start_ns'] + span['duration_ns']),
+                'attributes': [{'key': key, 'value': self._otlp_value(value)}
+                               for key, value in span['attributes'].items()] +
+                              [{'key': 'thread.id', 'value': {'intValue': str(span['thread_id'])}}]
+            }
+            if span['parent_id'] is not None:
+                otlp_span['parentSpanId'] = span['parent_id']
+            if 'error' in span['attributes']:
+                otlp_span['status'] = {'code': 2}
+            otlp_spans.append(otlp_span)
+        return {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'ai-study-assistant'}}]},
+            'scopeSpans': [{'scope': {'name': __name__}, 'spans': otlp_spans}]
+        }]}
+
+    def stats(self) -> Dict:
+        return {
+            'sample_rate': self.sample_rate,
+            'format': self.export_format,
+            'export_path': self.export_path,
+            'max_bytes': self.max_bytes,
+            'keep_files': self.keep_files,
+            'traces_exported': self.traces_exported,
+            'spans_exported': self.spans_exported
+        }
+
+class Profiler:
+    """On-demand profiles of the live process: stack sampling across all threads, or cProfile"""
+
+    MODES = ('sample', 'cprofile')
+
+    def __init__(self, max_seconds: float = 60.0, interval: float = 0.005):
+        self.max_seconds = max_seconds
+        self.interval = interval
+        self._busy = threading.Lock()
+        self._profiles: Optional[List] = None
+
+    def capture(self, seconds: float, mode: str = 'sample', loop=None, limit: int = 60) -> str:
+        """Profile for `seconds` and return the report; raises RuntimeError if one is already running"""
+        if mode not in self.MODES:
+            raise ValueError(f"mode must be one of: {', '.join(self.MODES)}")
+        if not 0 < seconds <= self.max_seconds:
+            raise ValueError(f'seconds must be between 0 and {self.max_seconds:g}')
+        if not self._busy.acquire(blocking=False):
+            raise RuntimeError('A profile is already running')
+        try:
+            if mode == 'sample':
+                return self._sample(seconds)
+            return self._cprofile(seconds, loop, limit)
+        finally:
+            self._busy.release()
+
+    def _sample(self, seconds: float) -> str:
+        """Wall-clock stack samples of every thread, as folded stacks for flamegraph.pl or speedscope"""
+        own = threading.get_ident()
+        stacks: Counter = Counter()
+        deadline = time.monotonic() + seconds
+        while time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                stacks[';'.join(reversed(stack))] += 1
+            time.sleep(self.interval)
+        return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+    def _cprofile(self, seconds: float, loop, limit: int) -> str:
+        """cProfile of the whole process for the window, falling back to stack samples if it cannot start"""
+        # From 3.12 cProfile sits on sys.monitoring: one profiler sees every thread, and a second
+        # enable() anywhere in the process fails. Before that it only sees the thread that enabled it.
+        if sys.version_info >= (3, 12):
+            profile = cProfile.Profile()
+            try:
+                profile.enable()
+            except (RuntimeError, ValueError) as e:
+                return f'# cProfile unavailable ({e}); stack samples instead\n' + self._sample(seconds)
+            try:
+                time.sleep(seconds)
+            finally:
+                profile.disable()
+            return self._report([profile], f'all threads profiled over {seconds:g}s', limit)
+
+        loop_profile = cProfile.Profile()
+
+        async def toggle(enable: bool):
+            loop_profile.enable() if enable else loop_profile.disable()
+
+        self._profiles = []
+        if loop is not None:
+            asyncio.run_coroutine_threadsafe(toggle(True), loop).result(5)
+        try:
+            time.sleep(seconds)
+        finally:
+            if loop is not None:
+                asyncio.run_coroutine_threadsafe(toggle(False), loop).result(5)
+            profiles, self._profiles = self._profiles, None
+        if loop is not None:
+            profiles.insert(0, loop_profile)
+        return self._report(profiles, f'{len(profiles) - (loop is not None)} requests profiled over {seconds:g}s', limit)
+
+    def _report(self, profiles: List, summary: str, limit: int) -> str:
+        output = io.StringIO()
+        output.write(summary + '\n')
+        if profiles:
+            stats = pstats.Stats(*profiles, stream=output)
+            stats.sort_stats('cumulative').print_stats(limit)
+        return output.getvalue()
+
+    def request_started(self):
+        """Profile this request's thread while a per-thread cProfile capture is running"""
+        if self._profiles is None:
+            return None
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except (RuntimeError, ValueError) as e:
+            # Another profiler owns the hook; the request itself must not fail over it
+            print(f"Could not profile request: {e}")
+            return None
+        return profile
+
+    def request_finished(self, profile):
+        if profile is None:
+            return
+        profile.disable()
+        profiles = self._profiles
+        if profiles is not None:
+            profiles.append(profile)
+
+tracer = Tracer(Config.TRACE_EXPORT_DIR, sample_rate=Config.TRACE_SAMPLE_RATE, export_format=Config.TRACE_FORMAT,
+                max_bytes=Config.TRACE_MAX_BYTES, keep_files=Config.TRACE_KEEP_FILES)
+profiler = Profiler(max_seconds=Config.PROFILE_MAX_SECONDS)
 
 # Database setup
+class MigrationError(Exception):
+    """The schema cannot be upgraded until an operator resolves the data it reports"""
+
 class Database:
-    def __init__(self, db_path: str):
+    """SQLite data-access layer over a pool of tuned, long-lived connections"""
+
+    # Bump when _create_schema or _create_search_index change
+    SCHEMA_VERSION = 5
+    
+    # Resource catalog indexes for filtered keyset pagination, dropped during bulk imports
+    RESOURCE_INDEXES = {
+        'idx_study_resources_created': 'study_resources (created_at DESC, id DESC)',
+        'idx_study_resources_subject': 'study_resources (subject, created_at DESC, id DESC)',
+        'idx_study_resources_difficulty': 'study_resources (difficulty, created_at DESC, id DESC)',
+        'idx_study_resources_type': 'study_resources (type, created_at DESC, id DESC)',
+    }
+
+    def __init__(self, db_path: str, pool_size: int = 16, busy_timeout_ms: int = 5000,
+                 cache_size_kb: int = 20000, mmap_size: int = 256 * 1024 * 1024):
         self.db_path = db_path
-        self.init_database()
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self._pool: queue.LifoQueue = queue.LifoQueue(maxsize=pool_size)
+        self.fts_enabled = False
     
-    def init_database(self):
-        """Initialize the database with required tables"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=self.busy_timeout_ms / 1000,
+            check_same_thread=False,
+            cached_statements=256
+        )
+        conn.row_factory = sqlite3.Row
+        # Must precede WAL, which writes the header of a new file; older files need `flask archive --full-vacuum`
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.execute('PRAGMA synchronous = NORMAL')
+        conn.execute(f'PRAGMA busy_timeout = {int(self.busy_timeout_ms)}')
+        conn.execute(f'PRAGMA cache_size = {-int(self.cache_size_kb)}')
+        conn.execute(f'PRAGMA mmap_size = {int(self.mmap_size)}')
+        conn.execute('PRAGMA temp_store = MEMORY')
+        return conn
+    
+    @contextmanager
+    def connection(self):
+        """Borrow a pooled connection; its prepared-statement cache survives between borrows"""
+        try:
+            conn = self._pool.get_nowait()
+        except queue.Empty:
+            conn = self._connect()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+            try:
+                self._pool.put_nowait(conn)
+            except queue.Full:
+                conn.close()
+    
+    @contextmanager
+    def transaction(self):
+        """Run a block in one write transaction, taking the write lock up front"""
+        with self.connection() as conn, tracer.span('sqlite.transaction'):
+            started = time.perf_counter()
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.rollback()
+                raise
+            conn.commit()
+            metrics.observe('sqlite_commit_duration_seconds', time.perf_counter() - started)
+    
+    def execute(self, query: str, params=()) -> sqlite3.Cursor:
+        """Run a single write statement and commit it"""
+        with self.transaction() as conn:
+            return conn.execute(query, params)
+    
+    def executemany(self, query: str, rows) -> int:
+        """Run a statement for many rows in one transaction"""
+        with self.transaction() as conn:
+            return conn.executemany(query, rows).rowcount
+    
+    def query(self, query: str, params=()) -> List[sqlite3.Row]:
+        """Run a read query and return all rows"""
+        with self.connection() as conn, tracer.span('sqlite.query'), metrics.timer('sqlite_query_duration_seconds'):
+            return conn.execute(query, params).fetchall()
+    
+    def query_one(self, query: str, params=()) -> Optional[sqlite3.Row]:
+        """Run a read query and return the first row"""
+        with self.connection() as conn, tracer.span('sqlite.query'), metrics.timer('sqlite_query_duration_seconds'):
+            return conn.execute(query, params).fetchone()
+    
+    def close(self):
+        """Close every idle pooled connection"""
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                return
+    
+    def schema_version(self) -> int:
+        """Schema version recorded by the last migration (0 for a new database)"""
+        with self.connection() as conn:
+            return conn.execute('PRAGMA user_version').fetchone()[0]
+    
+    def migrate(self) -> bool:
+        """Create or upgrade the schema and seed data; returns False if it was already current
         
+        Safe to call from every worker: a current database costs one PRAGMA read, and the
+        schema, search index, seed rows and user_version bump commit as one BEGIN IMMEDIATE
+        transaction, so concurrent first runs wait and then find the work done.
+        """
+        if self.check_schema():
+            return False
+        with self.connection() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            if conn.execute('PRAGMA user_version').fetchone()[0] >= self.SCHEMA_VERSION:
+                conn.rollback()
+                self.check_schema()
+                return False
+            self._create_schema(conn.cursor())
+            fts_enabled = self._create_search_index(conn)
+            self.seed_default_resources(conn)
+            conn.execute(f'PRAGMA user_version = {int(self.SCHEMA_VERSION)}')
+            conn.commit()
+        self.fts_enabled = fts_enabled
+        return True
+    
+    MAX_REPORTED_DUPLICATES = 50
+    
+    def _check_resource_duplicates(self, cursor: sqlite3.Cursor):
+        """Refuse to add the (url, subject) unique index over duplicate rows, listing them instead"""
+        duplicates = cursor.execute('''
+            SELECT url, subject, GROUP_CONCAT(id, ', ') FROM study_resources
+            WHERE url IS NOT NULL
+            GROUP BY url, subject HAVING COUNT(*) > 1
+            ORDER BY MIN(id)
+        ''').fetchall()
+        if not duplicates:
+            return
+        lines = [f"  ids {ids}: {subject} {url}" for url, subject, ids in duplicates[:self.MAX_REPORTED_DUPLICATES]]
+        if len(duplicates) > self.MAX_REPORTED_DUPLICATES:
+            lines.append(f"  ... and {len(duplicates) - self.MAX_REPORTED_DUPLICATES} more")
+        raise MigrationError(
+            f"study_resources has {len(duplicates)} (url, subject) pairs stored more than once; "
+            f"delete or change all but one row of each, then run `flask --app ai_study_assistant migrate`:\n"
+            + '\n'.join(lines)
+        )
+    
+    def check_schema(self) -> bool:
+        """Load schema-dependent flags; returns False if the database needs migrating"""
+        if self.schema_version() < self.SCHEMA_VERSION:
+            return False
+        self.fts_enabled = self.query_one(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'conversations_fts'"
+        ) is not None
+        return True
+    
+    def _create_schema(self, cursor: sqlite3.Cursor):
+        """Create tables and indexes that do not exist yet"""
         # Create conversations table
         cursor.execute('''
             CREATE TABLE IF NOT EXISTS conversations (
@@ -83,19 +811,238 @@ class Database:
             )
         ''')
         
-        conn.commit()
-        conn.close()
-        self.seed_default_resources()
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_sessions_last_active ON sessions (last_active)')
+        
+        # Create answer_cache table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS answer_cache (
+                cache_key TEXT PRIMARY KEY,
+                subject TEXT NOT NULL,
+                model TEXT NOT NULL,
+                prompt_version TEXT NOT NULL,
+                response TEXT NOT NULL,
+                expires_at REAL NOT NULL
+            )
+        ''')
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_answer_cache_subject ON answer_cache (subject)')
+        
+        # Conversation history keyset pagination
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_conversations_session ON conversations (session_id, created_at, id)')
+        
+        # Resource catalog indexes for filtered keyset pagination
+        self.create_resource_indexes(cursor)
+        
+        # One row per (url, subject) so bulk imports can upsert
+        self._check_resource_duplicates(cursor)
+        cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_study_resources_url_subject ON study_resources (url, subject)')
+        
+        # Change counters so caches can tell when a table was modified
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS table_versions (
+                name TEXT PRIMARY KEY,
+                version INTEGER NOT NULL DEFAULT 0
+            )
+        ''')
+        cursor.execute("INSERT OR IGNORE INTO table_versions (name, version) VALUES ('study_resources', 0)")
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS study_resources_version_{event.lower()}
+                AFTER {event} ON study_resources
+                BEGIN
+                    UPDATE table_versions SET version = version + 1 WHERE name = 'study_resources';
+                END
+            ''')
+        
+        # Token buckets shared by workers when RATE_LIMIT_BACKEND=sqlite
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS rate_limits (
+                key TEXT PRIMARY KEY,
+                tokens REAL NOT NULL,
+                updated REAL NOT NULL
+            )
+        ''')
+        
+        # Index of conversation rows moved to archive segment files
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS archive_segments (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                path TEXT UNIQUE NOT NULL,
+                day TEXT NOT NULL,
+                first_id INTEGER NOT NULL,
+                last_id INTEGER NOT NULL,
+                rows INTEGER NOT NULL,
+                bytes INTEGER NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS archive_sessions (
+                session_id TEXT NOT NULL,
+                segment_id INTEGER NOT NULL,
+                first_created TEXT NOT NULL,
+                last_created TEXT NOT NULL,
+                rows INTEGER NOT NULL,
+                PRIMARY KEY (session_id, segment_id)
+            )
+        ''')
+    
+    def export_conversations(self, after_id: int, limit: int, session_id: Optional[str] = None,
+                             subject: Optional[str] = None, start: Optional[str] = None,
+                             end: Optional[str] = None) -> List[sqlite3.Row]:
+        """Next `limit` rows by id after `after_id` with created_at in [start, end)"""
+        query = '''
+            SELECT id, session_id, question, answer, subject, confidence, created_at
+            FROM conversations
+            WHERE id > ?
+        '''
+        params: List = [after_id]
+        if session_id is not None:
+            query += ' AND session_id = ?'
+            params.append(session_id)
+        if subject is not None:
+            query += ' AND subject = ?'
+            params.append(subject)
+        if start is not None:
+            query += ' AND created_at >= ?'
+            params.append(start)
+        if end is not None:
+            query += ' AND created_at < ?'
+            params.append(end)
+        query += ' ORDER BY id LIMIT ?'
+        params.append(limit)
+        return self.query(query, params)
+    
+    @classmethod
+    def create_resource_indexes(cls, conn):
+        for name, target in cls.RESOURCE_INDEXES.items():
+            conn.execute(f'CREATE INDEX IF NOT EXISTS {name} ON {target}')
+    
+    def get_history(self, session_id: str, limit: int, before: Optional[tuple] = None,
+                    after: Optional[tuple] = None) -> List[sqlite3.Row]:
+        """Newest `limit` conversation rows of a session strictly between the after/before positions"""
+        query = '''
+            SELECT id, question, answer, subject, confidence, created_at
+            FROM conversations
+            WHERE session_id = ?
+        '''
+        params: List = [session_id]
+        if before is not None:
+            query += ' AND (created_at, id) < (?, ?)'
+            params.extend(before)
+        if after is not None:
+            query += ' AND (created_at, id) > (?, ?)'
+            params.extend(after)
+        query += ' ORDER BY created_at DESC, id DESC LIMIT ?'
+        params.append(limit)
+        return self.query(query, params)
     
-    def seed_default_resources(self):
-        """Seed default study resources"""
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.cursor()
+    def _create_search_index(self, conn: sqlite3.Connection) -> bool:
+        """Create FTS5 indexes kept in sync by triggers; returns False if FTS5 is unavailable
         
+        Runs inside the caller's transaction; a failure only undoes its own savepoint.
+        """
+        indexed = {
+            'conversations': ('question', 'answer'),
+            'study_resources': ('title', 'description'),
+        }
+        conn.execute('SAVEPOINT search_index')
+        try:
+            for table, columns in indexed.items():
+                fts = f'{table}_fts'
+                exists = conn.execute(
+                    "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (fts,)
+                ).fetchone()
+                cols = ', '.join(columns)
+                new_cols = ', '.join(f'new.{c}' for c in columns)
+                old_cols = ', '.join(f'old.{c}' for c in columns)
+                conn.execute(f'''
+                    CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5(
+                        {cols}, content='{table}', content_rowid='id', tokenize='porter unicode61'
+                    )
+                ''')
+                conn.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN
+                        INSERT INTO {fts} (rowid, {cols}) VALUES (new.id, {new_cols});
+                    END
+                ''')
+                conn.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN
+                        INSERT INTO {fts} ({fts}, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+                    END
+                ''')
+                conn.execute(f'''
+                    CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE ON {table} BEGIN
+                        INSERT INTO {fts} ({fts}, rowid, {cols}) VALUES ('delete', old.id, {old_cols});
+                        INSERT INTO {fts} (rowid, {cols}) VALUES (new.id, {new_cols});
+                    END
+                ''')
+                if not exists:
+                    # Index rows written before the search index existed
+                    conn.execute(f"INSERT INTO {fts} ({fts}) VALUES ('rebuild')")
+            conn.execute('RELEASE search_index')
+            return True
+        except sqlite3.OperationalError as e:
+            conn.execute('ROLLBACK TO search_index')
+            conn.execute('RELEASE search_index')
+            print(f"Full-text search disabled: {e}")
+            return False
+    
+    @staticmethod
+    def fts_query(text: str) -> Optional[str]:
+        """Turn free text into a safe FTS5 query: every term required, last term as a prefix"""
+        terms = re.findall(r'\w+', text.lower())
+        if not terms:
+            return None
+        quoted = [f'"{term}"' for term in terms[:32]]
+        quoted[-1] += '*'
+        return ' '.join(quoted)
+    
+    def search_conversations(self, match: str, subject: Optional[str] = None,
+                             session_id: Optional[str] = None, limit: int = 20,
+                             offset: int = 0) -> List[sqlite3.Row]:
+        """BM25-ranked conversation matches with highlighted snippets"""
+        query = '''
+            SELECT c.id, c.question, c.subject, c.created_at,
+                   snippet(conversations_fts, -1, '<mark>', '</mark>', '…', 24) AS snippet,
+                   bm25(conversations_fts) AS score
+            FROM conversations_fts
+            JOIN conversations c ON c.id = conversations_fts.rowid
+            WHERE conversations_fts MATCH ?
+        '''
+        params: List = [match]
+        if subject:
+            query += ' AND c.subject = ?'
+            params.append(subject)
+        if session_id:
+            query += ' AND c.session_id = ?'
+            params.append(session_id)
+        query += ' ORDER BY score LIMIT ? OFFSET ?'
+        params.extend((limit, offset))
+        return self.query(query, params)
+    
+    def search_resources(self, match: str, subject: Optional[str] = None,
+                         limit: int = 20, offset: int = 0) -> List[sqlite3.Row]:
+        """BM25-ranked study resource matches with highlighted snippets"""
+        query = '''
+            SELECT r.id, r.title, r.subject, r.url, r.type, r.difficulty, r.created_at,
+                   snippet(study_resources_fts, -1, '<mark>', '</mark>', '…', 24) AS snippet,
+                   bm25(study_resources_fts, 2.0, 1.0) AS score
+            FROM study_resources_fts
+            JOIN study_resources r ON r.id = study_resources_fts.rowid
+            WHERE study_resources_fts MATCH ?
+        '''
+        params: List = [match]
+        if subject:
+            query += ' AND r.subject = ?'
+            params.append(subject)
+        query += ' ORDER BY score LIMIT ? OFFSET ?'
+        params.extend((limit, offset))
+        return self.query(query, params)
+    
+    def seed_default_resources(self, conn: sqlite3.Connection):
+        """Seed default study resources within the caller's transaction"""
         # Check if resources already exist
-        cursor.execute("SELECT COUNT(*) FROM study_resources")
-        if cursor.fetchone()[0] > 0:
-            conn.close()
+        if conn.execute("SELECT COUNT(*) FROM study_resources").fetchone()[0] > 0:
             return
         
         default_resources = [
@@ -107,19 +1054,1776 @@ class Database:
             ("Biology: The Study of Life", "Introduction to biological concepts and living organisms", "Biology", "https://www.khanacademy.org/science/biology", "Course", "Beginner"),
         ]
         
-        cursor.executemany('''
-            INSERT INTO study_resources (title, description, subject, url, type, difficulty)
-            VALUES (?, ?, ?, ?, ?, ?)
-        ''', default_resources)
+        conn.executemany('''
+            INSERT INTO study_resources (title, description, subject, url, type, difficulty)
+            VALUES (?, ?, ?, ?, ?, ?)
+            ON CONFLICT (url, subject) DO NOTHING
+        ''', default_resources)
+    
+    def table_version(self, name: str) -> int:
+        """Change counter maintained by triggers on the named table"""
+        row = self.query_one('SELECT version FROM table_versions WHERE name = ?', (name,))
+        return row[0] if row else 0
+    
+    def get_resources(self, subject: Optional[str] = None, difficulty: Optional[str] = None,
+                      resource_type: Optional[str] = None, limit: Optional[int] = None,
+                      after: Optional[tuple] = None) -> List[sqlite3.Row]:
+        """Return study resources newest first, optionally filtered and keyset-paginated"""
+        query = '''
+            SELECT id, title, description, subject, url, type, difficulty, created_at
+            FROM study_resources
+            WHERE 1 = 1
+        '''
+        params: List = []
+        for column, value in (('subject', subject), ('difficulty', difficulty), ('type', resource_type)):
+            if value:
+                query += f' AND {column} = ?'
+                params.append(value)
+        if after is not None:
+            query += ' AND (created_at, id) < (?, ?)'
+            params.extend(after)
+        query += ' ORDER BY created_at DESC, id DESC'
+        if limit is not None:
+            query += ' LIMIT ?'
+            params.append(limit)
+        return self.query(query, params)
+
+# Keyset pagination cursors
+def encode_cursor(created_at: str, row_id: int) -> str:
+    """Encode a (created_at, id) position as an opaque URL-safe cursor"""
+    return base64.urlsafe_b64encode(f"{created_at}|{row_id}".encode('utf-8')).decode('ascii')
+
+def decode_cursor(cursor: str) -> tuple:
+    """Turn an opaque cursor back into (created_at, id); raises ValueError if malformed"""
+    try:
+        created_at, row_id = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8').rsplit('|', 1)
+        return created_at, int(row_id)
+    except Exception:
+        raise ValueError('Invalid cursor')
+
+# Resource catalog
+class ResourceCatalog:
+    """Pre-serialized resource pages, rebuilt only when study_resources changes"""
+
+    PUBLIC_FIELDS = ('title', 'description', 'subject', 'url', 'type', 'difficulty')
+    MAX_LIMIT = 500
+
+    def __init__(self, db: Database, max_pages: int = 256):
+        self.db = db
+        self.max_pages = max_pages
+        self._pages: 'OrderedDict[tuple, tuple]' = OrderedDict()
+        self._version: Optional[int] = None
+        self._lock = threading.Lock()
+
+    def page(self, subject: Optional[str] = None, difficulty: Optional[str] = None,
+             resource_type: Optional[str] = None, limit: Optional[int] = None,
+             cursor: Optional[str] = None) -> tuple:
+        """Return (body, etag, next_cursor) for one catalog page"""
+        if limit is not None and not 1 <= limit <= self.MAX_LIMIT:
+            raise ValueError(f'limit must be between 1 and {self.MAX_LIMIT}')
+        after = decode_cursor(cursor) if cursor else None
+        
+        version = self.db.table_version('study_resources')
+        key = (subject, difficulty, resource_type, limit, cursor)
+        with self._lock:
+            if version != self._version:
+                self._pages.clear()
+                self._version = version
+            cached = self._pages.get(key)
+            if cached is not None:
+                self._pages.move_to_end(key)
+                return cached
+        
+        # Fetch one extra row to learn whether another page exists
+        rows = self.db.get_resources(subject, difficulty, resource_type,
+                                     limit + 1 if limit is not None else None, after)
+        next_cursor = None
+        if limit is not None and len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1]['created_at'], rows[-1]['id'])
+        
+        body = json.dumps([{field: row[field] for field in self.PUBLIC_FIELDS} for row in rows]).encode('utf-8')
+        etag = hashlib.sha256(body).hexdigest()[:32]
+        result = (body, etag, next_cursor)
+        
+        with self._lock:
+            if version == self._version:
+                self._pages[key] = result
+                while len(self._pages) > self.max_pages:
+                    self._pages.popitem(last=False)
+        return result
+
+# Resource import
+class ResourceImporter:
+    """Bulk-loads study resources from CSV or JSONL, then swaps them into the live catalog at once
+
+    Valid rows are upserted on (url, subject) into a private staging table in large executemany
+    transactions. A single final transaction merges the staged rows into study_resources (or
+    replaces its contents with them), so readers see either the old catalog or the new one.
+    """
+
+    FIELDS = ('title', 'description', 'subject', 'url', 'type', 'difficulty')
+    MAX_LENGTHS = {'title': 300, 'description': 4000, 'subject': 100, 'url': 2000, 'type': 50, 'difficulty': 50}
+    DIFFICULTIES = {'beginner': 'Beginner', 'intermediate': 'Intermediate', 'advanced': 'Advanced'}
+    MAX_REPORTED_ERRORS = 20
+
+    def __init__(self, db: Database, batch_size: int = 10000):
+        self.db = db
+        self.batch_size = batch_size
+
+    @staticmethod
+    def read(stream, import_format: str):
+        """Yield (line number, record) pairs; JSONL records are left as text for validate()"""
+        if import_format == 'csv':
+            reader = csv.DictReader(stream)
+            for record in reader:
+                yield reader.line_num, record
+        else:
+            for line_number, line in enumerate(stream, 1):
+                if line.strip():
+                    yield line_number, line
+
+    def validate(self, record) -> tuple:
+        """A staging row from one input record; raises ValueError naming the problem"""
+        if isinstance(record, str):
+            try:
+                record = json.loads(record)
+            except ValueError:
+                raise ValueError('not valid JSON')
+        if not isinstance(record, dict):
+            raise ValueError('expected an object')
+
+        values = {}
+        for field in self.FIELDS:
+            value = record.get(field)
+            value = '' if value is None else str(value).strip()
+            if len(value) > self.MAX_LENGTHS[field]:
+                raise ValueError(f'{field} is longer than {self.MAX_LENGTHS[field]} characters')
+            values[field] = value or None
+        for field in ('title', 'subject', 'url'):
+            if values[field] is None:
+                raise ValueError(f'{field} is required')
+        if not values['url'].startswith(('http://', 'https://')):
+            raise ValueError('url must start with http:// or https://')
+        if values['difficulty'] is not None:
+            values['difficulty'] = self.DIFFICULTIES.get(values['difficulty'].lower())
+            if values['difficulty'] is None:
+                raise ValueError('difficulty must be Beginner, Intermediate or Advanced')
+        return tuple(values[field] for field in self.FIELDS)
+
+    def run(self, stream, import_format: str, replace: bool = False, force: bool = False):
+        """Import a text stream, yielding progress after every batch and a summary with done=True last
+
+        Stopping early (e.g. the client disconnected) drops the staging table and leaves the
+        live catalog untouched. So does an import with no valid rows, or a replace that hit
+        invalid rows unless force is set; their summary carries an error instead of counts.
+        """
+        if import_format not in ('csv', 'jsonl'):
+            raise ValueError('format must be csv or jsonl')
+        staging = f'study_resources_import_{os.urandom(6).hex()}'
+        columns = ', '.join(self.FIELDS)
+        stage_sql = f'''
+            INSERT INTO {staging} ({columns}) VALUES ({', '.join('?' * len(self.FIELDS))})
+            ON CONFLICT (url, subject) DO UPDATE SET
+                title = excluded.title, description = excluded.description,
+                type = excluded.type, difficulty = excluded.difficulty
+        '''
+        progress = {'rows_read': 0, 'rows_valid': 0, 'rows_invalid': 0, 'errors': []}
+        started = time.perf_counter()
+
+        def report() -> Dict:
+            elapsed = time.perf_counter() - started
+            return dict(progress, elapsed_s=round(elapsed, 3),
+                        rows_per_second=round(progress['rows_read'] / elapsed) if elapsed else 0)
+
+        with self.db.transaction() as conn:
+            # No catalog indexes here; only the unique key the upserts deduplicate on
+            conn.execute(f'''
+                CREATE TABLE {staging} (
+                    title TEXT NOT NULL,
+                    description TEXT,
+                    subject TEXT NOT NULL,
+                    url TEXT NOT NULL,
+                    type TEXT,
+                    difficulty TEXT,
+                    UNIQUE (url, subject)
+                )
+            ''')
+        try:
+            batch = []
+            for line_number, record in self.read(stream, import_format):
+                progress['rows_read'] += 1
+                try:
+                    batch.append(self.validate(record))
+                except ValueError as e:
+                    progress['rows_invalid'] += 1
+                    if len(progress['errors']) < self.MAX_REPORTED_ERRORS:
+                        progress['errors'].append({'line': line_number, 'error': str(e)})
+                    continue
+                if len(batch) >= self.batch_size:
+                    self.db.executemany(stage_sql, batch)
+                    progress['rows_valid'] += len(batch)
+                    batch = []
+                    yield report()
+            if batch:
+                self.db.executemany(stage_sql, batch)
+                progress['rows_valid'] += len(batch)
+
+            if progress['rows_valid'] == 0:
+                yield dict(report(), done=True, replace=replace,
+                           error='No valid rows to import; the catalog was left unchanged')
+                return
+            if replace and progress['rows_invalid'] and not force:
+                yield dict(report(), done=True, replace=replace,
+                           error=f"{progress['rows_invalid']} invalid rows; the catalog was left "
+                                 f"unchanged (force the replace to drop their resources anyway)")
+                return
+            with tracer.span('resource_import.swap'):
+                result = self._swap(staging, replace)
+            yield dict(report(), done=True, replace=replace, **result)
+        finally:
+            with self.db.transaction() as conn:
+                conn.execute(f'DROP TABLE IF EXISTS {staging}')
+
+    def _swap(self, staging: str, replace: bool) -> Dict:
+        columns = ', '.join(self.FIELDS)
+        with self.db.transaction() as conn:
+            staged = conn.execute(f'SELECT COUNT(*) FROM {staging}').fetchone()[0]
+            live = conn.execute('SELECT COUNT(*) FROM study_resources').fetchone()[0]
+            # For a load the size of the catalog, one index rebuild beats updating them row by row
+            defer_indexes = replace or staged >= live
+            if defer_indexes:
+                for name in Database.RESOURCE_INDEXES:
+                    conn.execute(f'DROP INDEX IF EXISTS {name}')
+            deleted = 0
+            if replace:
+                deleted = conn.execute(f'''
+                    DELETE FROM study_resources
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM {staging} s
+                        WHERE s.url = study_resources.url AND s.subject = study_resources.subject
+                    )
+                ''').rowcount
+            # Unchanged rows are skipped so they keep their position and do not churn the search index
+            upserted = conn.execute(f'''
+                INSERT INTO study_resources ({columns})
+                SELECT {columns} FROM {staging} WHERE true ORDER BY rowid
+                ON CONFLICT (url, subject) DO UPDATE SET
+                    title = excluded.title, description = excluded.description,
+                    type = excluded.type, difficulty = excluded.difficulty
+                WHERE title IS NOT excluded.title OR description IS NOT excluded.description
+                   OR type IS NOT excluded.type OR difficulty IS NOT excluded.difficulty
+            ''').rowcount
+            if defer_indexes:
+                Database.create_resource_indexes(conn)
+            total = conn.execute('SELECT COUNT(*) FROM study_resources').fetchone()[0]
+        inserted = total - (live - deleted)
+        return {'staged': staged, 'inserted': inserted, 'updated': upserted - inserted,
+                'deleted': deleted, 'catalog_size': total}
+
+# Conversation logging
+class ConversationWriter:
+    """Write-behind logger that batches conversation rows off the request path"""
+
+    INSERT_SQL = '''
+        INSERT INTO conversations (session_id, question, answer, subject, confidence, created_at)
+        VALUES (?, ?, ?, ?, ?, ?)
+    '''
+    _STOP = object()
+
+    def __init__(self, db: Database, max_queue: int = 10000, batch_size: int = 200,
+                 flush_interval: float = 0.5):
+        self.db = db
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._stats_lock = threading.Lock()
+        self.rows_written = 0
+        self.batches = 0
+        self.overflow_writes = 0
+        self.failed_rows = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Start the writer thread; until then submit() writes synchronously"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='conversation-writer', daemon=True)
+            self._thread.start()
+
+    @staticmethod
+    def make_record(session_id: str, question: str, answer: str,
+                    subject: Optional[str], confidence: Optional[float]) -> tuple:
+        """Build an INSERT_SQL row stamped with the current time"""
+        # Stamp now in CURRENT_TIMESTAMP's format so ordering reflects request time
+        created_at = datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        return (session_id, question, answer, subject, confidence, created_at)
+
+    def submit(self, session_id: str, question: str, answer: str,
+               subject: Optional[str], confidence: Optional[float]):
+        """Queue one conversation row; writes synchronously if the queue is full"""
+        record = self.make_record(session_id, question, answer, subject, confidence)
+        if self._thread is None or not self._thread.is_alive():
+            self._flush([record])
+            return
+        try:
+            self._queue.put_nowait(record)
+        except queue.Full:
+            with self._stats_lock:
+                self.overflow_writes += 1
+            self._flush([record])
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            deadline = None
+            while len(batch) < self.batch_size:
+                timeout = None if deadline is None else deadline - time.monotonic()
+                if timeout is not None and timeout <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is self._STOP:
+                    stopping = True
+                    break
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+            if batch:
+                self._flush(batch)
+
+    def _flush(self, batch: List[tuple]):
+        started = time.perf_counter()
+        for attempt in range(3):
+            try:
+                self.db.executemany(self.INSERT_SQL, batch)
+                break
+            except sqlite3.Error as e:
+                print(f"Error writing conversations (attempt {attempt + 1}): {e}")
+                time.sleep(0.1 * (attempt + 1))
+        else:
+            with self._stats_lock:
+                self.failed_rows += len(batch)
+            return
+        
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._stats_lock:
+            self.rows_written += len(batch)
+            self.batches += 1
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self._total_flush_ms += elapsed_ms
+
+    def write_now(self, records: List[tuple]):
+        """Write rows synchronously in a single transaction, bypassing the queue"""
+        if records:
+            self._flush(records)
+
+    def close(self, timeout: float = 30.0):
+        """Flush everything still queued and stop the writer thread"""
+        if self._thread is not None and self._thread.is_alive():
+            self._queue.put(self._STOP)
+            self._thread.join(timeout)
+
+    def stats(self) -> Dict:
+        """Queue depth and flush latency for the health endpoint"""
+        with self._stats_lock:
+            return {
+                'queue_depth': self._queue.qsize(),
+                'rows_written': self.rows_written,
+                'batches': self.batches,
+                'overflow_writes': self.overflow_writes,
+                'failed_rows': self.failed_rows,
+                'last_flush_ms': round(self.last_flush_ms, 3),
+                'avg_flush_ms': round(self._total_flush_ms / self.batches, 3) if self.batches else 0.0,
+                'max_flush_ms': round(self.max_flush_ms, 3)
+            }
+
+# Session activity
+class SessionTracker:
+    """Notes session creation and last activity in memory and upserts them into `sessions` in batches
+
+    A request only updates a dict entry; a background thread writes everything seen since the
+    last flush in one transaction and then refreshes the session counts from the table, so the
+    counts cover every worker process sharing the database.
+    """
+
+    ACTIVE_WINDOWS = {'5m': 300, '1h': 3600, '24h': 86400}
+    UPSERT_SQL = '''
+        INSERT INTO sessions (session_id, created_at, last_active) VALUES (?, ?, ?)
+        ON CONFLICT (session_id) DO UPDATE SET last_active = max(last_active, excluded.last_active)
+    '''
+
+    def __init__(self, db: Database, flush_interval: float = 30.0):
+        self.db = db
+        self.flush_interval = flush_interval
+        self.flushes = 0
+        self.rows_flushed = 0
+        self.last_flush_ms = 0.0
+        self._counts: Dict = {}
+        self._pending: Dict[str, list] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        """Start the background flush thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='session-tracker', daemon=True)
+            self._thread.start()
+
+    @staticmethod
+    def _timestamp(seconds: float) -> str:
+        # CURRENT_TIMESTAMP's format, so the table's defaults and these values compare correctly
+        return datetime.fromtimestamp(seconds, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+    def touch(self, session_id: str):
+        """Record activity for a session; no database write"""
+        now = time.time()
+        with self._lock:
+            seen = self._pending.get(session_id)
+            if seen is None:
+                self._pending[session_id] = [now, now]
+            else:
+                seen[1] = now
+
+    def flush(self) -> int:
+        """Upsert everything seen since the last flush in one transaction; returns rows written"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        rows = [(session_id, self._timestamp(first), self._timestamp(last))
+                for session_id, (first, last) in pending.items()]
+        started = time.perf_counter()
+        try:
+            self.db.executemany(self.UPSERT_SQL, rows)
+        except sqlite3.Error as e:
+            print(f"Error writing session activity: {e}")
+            # Put the batch back for the next flush without losing newer activity
+            with self._lock:
+                for session_id, (first, last) in pending.items():
+                    seen = self._pending.setdefault(session_id, [first, last])
+                    seen[0] = min(seen[0], first)
+            return 0
+        self.flushes += 1
+        self.rows_flushed += len(rows)
+        self.last_flush_ms = (time.perf_counter() - started) * 1000
+        return len(rows)
+
+    def refresh_counts(self):
+        """Recount total and recently active sessions from the table"""
+        now = time.time()
+        counts = {'total': self.db.query_one('SELECT COUNT(*) FROM sessions')[0]}
+        for window, seconds in self.ACTIVE_WINDOWS.items():
+            counts[window] = self.db.query_one(
+                'SELECT COUNT(*) FROM sessions WHERE last_active >= ?', (self._timestamp(now - seconds),)
+            )[0]
+        self._counts = counts
+
+    def _run(self):
+        # Count once at startup, then after every flush
+        while True:
+            try:
+                self.flush()
+                self.refresh_counts()
+            except Exception as e:
+                print(f"Error tracking sessions: {e}")
+            if self._stop.wait(self.flush_interval):
+                return
+
+    def close(self):
+        """Stop the flush thread and write what is still pending"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        self.flush()
+
+    def stats(self) -> Dict:
+        """Session counts as of the last flush, for the health endpoint"""
+        with self._lock:
+            pending = len(self._pending)
+        counts = self._counts
+        return {
+            'total': counts.get('total'),
+            'active': {window: counts.get(window) for window in self.ACTIVE_WINDOWS},
+            'pending': pending,
+            'flushes': self.flushes,
+            'rows_flushed': self.rows_flushed,
+            'last_flush_ms': round(self.last_flush_ms, 3)
+        }
+
+# Conversation retention
+class ConversationArchive:
+    """Old conversation rows as gzip NDJSON segments under ARCHIVE_DIR/YYYY/MM/DD, indexed in SQLite
+
+    archive_segments lists the segment files and archive_sessions records which sessions each one
+    holds, so reading a session's archived history only opens the segments it appears in.
+    """
+
+    FIELDS = ('id', 'session_id', 'question', 'answer', 'subject', 'confidence', 'created_at')
+
+    def __init__(self, db: Database, root: str):
+        self.db = db
+        self.root = root
+
+    def write_segments(self, rows: List[sqlite3.Row]) -> List[Dict]:
+        """Write id-ordered rows to one segment per day; index the result with add_segments()"""
+        days: Dict[str, List[sqlite3.Row]] = {}
+        for row in rows:
+            days.setdefault(row['created_at'][:10], []).append(row)
+
+        segments = []
+        for day, day_rows in days.items():
+            first_id, last_id = day_rows[0]['id'], day_rows[-1]['id']
+            relative = f"{day[:4]}/{day[5:7]}/{day[8:10]}/conversations-{first_id}-{last_id}.ndjson.gz"
+            path = os.path.join(self.root, relative)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write aside and rename, so a segment is either complete or absent
+            temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(temp_path, 'wb') as raw:
+                with gzip.GzipFile(fileobj=raw, mode='wb', mtime=0) as f:
+                    for row in day_rows:
+                        f.write(json.dumps({field: row[field] for field in self.FIELDS}).encode('utf-8') + b'\n')
+                raw.flush()
+                os.fsync(raw.fileno())
+            os.replace(temp_path, path)
+
+            sessions: Dict[str, tuple] = {}
+            for row in day_rows:
+                first, last, count = sessions.get(row['session_id'], (row['created_at'], row['created_at'], 0))
+                sessions[row['session_id']] = (min(first, row['created_at']), max(last, row['created_at']), count + 1)
+            segments.append({
+                'path': relative, 'day': day, 'first_id': first_id, 'last_id': last_id,
+                'rows': len(day_rows), 'bytes': os.path.getsize(path), 'sessions': sessions
+            })
+        return segments
+
+    @staticmethod
+    def add_segments(conn: sqlite3.Connection, segments: List[Dict]):
+        """Index written segments inside the caller's transaction"""
+        for segment in segments:
+            segment_id = conn.execute('''
+                INSERT INTO archive_segments (path, day, first_id, last_id, rows, bytes)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (segment['path'], segment['day'], segment['first_id'], segment['last_id'],
+                  segment['rows'], segment['bytes'])).lastrowid
+            conn.executemany('''
+                INSERT INTO archive_sessions (session_id, segment_id, first_created, last_created, rows)
+                VALUES (?, ?, ?, ?, ?)
+            ''', [(session_id, segment_id, first, last, count)
+                  for session_id, (first, last, count) in segment['sessions'].items()])
+
+    def read_segment(self, path: str):
+        """Yield the rows of one segment as dicts"""
+        with gzip.open(os.path.join(self.root, path), 'rt', encoding='utf-8') as f:
+            for line in f:
+                yield json.loads(line)
+
+    def history(self, session_id: str, limit: int, before: Optional[tuple] = None,
+                after: Optional[tuple] = None) -> List[Dict]:
+        """Newest `limit` archived rows of a session strictly between the after/before positions"""
+        query = '''
+            SELECT s.path, a.last_created
+            FROM archive_sessions a
+            JOIN archive_segments s ON s.id = a.segment_id
+            WHERE a.session_id = ?
+        '''
+        params: List = [session_id]
+        if before is not None:
+            query += ' AND a.first_created <= ?'
+            params.append(before[0])
+        if after is not None:
+            query += ' AND a.last_created >= ?'
+            params.append(after[0])
+        query += ' ORDER BY a.last_created DESC'
+
+        def newest_first(records):
+            return sorted(records, key=lambda r: (r['created_at'], r['id']), reverse=True)
+
+        found: Dict[int, Dict] = {}
+        for segment in self.db.query(query, params):
+            # Segments come newest first; stop once none can hold a row newer than what we have
+            if len(found) >= limit and segment['last_created'] < newest_first(found.values())[limit - 1]['created_at']:
+                break
+            for record in self.read_segment(segment['path']):
+                if record.pop('session_id') != session_id:
+                    continue
+                position = (record['created_at'], record['id'])
+                if before is not None and position >= tuple(before):
+                    continue
+                if after is not None and position <= tuple(after):
+                    continue
+                found[record['id']] = record
+        return newest_first(found.values())[:limit]
+
+    def export(self, session_id: Optional[str] = None, subject: Optional[str] = None,
+               start: Optional[str] = None, end: Optional[str] = None):
+        """Yield archived rows matching the export filters, one segment at a time in id order"""
+        query = 'SELECT s.path FROM archive_segments s'
+        params: List = []
+        if session_id is not None:
+            query += ' JOIN archive_sessions a ON a.segment_id = s.id AND a.session_id = ?'
+            params.append(session_id)
+        query += ' WHERE 1 = 1'
+        if start is not None:
+            query += ' AND s.day >= ?'
+            params.append(start[:10])
+        if end is not None:
+            query += ' AND s.day <= ?'
+            params.append(end[:10])
+        query += ' ORDER BY s.first_id'
+        for segment in self.db.query(query, params):
+            for record in self.read_segment(segment['path']):
+                if session_id is not None and record['session_id'] != session_id:
+                    continue
+                if subject is not None and record['subject'] != subject:
+                    continue
+                if start is not None and record['created_at'] < start:
+                    continue
+                if end is not None and record['created_at'] >= end:
+                    continue
+                yield record
+
+class RetentionJob:
+    """Moves conversations older than max_age_days into the archive, a bounded chunk per transaction"""
+
+    def __init__(self, db: Database, archive: ConversationArchive, max_age_days: float,
+                 batch_size: int = 2000, vacuum_pages: int = 1000, pause: float = 0.05):
+        self.db = db
+        self.archive = archive
+        self.max_age_days = max_age_days
+        self.batch_size = batch_size
+        self.vacuum_pages = vacuum_pages
+        self.pause = pause
+        self.runs = 0
+        self.rows_archived = 0
+        self.segments_written = 0
+        self.pages_vacuumed = 0
+        self.last_run: Optional[str] = None
+        self.last_duration_ms = 0.0
+        self._stop = threading.Event()
+        self._run_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def run_once(self) -> Dict:
+        """Archive every expired row, then hand freed pages back; returns this run's counts"""
+        with self._run_lock:
+            started = time.perf_counter()
+            cutoff = (datetime.now(timezone.utc) - timedelta(days=self.max_age_days)).strftime('%Y-%m-%d %H:%M:%S')
+            rows_archived = segments_written = 0
+            while not self._stop.is_set():
+                # Rows are inserted in time order, so the oldest sit at the front of the rowid scan
+                rows = self.db.query('''
+                    SELECT id, session_id, question, answer, subject, confidence, created_at
+                    FROM conversations
+                    WHERE created_at < ?
+                    ORDER BY id LIMIT ?
+                ''', (cutoff, self.batch_size))
+                if not rows:
+                    break
+
+                # Compress outside the transaction; only the index rows and deletes hold the write lock
+                segments = self.archive.write_segments(rows)
+                try:
+                    with self.db.transaction() as conn:
+                        self.archive.add_segments(conn, segments)
+                        conn.executemany('DELETE FROM conversations WHERE id = ?', [(row['id'],) for row in rows])
+                except sqlite3.IntegrityError:
+                    print("Another worker is archiving conversations; leaving the rest to it")
+                    break
+                rows_archived += len(rows)
+                segments_written += len(segments)
+                # Give the conversation writer a turn between chunks
+                self._stop.wait(self.pause)
+
+            pages = self.vacuum()
+            self.runs += 1
+            self.rows_archived += rows_archived
+            self.segments_written += segments_written
+            self.pages_vacuumed += pages
+            self.last_run = datetime.now().isoformat()
+            self.last_duration_ms = (time.perf_counter() - started) * 1000
+            return {'cutoff': cutoff, 'rows_archived': rows_archived,
+                    'segments_written': segments_written, 'pages_vacuumed': pages}
+
+    def vacuum(self) -> int:
+        """Return free pages to the filesystem a few at a time; a no-op unless auto_vacuum is INCREMENTAL"""
+        with self.db.connection() as conn:
+            if conn.execute('PRAGMA auto_vacuum').fetchone()[0] != 2:
+                return 0
+        freed = 0
+        while not self._stop.is_set():
+            with self.db.connection() as conn:
+                free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+                if not free_pages:
+                    conn.execute('PRAGMA wal_checkpoint(PASSIVE)').fetchall()
+                    break
+                # execute() would step the pragma once and free a single page; executescript() runs it out
+                conn.executescript(f'PRAGMA incremental_vacuum({int(self.vacuum_pages)})')
+                step = free_pages - conn.execute('PRAGMA freelist_count').fetchone()[0]
+            if step <= 0:
+                break
+            freed += step
+            self._stop.wait(self.pause)
+        return freed
+
+    def start(self, interval: float):
+        """Run in a background thread shortly after startup and then every `interval` seconds"""
+        def run():
+            delay = min(interval, 60.0)
+            while not self._stop.wait(delay):
+                try:
+                    self.run_once()
+                except Exception as e:
+                    print(f"Error archiving conversations: {e}")
+                delay = interval
+        self._thread = threading.Thread(target=run, name='conversation-retention', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def stats(self) -> Dict:
+        """Archive progress for the health endpoint"""
+        return {
+            'max_age_days': self.max_age_days,
+            'runs': self.runs,
+            'rows_archived': self.rows_archived,
+            'segments_written': self.segments_written,
+            'pages_vacuumed': self.pages_vacuumed,
+            'last_run': self.last_run,
+            'last_duration_ms': round(self.last_duration_ms, 1)
+        }
+
+# Answer cache
+class AnswerCache:
+    """Two-tier answer cache: in-process LRU with TTL in front of the answer_cache table"""
+
+    _whitespace = re.compile(r'\s+')
+    _trailing_punctuation = re.compile(r'[\s?!.]+$')
+
+    def __init__(self, db: Database, max_entries: int = 2048, ttl: int = 7 * 24 * 3600,
+                 purge_interval: float = 3600):
+        self.db = db
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._entries: 'OrderedDict[str, tuple]' = OrderedDict()
+        self._lock = threading.Lock()
+        self._next_purge = 0.0
+        self.hits = 0
+        self.misses = 0
+        self.db_hits = 0
+        self.purged = 0
+
+    @classmethod
+    def normalize_question(cls, question: str) -> str:
+        """Lowercase, collapse whitespace and drop trailing punctuation"""
+        normalized = cls._whitespace.sub(' ', question.strip().lower())
+        return cls._trailing_punctuation.sub('', normalized)
+
+    def make_key(self, question: str, subject: str, model: str, prompt_version: str) -> str:
+        """Build the cache key from the normalized question, subject, model and prompt version"""
+        raw = '\x1f'.join((self.normalize_question(question), subject, model, prompt_version))
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict]:
+        """Return a cached response, checking memory first and SQLite second"""
+        response = self.get_memory(key)
+        return response if response is not None else self.get_stored(key)
+
+    async def get_async(self, key: str) -> Optional[Dict]:
+        """get() for coroutines: the SQLite tier runs in a worker thread so the event loop keeps going"""
+        response = self.get_memory(key)
+        return response if response is not None else await asyncio.to_thread(self.get_stored, key)
+
+    def get_memory(self, key: str) -> Optional[Dict]:
+        """Return a response from the in-process tier only; a miss here is not counted"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                response, _subject, expires_at = entry
+                if expires_at > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return dict(response)
+                del self._entries[key]
+        return None
+
+    def get_stored(self, key: str) -> Optional[Dict]:
+        """Return a response from the answer_cache table, promoting it into memory"""
+        now = time.time()
+        row = self.db.query_one(
+            'SELECT subject, response, expires_at FROM answer_cache WHERE cache_key = ?',
+            (key,)
+        )
+        
+        if row is None or row[2] <= now:
+            with self._lock:
+                self.misses += 1
+            return None
+        
+        response = json.loads(row[1])
+        with self._lock:
+            self.hits += 1
+            self.db_hits += 1
+            self._remember(key, row[0], response, row[2])
+        return dict(response)
+
+    def set(self, key: str, subject: str, model: str, prompt_version: str, response: Dict):
+        """Store a response in both tiers"""
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, subject, response, expires_at)
+        self._store(key, subject, model, prompt_version, response, expires_at)
+
+    async def set_async(self, key: str, subject: str, model: str, prompt_version: str, response: Dict):
+        """set() for coroutines: memory is updated at once, the SQLite write runs in a worker thread"""
+        expires_at = time.time() + self.ttl
+        with self._lock:
+            self._remember(key, subject, response, expires_at)
+        await asyncio.to_thread(self._store, key, subject, model, prompt_version, response, expires_at)
+
+    def _store(self, key: str, subject: str, model: str, prompt_version: str, response: Dict,
+               expires_at: float):
+        self.db.execute('''
+            INSERT OR REPLACE INTO answer_cache (cache_key, subject, model, prompt_version, response, expires_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        ''', (key, subject, model, prompt_version, json.dumps(response), expires_at))
+        # Expired rows are never read again; sweep them out at most once per purge_interval
+        if time.time() >= self._next_purge:
+            self.purge_expired()
+
+    def purge_expired(self) -> int:
+        """Delete answer_cache rows whose expires_at has passed; returns the number removed"""
+        now = time.time()
+        with self._lock:
+            if now < self._next_purge:
+                return 0
+            self._next_purge = now + self.purge_interval
+        try:
+            removed = self.db.execute('DELETE FROM answer_cache WHERE expires_at <= ?', (now,)).rowcount
+        except sqlite3.Error as e:
+            print(f"Error purging expired answers: {e}")
+            return 0
+        with self._lock:
+            self.purged += removed
+        return removed
+
+    def _remember(self, key: str, subject: str, response: Dict, expires_at: float):
+        self._entries[key] = (dict(response), subject, expires_at)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, subject: Optional[str] = None, keep_prompt_version: Optional[str] = None) -> int:
+        """Drop cached answers for one subject (or all), optionally keeping the current prompt version"""
+        with self._lock:
+            if subject is None:
+                self._entries.clear()
+            else:
+                for key in [k for k, v in self._entries.items() if v[1] == subject]:
+                    del self._entries[key]
+        
+        query = 'DELETE FROM answer_cache WHERE 1 = 1'
+        params: List = []
+        if subject is not None:
+            query += ' AND subject = ?'
+            params.append(subject)
+        if keep_prompt_version is not None:
+            query += ' AND prompt_version != ?'
+            params.append(keep_prompt_version)
+        
+        return self.db.execute(query, params).rowcount
+
+    def stats(self) -> Dict:
+        """Hit/miss counters for the health endpoint"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'db_hits': self.db_hits,
+                'misses': self.misses,
+                'purged': self.purged,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0
+            }
+
+# Upstream HTTP client
+class UpstreamClient:
+    """Pooled async HTTP client running on a long-lived background event loop"""
+
+    def __init__(self, base_url: str, api_key: str, max_concurrency: int = 32,
+                 timeout: float = 30.0, connect_timeout: float = 5.0,
+                 max_connections: int = 64, keepalive_connections: int = 32):
+        self.base_url = base_url.rstrip('/')
+        self.api_key = api_key
+        self.max_concurrency = max_concurrency
+        self.timeout = httpx.Timeout(timeout, connect=connect_timeout)
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=keepalive_connections
+        )
+        self._client: Optional['httpx.AsyncClient'] = None
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+
+    @property
+    def loop(self) -> 'asyncio.AbstractEventLoop':
+        """Event loop shared by all upstream calls, started on first use"""
+        if self._loop is None:
+            with self._lock:
+                if self._loop is None:
+                    loop = asyncio.new_event_loop()
+                    thread = threading.Thread(target=loop.run_forever, name='upstream-loop', daemon=True)
+                    thread.start()
+                    self._thread = thread
+                    self._loop = loop
+        return self._loop
+
+    def run(self, coro, timeout: Optional[float] = None):
+        """Run a coroutine on the shared loop from synchronous code and wait for its result"""
+        return asyncio.run_coroutine_threadsafe(tracer.bind(coro), self.loop).result(timeout)
+
+    def _ensure_client(self) -> 'httpx.AsyncClient':
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.base_url,
+                headers={
+                    "Authorization": f"Bearer {self.api_key}",
+                    "Content-Type": "application/json"
+                },
+                timeout=self.timeout,
+                limits=self.limits
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    async def post_json(self, path: str, payload: Dict, timeout: Optional[float] = None) -> 'httpx.Response':
+        """POST a JSON payload upstream, bounded by the concurrency cap"""
+        client = self._ensure_client()
+        request_timeout = httpx.Timeout(timeout, connect=self.timeout.connect) if timeout else self.timeout
+        async with self._semaphore:
+            return await client.post(path, json=payload, timeout=request_timeout)
+
+    async def stream_lines(self, path: str, payload: Dict, timeout: Optional[float] = None):
+        """POST a JSON payload upstream and yield the response body line by line"""
+        client = self._ensure_client()
+        request_timeout = httpx.Timeout(timeout, connect=self.timeout.connect) if timeout else self.timeout
+        async with self._semaphore:
+            async with client.stream('POST', path, json=payload, timeout=request_timeout) as response:
+                if response.status_code != 200:
+                    raise UpstreamStatusError(response.status_code)
+                async for line in response.aiter_lines():
+                    yield line
+
+    def iterate(self, agen):
+        """Consume an async generator on the shared loop as a synchronous iterator"""
+        events: queue.Queue = queue.Queue()
+
+        async def pump():
+            try:
+                async for item in agen:
+                    events.put((True, item))
+            except Exception as e:
+                events.put((False, e))
+            finally:
+                events.put((False, None))
+
+        future = asyncio.run_coroutine_threadsafe(tracer.bind(pump()), self.loop)
+        try:
+            while True:
+                ok, item = events.get()
+                if ok:
+                    yield item
+                elif item is None:
+                    return
+                else:
+                    raise item
+        finally:
+            future.cancel()
+
+    def attach(self, loop: 'asyncio.AbstractEventLoop'):
+        """Run upstream calls on an already running loop (the ASGI server's) instead of a private thread"""
+        with self._lock:
+            if self._loop is not None and self._loop is not loop:
+                raise RuntimeError('Upstream client is already bound to another event loop')
+            self._loop = loop
+
+    async def aclose(self):
+        """Close pooled connections from inside the loop that owns them"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def close(self):
+        """Close pooled connections and stop the background loop"""
+        if self._loop is None or self._thread is None:
+            return
+        if self._client is not None:
+            self.run(self._client.aclose())
+            self._client = None
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout=5)
+        if not self._thread.is_alive():
+            # Also shuts down the loop's default executor used by asyncio.to_thread
+            self._loop.close()
+        self._loop = None
+        self._thread = None
+
+# Upstream resilience
+class UpstreamUnavailable(Exception):
+    """Raised instead of calling upstream while the circuit breaker is open"""
+
+class UpstreamStatusError(Exception):
+    """Upstream answered a streamed request with a non-200 status"""
+
+    def __init__(self, status_code: int):
+        super().__init__(f"API request failed with status {status_code}")
+        self.status_code = status_code
+
+class CircuitBreaker:
+    """Closed/open/half-open breaker with a timeout derived from recent p95 latency"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int = 5, recovery_time: float = 30.0,
+                 min_timeout: float = 3.0, max_timeout: float = 30.0,
+                 latency_multiplier: float = 3.0, window: int = 200, min_samples: int = 20):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.latency_multiplier = latency_multiplier
+        self.min_samples = min_samples
+        self.state = self.CLOSED
+        self.consecutive_failures = 0
+        self.times_opened = 0
+        self.rejected = 0
+        self._opened_at = 0.0
+        self._probe_started: Optional[float] = None
+        self._latencies: deque = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        """Whether a call may go upstream now; in half-open state only one probe is let through"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == self.OPEN and now - self._opened_at >= self.recovery_time:
+                self.state = self.HALF_OPEN
+                self._probe_started = None
+            if self.state == self.HALF_OPEN:
+                # A probe that never reported back (e.g. a dropped stream) must not wedge the breaker
+                if self._probe_started is None or now - self._probe_started >= self.recovery_time:
+                    self._probe_started = now
+                    return True
+            if self.state == self.CLOSED:
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self, latency: Optional[float] = None):
+        with self._lock:
+            if latency is not None:
+                self._latencies.append(latency)
+            self.consecutive_failures = 0
+            self.state = self.CLOSED
+            self._probe_started = None
+
+    @staticmethod
+    def is_failure(status_code: Optional[int]) -> bool:
+        """Whether an upstream outcome counts against the breaker; None is a transport error.
+        4xx responses other than 429 are the request's fault, not an outage."""
+        return status_code is None or status_code >= 500 or status_code == 429
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == self.HALF_OPEN or self.consecutive_failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    self.times_opened += 1
+                self.state = self.OPEN
+                self._opened_at = time.monotonic()
+                self._probe_started = None
+
+    def _p95(self) -> Optional[float]:
+        if len(self._latencies) < self.min_samples:
+            return None
+        ordered = sorted(self._latencies)
+        return ordered[int(0.95 * (len(ordered) - 1))]
+
+    def timeout(self) -> float:
+        """Per-request timeout: a multiple of recent p95 latency, clamped to [min, max]"""
+        with self._lock:
+            p95 = self._p95()
+        if p95 is None:
+            return self.max_timeout
+        return min(self.max_timeout, max(self.min_timeout, p95 * self.latency_multiplier))
+
+    def stats(self) -> Dict:
+        """Breaker state for the health endpoint"""
+        with self._lock:
+            p95 = self._p95()
+            state = self.state
+            if state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_time:
+                state = self.HALF_OPEN
+            stats = {
+                'state': state,
+                'consecutive_failures': self.consecutive_failures,
+                'times_opened': self.times_opened,
+                'rejected': self.rejected,
+                'p95_latency_ms': round(p95 * 1000, 1) if p95 is not None else None
+            }
+        stats['timeout_s'] = round(self.timeout(), 3)
+        return stats
+
+class RetryBudget:
+    """Caps retries at a fraction of recent requests so retries cannot amplify an outage"""
+
+    def __init__(self, ratio: float = 0.1, max_tokens: float = 10.0):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self.retries = 0
+        self._lock = threading.Lock()
+
+    def deposit(self):
+        """Every first attempt earns a fraction of a retry"""
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self) -> bool:
+        """Spend one retry if the budget allows it"""
+        with self._lock:
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            self.retries += 1
+            return True
+
+# Admission control
+class Overloaded(Exception):
+    """A request turned away before reaching the AI service; sent as 429/503 with Retry-After"""
+
+    def __init__(self, status: int, message: str, retry_after: float, reason: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.retry_after = retry_after
+        self.reason = reason
+        metrics.inc('requests_shed_total', (('reason', reason),))
+
+    @property
+    def retry_after_header(self) -> str:
+        return str(max(1, math.ceil(self.retry_after)))
+
+class RateLimiter:
+    """Token buckets per session and per client IP, in memory or shared by workers through SQLite"""
+
+    PRUNE_INTERVAL = 60.0
+
+    def __init__(self, session_rate: float, session_burst: float, ip_rate: float, ip_burst: float,
+                 db: Optional['Database'] = None, max_keys: int = 100000):
+        # Rates are tokens per second; a rate of 0 disables that bucket
+        self.limits = {'session': (session_rate, session_burst), 'ip': (ip_rate, ip_burst)}
+        self.db = db
+        self.max_keys = max_keys
+        # A bucket untouched this long is full again, so forgetting it changes nothing
+        self.idle_after = max((burst / rate for rate, burst in self.limits.values() if rate > 0), default=0.0)
+        self._buckets: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._last_prune = 0.0
+
+    @property
+    def shared(self) -> bool:
+        return self.db is not None
+
+    def check(self, session_id: Optional[str], client_ip: Optional[str], cost: float = 1.0):
+        """Take `cost` tokens from the session and IP buckets, or raise Overloaded(429) taking none"""
+        buckets = []
+        for kind, value in (('session', session_id), ('ip', client_ip)):
+            rate, burst = self.limits[kind]
+            if rate > 0 and value:
+                buckets.append((f'{kind}:{value}', rate, burst))
+        if not buckets:
+            return
+        # A request bigger than a full bucket (a large batch) empties it rather than never fitting
+        cost = min(cost, min(burst for _, _, burst in buckets))
+        wait = self._take_shared(buckets, cost) if self.shared else self._take_local(buckets, cost)
+        if wait > 0:
+            raise Overloaded(429, 'Too many questions; please slow down', wait, 'rate_limited')
+
+    @staticmethod
+    def _plan(buckets: List[tuple], states: Dict, cost: float, now: float) -> tuple:
+        """(seconds until every bucket holds `cost` tokens, [(key, tokens left after taking)])"""
+        wait, levels = 0.0, []
+        for key, rate, burst in buckets:
+            tokens, updated = states.get(key, (burst, now))
+            tokens = min(burst, tokens + max(0.0, now - updated) * rate)
+            wait = max(wait, (cost - tokens) / rate)
+            levels.append((key, tokens - cost))
+        return wait, levels
+
+    def _take_local(self, buckets: List[tuple], cost: float) -> float:
+        now = time.monotonic()
+        with self._lock:
+            wait, levels = self._plan(buckets, self._buckets, cost, now)
+            if wait > 0:
+                return wait
+            for key, tokens in levels:
+                self._buckets[key] = (tokens, now)
+                self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return 0.0
+
+    def _take_shared(self, buckets: List[tuple], cost: float) -> float:
+        # Wall-clock time, since every worker process reads the same rows
+        now = time.time()
+        keys = [key for key, _, _ in buckets]
+        with self.db.transaction() as conn:
+            states = {row['key']: (row['tokens'], row['updated']) for row in conn.execute(
+                f"SELECT key, tokens, updated FROM rate_limits WHERE key IN ({', '.join('?' * len(keys))})", keys
+            )}
+            wait, levels = self._plan(buckets, states, cost, now)
+            if wait > 0:
+                return wait
+            conn.executemany('''
+                INSERT INTO rate_limits (key, tokens, updated) VALUES (?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET tokens = excluded.tokens, updated = excluded.updated
+            ''', [(key, tokens, now) for key, tokens in levels])
+            if now - self._last_prune >= self.PRUNE_INTERVAL:
+                self._last_prune = now
+                conn.execute('DELETE FROM rate_limits WHERE updated < ?', (now - self.idle_after,))
+        return 0.0
+
+class AdmissionSlot:
+    """One request's claim on an AdmissionController slot; release() is safe to call twice"""
+
+    def __init__(self, controller: 'AdmissionController', wake=None):
+        self.controller = controller
+        self.wake = wake
+        self.granted = False
+        self.acquired_at = 0.0
+        self.released = False
+
+    def release(self):
+        if self.granted and not self.released:
+            self.released = True
+            self.controller._release(self)
+
+class AdmissionController:
+    """Caps in-flight upstream-bound requests; the rest wait in a bounded FIFO queue or are shed
+
+    A request is shed with 503 up front when the queue is full, or when the wait it would face
+    (its queue position times the recent average slot hold time, spread over the slots) is over
+    the latency target. A queued request still without a slot at the target gives up the same way.
+    """
+
+    def __init__(self, max_concurrent: int = 64, max_queue: int = 256, target_wait: float = 5.0):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.target_wait = target_wait
+        self.active = 0
+        self.admitted = 0
+        self._hold_time: Optional[float] = None
+        self._waiters: deque = deque()
+        self._lock = threading.Lock()
+
+    def _estimated_wait(self, position: int) -> float:
+        if self._hold_time is None:
+            return 0.0
+        return position * self._hold_time / self.max_concurrent
+
+    def _grant(self, slot: AdmissionSlot):
+        slot.granted = True
+        slot.acquired_at = time.monotonic()
+        self.admitted += 1
+
+    def _admit_or_queue(self, slot: AdmissionSlot) -> bool:
+        """Under the lock: take a free slot, or queue for one, or raise Overloaded(503)"""
+        if self.active < self.max_concurrent and not self._waiters:
+            self.active += 1
+            self._grant(slot)
+            return True
+        estimate = self._estimated_wait(len(self._waiters) + 1)
+        if len(self._waiters) >= self.max_queue:
+            raise Overloaded(503, 'Server is busy; please try again shortly', estimate, 'queue_full')
+        if estimate > self.target_wait:
+            raise Overloaded(503, 'Server is busy; please try again shortly', estimate, 'over_target')
+        self._waiters.append(slot)
+        return False
+
+    def _finish_wait(self, slot: AdmissionSlot, started: float) -> AdmissionSlot:
+        with self._lock:
+            if not slot.granted:
+                self._waiters.remove(slot)
+                raise Overloaded(503, 'Server is busy; please try again shortly',
+                                 self._estimated_wait(len(self._waiters) + 1), 'timeout')
+        metrics.observe('admission_wait_seconds', time.monotonic() - started)
+        return slot
+
+    def _abandon(self, slot: AdmissionSlot):
+        """The waiting request went away: leave the queue, or hand on a slot granted meanwhile"""
+        with self._lock:
+            if not slot.granted:
+                self._waiters.remove(slot)
+        slot.release()
+
+    def acquire(self) -> AdmissionSlot:
+        """Take a slot, waiting in the queue for up to target_wait; raises Overloaded"""
+        granted = threading.Event()
+        slot = AdmissionSlot(self, granted.set)
+        started = time.monotonic()
+        with self._lock:
+            if self._admit_or_queue(slot):
+                return slot
+        granted.wait(self.target_wait)
+        return self._finish_wait(slot, started)
+
+    async def acquire_async(self) -> AdmissionSlot:
+        """acquire() for ASGI handlers: the queued request waits on the event loop, not a thread"""
+        loop = asyncio.get_running_loop()
+        granted = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: granted.done() or granted.set_result(True))
+
+        slot = AdmissionSlot(self, wake)
+        started = time.monotonic()
+        with self._lock:
+            if self._admit_or_queue(slot):
+                return slot
+        try:
+            await asyncio.wait_for(granted, self.target_wait)
+        except asyncio.TimeoutError:
+            pass
+        except BaseException:
+            self._abandon(slot)
+            raise
+        return self._finish_wait(slot, started)
+
+    def _release(self, slot: AdmissionSlot):
+        held = time.monotonic() - slot.acquired_at
+        wake = None
+        with self._lock:
+            self._hold_time = held if self._hold_time is None else 0.8 * self._hold_time + 0.2 * held
+            if self._waiters:
+                # Hand the slot straight to the oldest waiter so nobody can jump the queue
+                waiter = self._waiters.popleft()
+                self._grant(waiter)
+                wake = waiter.wake
+            else:
+                self.active -= 1
+        if wake is not None:
+            wake()
+
+    def stats(self) -> Dict:
+        """Slot usage for the health endpoint"""
+        with self._lock:
+            return {
+                'active': self.active,
+                'waiting': len(self._waiters),
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                'admitted': self.admitted,
+                'avg_hold_ms': round(self._hold_time * 1000, 1) if self._hold_time is not None else None,
+                'estimated_wait_ms': round(self._estimated_wait(len(self._waiters) + 1) * 1000, 1)
+            }
+
+# Local similarity index
+class SimilarityIndex:
+    """MinHash signatures of answered questions per subject, persisted as memory-mapped arrays"""
+
+    NUM_PERM = 64
+    _PRIME = (1 << 31) - 1
+    # Only real upstream answers are indexed; retrieved answers are stored below this
+    MIN_CONFIDENCE = 0.85
+    RETRIEVED_CONFIDENCE = 0.8
+
+    def __init__(self, db: Database, index_dir: str, threshold: float = 0.85,
+                 fallback_threshold: float = 0.5, compact_after: int = 10000):
+        self.db = db
+        self.index_dir = index_dir
+        self.threshold = threshold
+        self.fallback_threshold = fallback_threshold
+        self.compact_after = compact_after
+        os.makedirs(index_dir, exist_ok=True)
+        
+        # Stable hash permutations derived from fixed seeds, so files stay valid across restarts
+        seeds = [hashlib.sha256(f"minhash-{i}".encode()).digest() for i in range(self.NUM_PERM)]
+        self._a = np.array([int.from_bytes(d[:4], 'big') % (self._PRIME - 1) + 1 for d in seeds], dtype=np.uint64)
+        self._b = np.array([int.from_bytes(d[4:8], 'big') % self._PRIME for d in seeds], dtype=np.uint64)
+        
+        # subject -> {'base': memmap signatures, 'base_ids', 'tail': [(ids, sigs)], 'tail_sigs', 'tail_ids'}
+        self._partitions: Dict[str, Dict] = {}
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self.last_id = 0
+        self.hits = 0
+        self.lookups = 0
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._load()
+
+    def _paths(self, subject: str) -> tuple:
+        slug = re.sub(r'[^a-z0-9]+', '_', subject.lower()).strip('_') or 'default'
+        return (os.path.join(self.index_dir, f'{slug}.sig'), os.path.join(self.index_dir, f'{slug}.ids'),
+                os.path.join(self.index_dir, f'{slug}.subject'))
+
+    def _disk_rows(self, subject: str) -> int:
+        sig_path, ids_path, _ = self._paths(subject)
+        if not (os.path.exists(sig_path) and os.path.exists(ids_path)):
+            return 0
+        # A crash between the two appends leaves one file longer; ignore the partial row
+        return min(os.path.getsize(sig_path) // (4 * self.NUM_PERM), os.path.getsize(ids_path) // 8)
+
+    def _map_partition(self, subject: str) -> Dict:
+        sig_path, ids_path, _ = self._paths(subject)
+        rows = self._disk_rows(subject)
+        if rows:
+            base = np.memmap(sig_path, dtype=np.uint32, mode='r', shape=(rows, self.NUM_PERM))
+            base_ids = np.memmap(ids_path, dtype=np.int64, mode='r', shape=(rows,))
+        else:
+            base = np.empty((0, self.NUM_PERM), dtype=np.uint32)
+            base_ids = np.empty((0,), dtype=np.int64)
+        return {'base': base, 'base_ids': base_ids, 'tail_sigs': base[:0], 'tail_ids': base_ids[:0], 'tail_rows': 0}
+
+    def _load(self):
+        for name in os.listdir(self.index_dir):
+            if not name.endswith('.subject'):
+                continue
+            with open(os.path.join(self.index_dir, name), encoding='utf-8') as f:
+                subject = f.read()
+            partition = self._map_partition(subject)
+            self._partitions[subject] = partition
+            if len(partition['base_ids']):
+                self.last_id = max(self.last_id, int(partition['base_ids'].max()))
+
+    def signature(self, text: str) -> Optional['np.ndarray']:
+        """MinHash over word unigrams and bigrams of the normalized question"""
+        words = re.findall(r'\w+', AnswerCache.normalize_question(text))
+        shingles = set(words) | {f'{a} {b}' for a, b in zip(words, words[1:])}
+        if not shingles:
+            return None
+        hashes = np.array([zlib.crc32(s.encode('utf-8')) for s in shingles], dtype=np.uint64)
+        permuted = (self._a[:, None] * hashes[None, :] + self._b[:, None]) % self._PRIME
+        return permuted.min(axis=1).astype(np.uint32)
+
+    @contextmanager
+    def _file_lock(self):
+        """Exclusive lock on the index directory, so one worker process appends at a time"""
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.index_dir, '.lock'), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _sync_from_disk(self):
+        """Map rows other processes appended since this one last looked; call with the file lock held"""
+        for name in os.listdir(self.index_dir):
+            if not name.endswith('.subject'):
+                continue
+            with open(os.path.join(self.index_dir, name), encoding='utf-8') as f:
+                subject = f.read()
+            with self._lock:
+                partition = self._partitions.get(subject)
+            known = len(partition['base_ids']) + partition['tail_rows'] if partition else 0
+            if self._disk_rows(subject) == known:
+                continue
+            partition = self._map_partition(subject)
+            with self._lock:
+                self._partitions[subject] = partition
+            # Rows are appended in id order, so the last one is the partition's newest
+            if len(partition['base_ids']):
+                self.last_id = max(self.last_id, int(partition['base_ids'][-1]))
+
+    def refresh(self, batch_size: int = 5000) -> int:
+        """Index conversation rows added since the last refresh by any process; returns rows added"""
+        added = 0
+        with self._refresh_lock, self._file_lock():
+            self._sync_from_disk()
+            while True:
+                rows = self.db.query('''
+                    SELECT id, question, subject FROM conversations
+                    WHERE id > ? AND confidence >= ?
+                    ORDER BY id LIMIT ?
+                ''', (self.last_id, self.MIN_CONFIDENCE, batch_size))
+                if not rows:
+                    return added
+                
+                grouped: Dict[str, tuple] = {}
+                for row in rows:
+                    sig = self.signature(row['question'])
+                    if sig is not None:
+                        ids, sigs = grouped.setdefault(row['subject'] or 'default', ([], []))
+                        ids.append(row['id'])
+                        sigs.append(sig)
+                for subject, (ids, sigs) in grouped.items():
+                    self._append(subject, np.array(ids, dtype=np.int64), np.vstack(sigs))
+                    added += len(ids)
+                self.last_id = rows[-1]['id']
+
+    def _append(self, subject: str, ids: 'np.ndarray', sigs: 'np.ndarray'):
+        sig_path, ids_path, subject_path = self._paths(subject)
+        if not os.path.exists(subject_path):
+            with open(subject_path, 'w', encoding='utf-8') as f:
+                f.write(subject)
+        # Drop a partial row left by a crash so new rows stay aligned across the two files
+        rows = self._disk_rows(subject)
+        for path, row_size in ((sig_path, 4 * self.NUM_PERM), (ids_path, 8)):
+            if os.path.exists(path) and os.path.getsize(path) > rows * row_size:
+                os.truncate(path, rows * row_size)
+        with open(sig_path, 'ab') as f:
+            f.write(sigs.tobytes())
+        with open(ids_path, 'ab') as f:
+            f.write(ids.tobytes())
+        
+        with self._lock:
+            partition = self._partitions.get(subject)
+            if partition is None or partition['tail_rows'] + len(ids) > self.compact_after:
+                # Remap the files, which already hold every appended row
+                self._partitions[subject] = self._map_partition(subject)
+            else:
+                self._partitions[subject] = dict(
+                    partition,
+                    tail_sigs=np.vstack((partition['tail_sigs'], sigs)),
+                    tail_ids=np.concatenate((partition['tail_ids'], ids)),
+                    tail_rows=partition['tail_rows'] + len(ids)
+                )
+
+    def nearest(self, question: str, subject: str, chunk: int = 65536) -> Optional[tuple]:
+        """Return (conversation_id, similarity) of the closest indexed question in the subject"""
+        sig = self.signature(question)
+        with self._lock:
+            partition = self._partitions.get(subject)
+        if sig is None or partition is None:
+            return None
+        
+        best_id, best_score = None, -1
+        for sigs, ids in ((partition['base'], partition['base_ids']), (partition['tail_sigs'], partition['tail_ids'])):
+            for start in range(0, len(ids), chunk):
+                scores = (sigs[start:start + chunk] == sig).sum(axis=1)
+                position = int(scores.argmax())
+                if scores[position] > best_score:
+                    best_id, best_score = int(ids[start + position]), int(scores[position])
+        if best_id is None:
+            return None
+        return best_id, best_score / self.NUM_PERM
+
+    def lookup(self, question: str, subject: str, threshold: float) -> Optional[Dict]:
+        """Return a stored answer whose question is at least `threshold` similar, if any"""
+        with self._lock:
+            self.lookups += 1
+        match = self.nearest(question, subject)
+        if match is None or match[1] < threshold:
+            return None
+        row = self.db.query_one('SELECT question, answer FROM conversations WHERE id = ?', (match[0],))
+        if row is None:
+            return None
+        with self._lock:
+            self.hits += 1
+        return {
+            'answer': row['answer'],
+            'detected_subject': subject if subject != 'default' else None,
+            'confidence': round(self.RETRIEVED_CONFIDENCE * match[1], 4),
+            'similar_question': row['question']
+        }
+
+    def start(self, interval: float):
+        """Refresh the index in a background thread every `interval` seconds"""
+        def run():
+            while not self._stop.is_set():
+                try:
+                    self.refresh()
+                except Exception as e:
+                    print(f"Error refreshing similarity index: {e}")
+                self._stop.wait(interval)
+        self._thread = threading.Thread(target=run, name='similarity-index', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def stats(self) -> Dict:
+        """Index size and hit counters for the health endpoint"""
+        with self._lock:
+            rows = {subject: len(p['base_ids']) + p['tail_rows'] for subject, p in self._partitions.items()}
+            return {'rows': rows, 'last_id': self.last_id, 'lookups': self.lookups, 'hits': self.hits}
+
+# Subject classification
+DEFAULT_SUBJECT_KEYWORDS = {
+    'Mathematics': ['math', 'calculus', 'algebra', 'geometry', 'statistics', 'probability', 'equation', 'formula', 'integral', 'derivative'],
+    'Physics': ['physics', 'force', 'energy', 'motion', 'quantum', 'relativity', 'mechanics', 'wave', 'optics', 'thermodynamics'],
+    'Chemistry': ['chemistry', 'chemical', 'molecule', 'atom', 'reaction', 'compound', 'element', 'bond', 'acid', 'base'],
+    'Computer Science': ['programming', 'code', 'algorithm', 'data structure', 'software', 'computer', 'python', 'java', 'javascript', 'web'],
+    'Engineering': ['engineering', 'civil', 'mechanical', 'electrical', 'chemical engineering', 'software engineering', 'design', 'manufacturing'],
+    'Biology': ['biology', 'cell', 'genetics', 'evolution', 'organism', 'ecosystem', 'physiology', 'anatomy', 'species']
+}
+
+class SubjectClassifier:
+    """Keyword classifier compiled once into a single alternation regex
+
+    Keywords match whole words; multi-word keywords allow any whitespace between their
+    words and score their word count. Longer keywords are tried first, so "chemical
+    engineering" wins over "chemical".
+    """
+
+    def __init__(self, subject_keywords: Dict[str, List[str]]):
+        self.subjects = list(subject_keywords)
+        # normalized keyword -> [(subject, weight)]
+        self._weights: Dict[str, List[tuple]] = {}
+        for subject, keywords in subject_keywords.items():
+            for keyword in keywords:
+                words = keyword.lower().split()
+                if words:
+                    self._weights.setdefault(' '.join(words), []).append((subject, len(words)))
+        alternatives = sorted(self._weights, key=len, reverse=True)
+        self._pattern = re.compile(
+            r'(?<!\w)(?:' + '|'.join(r'\s+'.join(map(re.escape, keyword.split())) for keyword in alternatives) + r')(?!\w)'
+        )
+
+    @classmethod
+    def from_file(cls, path: str) -> 'SubjectClassifier':
+        """Load a {subject: [keywords]} table from a JSON file"""
+        with open(path, encoding='utf-8') as f:
+            return cls(json.load(f))
+
+    def scores(self, text: str) -> Dict[str, int]:
+        """Score every subject in one pass over the text"""
+        scores = dict.fromkeys(self.subjects, 0)
+        for match in self._pattern.finditer(text.lower()):
+            keyword = match.group()
+            matches = self._weights.get(keyword) or self._weights[' '.join(keyword.split())]
+            for subject, weight in matches:
+                scores[subject] += weight
+        return scores
+
+    def classify(self, text: str) -> tuple:
+        """Return (subject, confidence); ('default', 0.0) when nothing matches"""
+        scores = self.scores(text)
+        total = sum(scores.values())
+        if not total:
+            return 'default', 0.0
+        # max() keeps the first subject on ties, preserving table order
+        best = max(self.subjects, key=scores.__getitem__)
+        return best, round(scores[best] / total, 4)
+
+# Prompt assembly
+class PromptBuilder:
+    """Chat messages from precomputed per-subject system prefixes plus a token-budgeted history"""
+
+    GUIDELINES = "Guidelines:\n- Provide comprehensive, accurate answers\n- Include relevant examples and practical applications\n- Explain complex concepts in simple terms\n- When appropriate, mention formulas, equations, or code snippets\n- Structure answers with clear headings and bullet points\n- Be educational and encouraging\n- If the question is unclear, ask for clarification\n- For engineering topics, consider safety and real-world constraints"
+    QUESTION_TEMPLATE = "Question: {question}\n\nPlease provide a detailed, educational answer that helps me understand this concept thoroughly."
+    _token_pattern = re.compile(r'\w+|[^\w\s]')
+
+    def __init__(self, subject_prompts: Optional[Dict[str, str]] = None, token_budget: int = 1200,
+                 summary_tokens: int = 120):
+        self.token_budget = token_budget
+        self.summary_tokens = summary_tokens
+        self.rebuild(subject_prompts or {})
+
+    def rebuild(self, subject_prompts: Dict[str, str]):
+        """Precompute system messages so every request for a subject sends the same bytes"""
+        self._system = {
+            subject: {"role": "system", "content": f"{prompt}\n\n{self.GUIDELINES}"}
+            for subject, prompt in subject_prompts.items()
+        }
+
+    @classmethod
+    def count_tokens(cls, text: str) -> int:
+        """Local token estimate: one per word or symbol, plus one per extra 5 characters of long words"""
+        return sum(1 + len(piece) // 5 for piece in cls._token_pattern.findall(text))
+
+    @classmethod
+    def trim_to_tokens(cls, text: str, tokens: int) -> str:
+        """Cut text down to roughly `tokens` tokens"""
+        used = 0
+        for match in cls._token_pattern.finditer(text):
+            used += 1 + len(match.group(0)) // 5
+            if used > tokens:
+                return text[:match.start()].rstrip() + ' …'
+        return text
+
+    def build(self, question: str, subject: str, history: Optional[List] = None) -> List[Dict]:
+        """Assemble messages; `history` rows (question/answer) are newest first"""
+        system = self._system.get(subject, self._system['default'])
+        
+        budget = self.token_budget
+        kept: List[tuple] = []
+        dropped: List[str] = []
+        for row in history or []:
+            question_cost = self.count_tokens(row['question']) + 4
+            answer_cost = self.count_tokens(row['answer']) + 4
+            if dropped:
+                dropped.append(row['question'])
+            elif question_cost + answer_cost <= budget:
+                kept.append((row['question'], row['answer']))
+                budget -= question_cost + answer_cost
+            elif budget - question_cost >= 50:
+                # Trim the oldest turn that still partly fits rather than dropping it
+                kept.append((row['question'], self.trim_to_tokens(row['answer'], budget - question_cost)))
+                budget = 0
+            else:
+                dropped.append(row['question'])
         
-        conn.commit()
-        conn.close()
+        messages = [system]
+        if dropped:
+            topics = '; '.join(' '.join(q.split()) for q in reversed(dropped))
+            summary = self.trim_to_tokens(f"Earlier in this session the student also asked about: {topics}", self.summary_tokens)
+            messages.append({"role": "system", "content": summary})
+        for past_question, past_answer in reversed(kept):
+            messages.append({"role": "user", "content": past_question})
+            messages.append({"role": "assistant", "content": past_answer})
+        messages.append({"role": "user", "content": self.QUESTION_TEMPLATE.format(question=question)})
+        return messages
 
 # AI Service
 class AIService:
-    def __init__(self, api_key: str, base_url: str):
+    # Bump when the shared Guidelines block or user prompt wording changes
+    PROMPT_VERSION = '1'
+
+    def __init__(self, api_key: str, base_url: str, client: Optional[UpstreamClient] = None,
+                 model: str = 'gpt-3.5-turbo', cache: Optional[AnswerCache] = None,
+                 classifier: Optional[SubjectClassifier] = None,
+                 breaker: Optional[CircuitBreaker] = None,
+                 retry_budget: Optional[RetryBudget] = None,
+                 max_retries: int = 2, retry_base_delay: float = 0.2,
+                 similarity: Optional[SimilarityIndex] = None,
+                 prompt_builder: Optional[PromptBuilder] = None):
         self.api_key = api_key
         self.base_url = base_url
+        self.model = model
+        self.client = client or UpstreamClient(base_url, api_key)
+        self.cache = cache
+        self.classifier = classifier or SubjectClassifier(DEFAULT_SUBJECT_KEYWORDS)
+        self.breaker = breaker or CircuitBreaker()
+        self.retry_budget = retry_budget or RetryBudget()
+        self.max_retries = max_retries
+        self.retry_base_delay = retry_base_delay
+        self.similarity = similarity
+        # Single-flight state, only touched from the upstream event loop
+        self._inflight: Dict[str, asyncio.Task] = {}
+        self.upstream_calls = 0
+        self.coalesced_calls = 0
         self.subject_prompts = {
             'Mathematics': 'You are an expert mathematics tutor. Provide clear, step-by-step mathematical explanations with formulas and examples when applicable.',
             'Physics': 'You are an expert physics tutor. Explain physics concepts with real-world examples, equations, and practical applications.',
@@ -129,83 +2833,269 @@ class AIService:
             'Biology': 'You are an expert biology tutor. Explain biological concepts with examples, processes, and scientific context.',
             'default': 'You are an expert academic tutor specializing in engineering and sciences. Provide comprehensive, educational answers with clear explanations and practical examples.'
         }
+        self.prompts = prompt_builder or PromptBuilder(self.subject_prompts)
+        self.prompts.rebuild(self.subject_prompts)
+    
+    def prompt_version(self, subject: str) -> str:
+        """Version tag for a subject's prompt, changes whenever the prompt text changes"""
+        prompt = self.subject_prompts.get(subject, self.subject_prompts['default'])
+        return f"{self.PROMPT_VERSION}:{hashlib.sha1(prompt.encode('utf-8')).hexdigest()[:12]}"
+    
+    def set_subject_prompt(self, subject: str, prompt: str):
+        """Replace a subject prompt and invalidate answers cached under the old one"""
+        self.subject_prompts[subject] = prompt
+        self.prompts.rebuild(self.subject_prompts)
+        if self.cache is not None:
+            self.cache.invalidate(subject, keep_prompt_version=self.prompt_version(subject))
     
     def detect_subject(self, question: str) -> str:
         """Detect the subject from the question"""
-        lower_question = question.lower()
-        
-        subject_keywords = {
-            'Mathematics': ['math', 'calculus', 'algebra', 'geometry', 'statistics', 'probability', 'equation', 'formula', 'integral', 'derivative'],
-            'Physics': ['physics', 'force', 'energy', 'motion', 'quantum', 'relativity', 'mechanics', 'wave', 'optics', 'thermodynamics'],
-            'Chemistry': ['chemistry', 'chemical', 'molecule', 'atom', 'reaction', 'compound', 'element', 'bond', 'acid', 'base'],
-            'Computer Science': ['programming', 'code', 'algorithm', 'data structure', 'software', 'computer', 'python', 'java', 'javascript', 'web'],
-            'Engineering': ['engineering', 'civil', 'mechanical', 'electrical', 'chemical engineering', 'software engineering', 'design', 'manufacturing'],
-            'Biology': ['biology', 'cell', 'genetics', 'evolution', 'organism', 'ecosystem', 'physiology', 'anatomy', 'species']
+        with tracer.span('detect_subject'), metrics.timer('detect_subject_duration_seconds'):
+            return self.classifier.classify(question)[0]
+    
+    def build_messages(self, question: str, subject: str, history: Optional[List] = None) -> List[Dict]:
+        """Build the chat messages sent upstream; `history` rows are newest first"""
+        return self.prompts.build(question, subject, history)
+    
+    def build_payload(self, messages: List[Dict], stream: bool = False) -> Dict:
+        """Build the /chat/completions request body"""
+        data = {
+            "model": self.model,
+            "messages": messages,
+            "temperature": 0.7,
+            "max_tokens": 1000
         }
+        if stream:
+            data["stream"] = True
+        return data
+    
+    @staticmethod
+    def context_digest(messages: List[Dict]) -> str:
+        """Fingerprint of the conversation context between the system prefix and the question"""
+        context = messages[1:-1]
+        if not context:
+            return ''
+        return hashlib.sha1(json.dumps(context, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    
+    async def _lookup_cache(self, question: str, subject: str, context: str = ''):
+        """Return (cache_key, prompt_version, cached_response) for a question"""
+        if self.cache is None:
+            return None, None, None
+        prompt_version = self.prompt_version(subject)
+        cache_key = self.cache.make_key(question, subject, self.model, f"{prompt_version}:{context}" if context else prompt_version)
+        cached = await self.cache.get_async(cache_key)
+        if cached is not None:
+            cached['cached'] = True
+            metrics.inc('answers_total', (('source', 'cache'),))
+        return cache_key, prompt_version, cached
+    
+    async def _store_cache(self, cache_key: Optional[str], subject: str, prompt_version: Optional[str], ai_response: Dict):
+        if cache_key is not None:
+            await self.cache.set_async(cache_key, subject, self.model, prompt_version, ai_response)
+    
+    async def generate_response(self, question: str, subject: Optional[str] = None,
+                                history: Optional[List] = None) -> Dict:
+        """Generate AI response for the given question; `history` rows are newest first"""
+        detected_subject = subject or self.detect_subject(question)
+        with tracer.span('build_messages'):
+            messages = self.build_messages(question, detected_subject, history)
+            context = self.context_digest(messages)
         
-        for subject, keywords in subject_keywords.items():
-            if any(keyword in lower_question for keyword in keywords):
-                return subject
+        with tracer.span('answer_cache.lookup') as span:
+            cache_key, prompt_version, cached = await self._lookup_cache(question, detected_subject, context)
+            if span is not None:
+                span['attributes']['hit'] = cached is not None
+        if cached is not None:
+            return cached
+        
+        # Coalesce identical questions already waiting on upstream into one call
+        flight_key = f"{AnswerCache.normalize_question(question)}\x1f{detected_subject}\x1f{context}"
+        task = self._inflight.get(flight_key)
+        coalesced = task is not None
+        if coalesced:
+            self.coalesced_calls += 1
+        else:
+            self.upstream_calls += 1
+            task = asyncio.get_running_loop().create_task(
+                self._request_answer(question, detected_subject, messages, cache_key, prompt_version)
+            )
+            self._inflight[flight_key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(flight_key, None))
         
-        return 'default'
+        # Shield so one caller going away does not cancel the shared call
+        with tracer.span('await_answer', coalesced=coalesced):
+            return dict(await asyncio.shield(task))
     
-    async def generate_response(self, question: str, subject: Optional[str] = None) -> Dict:
-        """Generate AI response for the given question"""
+    async def _request_answer(self, question: str, detected_subject: str, messages: List[Dict],
+                              cache_key: Optional[str], prompt_version: Optional[str]) -> Dict:
+        """Call the upstream model once, falling back to stored or canned answers on failure"""
+        # A near-identical standalone question answered before is as good as a fresh completion
+        if self.similarity is not None and len(messages) == 2:
+            with tracer.span('similarity.lookup'):
+                similar = await asyncio.to_thread(
+                    self.similarity.lookup, question, detected_subject, self.similarity.threshold
+                )
+            if similar is not None:
+                metrics.inc('answers_total', (('source', 'similarity'),))
+                return similar
+        
         try:
-            detected_subject = subject or self.detect_subject(question)
-            system_prompt = self.subject_prompts.get(detected_subject, self.subject_prompts['default'])
-            
-            # Prepare the prompt
-            messages = [
-                {
-                    "role": "system",
-                    "content": f"{system_prompt}\n\nGuidelines:\n- Provide comprehensive, accurate answers\n- Include relevant examples and practical applications\n- Explain complex concepts in simple terms\n- When appropriate, mention formulas, equations, or code snippets\n- Structure answers with clear headings and bullet points\n- Be educational and encouraging\n- If the question is unclear, ask for clarification\n- For engineering topics, consider safety and real-world constraints"
-                },
-                {
-                    "role": "user",
-                    "content": f"Question: {question}\n\nPlease provide a detailed, educational answer that helps me understand this concept thoroughly."
-                }
-            ]
+            if not self.breaker.allow_request():
+                raise UpstreamUnavailable("Circuit breaker is open")
             
             # Make API call
-            headers = {
-                "Authorization": f"Bearer {self.api_key}",
-                "Content-Type": "application/json"
-            }
-            
-            data = {
-                "model": "gpt-3.5-turbo",
-                "messages": messages,
-                "temperature": 0.7,
-                "max_tokens": 1000
-            }
-            
-            response = requests.post(
-                f"{self.base_url}/chat/completions",
-                headers=headers,
-                json=data,
-                timeout=30
-            )
+            data = self.build_payload(messages)
+            response = await self._post_with_retries(data)
             
             if response.status_code == 200:
-                result = response.json()
+                with tracer.span('upstream.decode'):
+                    result = response.json()
                 answer = result['choices'][0]['message']['content']
                 
-                return {
+                ai_response = {
                     'answer': answer,
                     'detected_subject': detected_subject if detected_subject != 'default' else None,
                     'confidence': 0.85
                 }
+                await self._store_cache(cache_key, detected_subject, prompt_version, ai_response)
+                metrics.inc('answers_total', (('source', 'upstream'),))
+                return ai_response
             else:
                 raise Exception(f"API request failed with status {response.status_code}")
                 
         except Exception as e:
             # Fallback response if AI fails
-            return {
-                'answer': self.generate_fallback_response(question, detected_subject),
-                'detected_subject': detected_subject if detected_subject != 'default' else None,
-                'confidence': 0.5
-            }
+            return await self._fallback(question, detected_subject)
+    
+    async def _fallback(self, question: str, detected_subject: str) -> Dict:
+        """Closest stored answer if one is similar enough, otherwise the canned study guide"""
+        if self.similarity is not None:
+            similar = await asyncio.to_thread(
+                self.similarity.lookup, question, detected_subject, self.similarity.fallback_threshold
+            )
+            if similar is not None:
+                metrics.inc('answers_total', (('source', 'similarity_fallback'),))
+                return similar
+        metrics.inc('answers_total', (('source', 'fallback'),))
+        return {
+            'answer': self.generate_fallback_response(question, detected_subject),
+            'detected_subject': detected_subject if detected_subject != 'default' else None,
+            'confidence': 0.5
+        }
+    
+    async def _post_with_retries(self, data: Dict) -> 'httpx.Response':
+        """POST upstream with the adaptive timeout, retrying transient failures with full jitter"""
+        self.retry_budget.deposit()
+        attempt = 0
+        while True:
+            started = time.monotonic()
+            try:
+                with tracer.span('upstream.post', attempt=attempt) as span:
+                    response = await self.client.post_json("/chat/completions", data, timeout=self.breaker.timeout())
+                    if span is not None:
+                        span['attributes']['status'] = response.status_code
+            except httpx.TransportError as e:
+                self._record_outcome(None, time.monotonic() - started)
+                error: Exception = e
+            else:
+                if self._record_outcome(response.status_code, time.monotonic() - started):
+                    return response
+                error = Exception(f"API request failed with status {response.status_code}")
+            
+            attempt += 1
+            if (attempt > self.max_retries or not self.breaker.allow_request()
+                    or not self.retry_budget.withdraw()):
+                raise error
+            await asyncio.sleep(random.uniform(0, self.retry_base_delay * 2 ** attempt))
+    
+    def _record_outcome(self, status_code: Optional[int], latency: float) -> bool:
+        """Report one upstream call to the metrics and the breaker; returns False if it was a failure"""
+        metrics.observe('upstream_request_duration_seconds', latency)
+        metrics.inc('upstream_responses_total', (('status', 'error' if status_code is None else str(status_code)),))
+        if self.breaker.is_failure(status_code):
+            self.breaker.record_failure()
+            return False
+        self.breaker.record_success(latency)
+        return True
+    
+    async def generate_batch(self, items: List[tuple], concurrency: int = 8):
+        """Answer (question, subject) pairs concurrently, yielding (index, response, error) as each finishes"""
+        semaphore = asyncio.Semaphore(concurrency)
+        
+        async def answer(index: int, question: str, subject: Optional[str]):
+            async with semaphore:
+                try:
+                    return index, await self.generate_response(question, subject), None
+                except Exception as e:
+                    return index, None, e
+        
+        tasks = [asyncio.ensure_future(answer(i, q, s)) for i, (q, s) in enumerate(items)]
+        try:
+            for finished in asyncio.as_completed(tasks):
+                yield await finished
+        finally:
+            for task in tasks:
+                task.cancel()
+    
+    def coalescing_stats(self) -> Dict:
+        """Single-flight counters for the health endpoint"""
+        return {
+            'upstream_calls': self.upstream_calls,
+            'coalesced_calls': self.coalesced_calls,
+            'in_flight': len(self._inflight)
+        }
+    
+    async def stream_response(self, question: str, subject: Optional[str] = None,
+                              history: Optional[List] = None):
+        """Yield ('token', text) events as the answer arrives, then a final ('done', response) event"""
+        detected_subject = subject or self.detect_subject(question)
+        public_subject = detected_subject if detected_subject != 'default' else None
+        messages = self.build_messages(question, detected_subject, history)
+        
+        cache_key, prompt_version, cached = await self._lookup_cache(question, detected_subject, self.context_digest(messages))
+        if cached is not None:
+            yield 'token', cached['answer']
+            yield 'done', cached
+            return
+        
+        parts: List[str] = []
+        started = time.monotonic()
+        try:
+            if not self.breaker.allow_request():
+                raise UpstreamUnavailable("Circuit breaker is open")
+            
+            data = self.build_payload(messages, stream=True)
+            async for line in self.client.stream_lines("/chat/completions", data, timeout=self.breaker.timeout()):
+                if not line.startswith('data:'):
+                    continue
+                chunk = line[5:].strip()
+                if chunk == '[DONE]':
+                    break
+                delta = json.loads(chunk)['choices'][0].get('delta', {}).get('content')
+                if delta:
+                    parts.append(delta)
+                    yield 'token', delta
+            self._record_outcome(200, time.monotonic() - started)
+        except Exception as e:
+            if isinstance(e, UpstreamStatusError):
+                self._record_outcome(e.status_code, time.monotonic() - started)
+            elif not isinstance(e, UpstreamUnavailable):
+                # Transport errors and malformed chunks alike
+                self._record_outcome(None, time.monotonic() - started)
+            if not parts:
+                # Fallback response if AI fails before the first token
+                fallback = await self._fallback(question, detected_subject)
+                yield 'token', fallback['answer']
+                yield 'done', fallback
+                return
+            print(f"Upstream stream interrupted: {e}")
+            yield 'done', {'answer': ''.join(parts), 'detected_subject': public_subject, 'confidence': 0.5}
+            return
+        
+        ai_response = {'answer': ''.join(parts), 'detected_subject': public_subject, 'confidence': 0.85}
+        metrics.inc('answers_total', (('source', 'upstream'),))
+        await self._store_cache(cache_key, detected_subject, prompt_version, ai_response)
+        yield 'done', ai_response
     
     def generate_fallback_response(self, question: str, subject: str) -> str:
         """Generate a fallback response when AI is unavailable"""
@@ -282,9 +3172,154 @@ Would you like more specific guidance on this topic?"""
         
         return fallback_responses.get(subject, fallback_responses['default'])
 
-# Initialize services
-db = Database(app.config['DATABASE_URL'])
-ai_service = AIService(app.config['AI_API_KEY'], app.config['AI_BASE_URL'])
+# Services
+class Services:
+    """The data layer, upstream client and AI service shared by one app instance"""
+
+    def __init__(self, app: Flask):
+        config = app.config
+        self.app = app
+        self.db = Database(
+            config['DATABASE_URL'],
+            pool_size=config['DB_POOL_SIZE'],
+            busy_timeout_ms=config['DB_BUSY_TIMEOUT_MS'],
+            cache_size_kb=config['DB_CACHE_SIZE_KB'],
+            mmap_size=config['DB_MMAP_SIZE']
+        )
+        if config['AUTO_MIGRATE']:
+            self.db.migrate()
+        elif not self.db.check_schema():
+            print(f"Database schema is older than version {Database.SCHEMA_VERSION}; "
+                  f"run `flask --app ai_study_assistant migrate`")
+        self.resource_catalog = ResourceCatalog(self.db)
+        self.session_tracker = SessionTracker(self.db, flush_interval=config['SESSION_FLUSH_INTERVAL'])
+        self.conversation_archive = ConversationArchive(self.db, config['ARCHIVE_DIR'])
+        self.retention = RetentionJob(
+            self.db,
+            self.conversation_archive,
+            max_age_days=config['RETENTION_DAYS'],
+            batch_size=config['RETENTION_BATCH_SIZE'],
+            vacuum_pages=config['RETENTION_VACUUM_PAGES']
+        )
+        self.conversation_writer = ConversationWriter(
+            self.db,
+            max_queue=config['CONVERSATION_QUEUE_SIZE'],
+            batch_size=config['CONVERSATION_BATCH_SIZE'],
+            flush_interval=config['CONVERSATION_FLUSH_INTERVAL']
+        )
+        self.upstream_client = UpstreamClient(
+            config['AI_BASE_URL'],
+            config['AI_API_KEY'],
+            max_concurrency=config['AI_MAX_CONCURRENCY'],
+            timeout=config['AI_TIMEOUT'],
+            connect_timeout=config['AI_CONNECT_TIMEOUT'],
+            max_connections=config['AI_MAX_CONNECTIONS'],
+            keepalive_connections=config['AI_KEEPALIVE_CONNECTIONS']
+        )
+        self.answer_cache = AnswerCache(
+            self.db,
+            max_entries=config['ANSWER_CACHE_SIZE'],
+            ttl=config['ANSWER_CACHE_TTL']
+        )
+        self.similarity_index = None
+        if config['SIMILARITY_ENABLED'] and np is not None:
+            self.similarity_index = SimilarityIndex(
+                self.db,
+                config['SIMILARITY_INDEX_DIR'],
+                threshold=config['SIMILARITY_THRESHOLD'],
+                fallback_threshold=config['SIMILARITY_FALLBACK_THRESHOLD']
+            )
+        if config['SUBJECT_KEYWORDS_FILE']:
+            subject_classifier = SubjectClassifier.from_file(config['SUBJECT_KEYWORDS_FILE'])
+        else:
+            subject_classifier = SubjectClassifier(DEFAULT_SUBJECT_KEYWORDS)
+        self.ai_service = AIService(
+            config['AI_API_KEY'],
+            config['AI_BASE_URL'],
+            client=self.upstream_client,
+            model=config['AI_MODEL'],
+            cache=self.answer_cache,
+            classifier=subject_classifier,
+            breaker=CircuitBreaker(
+                failure_threshold=config['BREAKER_FAILURE_THRESHOLD'],
+                recovery_time=config['BREAKER_RECOVERY_TIME'],
+                min_timeout=config['AI_MIN_TIMEOUT'],
+                max_timeout=config['AI_TIMEOUT']
+            ),
+            retry_budget=RetryBudget(ratio=config['AI_RETRY_BUDGET_RATIO']),
+            max_retries=config['AI_MAX_RETRIES'],
+            similarity=self.similarity_index,
+            prompt_builder=PromptBuilder(
+                token_budget=config['CONTEXT_TOKEN_BUDGET'],
+                summary_tokens=config['CONTEXT_SUMMARY_TOKENS']
+            )
+        )
+        if config['RATE_LIMIT_BACKEND'] not in ('memory', 'sqlite'):
+            raise ValueError("RATE_LIMIT_BACKEND must be 'memory' or 'sqlite'")
+        self.rate_limiter = RateLimiter(
+            session_rate=config['RATE_LIMIT_SESSION_PER_MINUTE'] / 60,
+            session_burst=config['RATE_LIMIT_SESSION_BURST'],
+            ip_rate=config['RATE_LIMIT_IP_PER_MINUTE'] / 60,
+            ip_burst=config['RATE_LIMIT_IP_BURST'],
+            db=self.db if config['RATE_LIMIT_BACKEND'] == 'sqlite' else None
+        )
+        self.admission = AdmissionController(
+            max_concurrent=config['ADMISSION_MAX_CONCURRENT'],
+            max_queue=config['ADMISSION_MAX_QUEUE'],
+            target_wait=config['ADMISSION_TARGET_WAIT']
+        )
+        self._static_assets: Optional[Dict] = None
+        self._started = False
+        self._start_lock = threading.Lock()
+
+    def start(self):
+        """Start the background threads once the app serves requests; CLI commands never need them"""
+        if self._started:
+            return
+        with self._start_lock:
+            if self._started:
+                return
+            config = self.app.config
+            self.conversation_writer.start()
+            self.session_tracker.start()
+            if config['RETENTION_DAYS'] > 0:
+                self.retention.start(config['RETENTION_INTERVAL'])
+            if self.similarity_index is not None:
+                self.similarity_index.start(config['SIMILARITY_REFRESH_INTERVAL'])
+            self._started = True
+
+    @property
+    def static_assets(self) -> Dict:
+        """Rendered and compressed on first use rather than at startup"""
+        if self._static_assets is None:
+            self._static_assets = build_static_assets(self.app, HTML_TEMPLATE, split=self.app.config['SPLIT_STATIC_ASSETS'])
+        return self._static_assets
+
+    def close(self):
+        if self.similarity_index is not None:
+            self.similarity_index.close()
+        self.retention.close()
+        self.session_tracker.close()
+        self.conversation_writer.close()
+        self.upstream_client.close()
+
+def _service(name: str) -> LocalProxy:
+    return LocalProxy(lambda: getattr(current_app.extensions['study_assistant'], name))
+
+# The current app's services, for use inside requests and CLI commands
+db = _service('db')
+resource_catalog = _service('resource_catalog')
+conversation_writer = _service('conversation_writer')
+upstream_client = _service('upstream_client')
+answer_cache = _service('answer_cache')
+similarity_index = _service('similarity_index')
+ai_service = _service('ai_service')
+static_assets = _service('static_assets')
+session_tracker = _service('session_tracker')
+conversation_archive = _service('conversation_archive')
+retention = _service('retention')
+rate_limiter = _service('rate_limiter')
+admission = _service('admission')
 
 # HTML Template
 HTML_TEMPLATE = """
@@ -477,6 +3512,7 @@ HTML_TEMPLATE = """
         let selectedSubject = '';
         let messages = [];
         let showResources = false;
+        let historyBefore = null;
 
         // Initialize app
         function init() {
@@ -499,6 +3535,7 @@ HTML_TEMPLATE = """
             event.preventDefault();
             
             const input = document.getElementById('messageInput');
+            const chatContainer = document.getElementById('chatContainer');
             const message = input.value.trim();
             
             if (!message) return;
@@ -510,8 +3547,9 @@ HTML_TEMPLATE = """
             // Show typing indicator
             showTypingIndicator();
             
+            let bubble = null;
             try {
-                const response = await fetch('/api/ask', {
+                const response = await fetch('/api/ask/stream', {
                     method: 'POST',
                     headers: {
                         'Content-Type': 'application/json',
@@ -522,24 +3560,69 @@ HTML_TEMPLATE = """
                     }),
                 });
 
-                if (!response.ok) {
+                if (!response.ok || !response.body) {
                     throw new Error('Failed to get answer');
                 }
 
-                const data = await response.json();
-                hideTypingIndicator();
-                addMessage(data.answer, 'assistant');
+                // Render tokens as they arrive
+                const reader = response.body.getReader();
+                const decoder = new TextDecoder();
+                let buffer = '';
+                let answer = '';
+                while (true) {
+                    const { value, done } = await reader.read();
+                    if (done) break;
+                    buffer += decoder.decode(value, { stream: true });
+                    
+                    let boundary;
+                    while ((boundary = buffer.indexOf('\\n\\n')) !== -1) {
+                        const frame = parseSSE(buffer.slice(0, boundary));
+                        buffer = buffer.slice(boundary + 2);
+                        if (frame.event === 'error') {
+                            throw new Error(frame.data.error);
+                        }
+                        if (!bubble) {
+                            hideTypingIndicator();
+                            bubble = addMessage('', 'assistant');
+                        }
+                        answer = frame.event === 'done' ? frame.data.answer : answer + frame.data.text;
+                        bubble.textEl.textContent = answer;
+                        bubble.record.content = answer;
+                        chatContainer.scrollTop = chatContainer.scrollHeight;
+                    }
+                }
+                
+                if (!bubble) {
+                    throw new Error('Empty answer');
+                }
                 
                 // Save to localStorage
                 saveMessages();
                 
             } catch (error) {
                 hideTypingIndicator();
-                addMessage('Sorry, I encountered an error. Please try again.', 'assistant');
+                if (bubble) {
+                    saveMessages();
+                } else {
+                    addMessage('Sorry, I encountered an error. Please try again.', 'assistant');
+                }
             }
         }
 
-        function addMessage(content, type) {
+        function parseSSE(frame) {
+            let event = 'message';
+            let data = '';
+            frame.split('\\n').forEach(line => {
+                if (line.startsWith('event:')) {
+                    event = line.slice(6).trim();
+                } else if (line.startsWith('data:')) {
+                    data += line.slice(5).trim();
+                }
+            });
+            return { event, data: data ? JSON.parse(data) : {} };
+        }
+
+        function addMessage(content, type, options = {}) {
             const chatContainer = document.getElementById('chatContainer');
             
             // Clear welcome message if it's the first message
@@ -547,6 +3630,7 @@ HTML_TEMPLATE = """
                 chatContainer.innerHTML = '';
             }
             
+            const timestamp = options.timestamp ? new Date(options.timestamp) : new Date();
             const messageDiv = document.createElement('div');
             messageDiv.className = `chat-bubble flex ${type === 'user' ? 'justify-end' : 'justify-start'}`;
             
@@ -558,19 +3642,30 @@ HTML_TEMPLATE = """
                 <div class="${bubbleClass} p-3">
                     <div class="text-sm whitespace-pre-wrap">${content}</div>
                     <div class="text-xs ${type === 'user' ? 'text-blue-100' : 'text-gray-500'} mt-1">
-                        ${new Date().toLocaleTimeString()}
+                        ${timestamp.toLocaleTimeString()}
                     </div>
                 </div>
             `;
             
-            chatContainer.appendChild(messageDiv);
-            chatContainer.scrollTop = chatContainer.scrollHeight;
+            if (options.before) {
+                chatContainer.insertBefore(messageDiv, options.before);
+            } else {
+                chatContainer.appendChild(messageDiv);
+                chatContainer.scrollTop = chatContainer.scrollHeight;
+            }
             
             // Save message
-            messages.push({ content, type, timestamp: new Date().toISOString() });
+            const record = { content, type, timestamp: timestamp.toISOString() };
+            if (options.before) {
+                messages.splice(options.index, 0, record);
+            } else {
+                messages.push(record);
+            }
             
             // Recreate icons
             lucide.createIcons();
+            
+            return { textEl: messageDiv.querySelector('.whitespace-pre-wrap'), record };
         }
 
         function showTypingIndicator() {
@@ -599,8 +3694,18 @@ HTML_TEMPLATE = """
             }
         }
 
-        function clearChat() {
+        async function clearChat() {
             if (confirm('Are you sure you want to clear all messages?')) {
+                // Remember where the server-side history was cleared
+                try {
+                    const response = await fetch('/api/history?limit=1');
+                    const data = await response.json();
+                    if (data.latest) {
+                        localStorage.setItem('studyHistoryCleared', data.latest);
+                    }
+                } catch (error) {
+                    console.error('Failed to mark history as cleared:', error);
+                }
                 messages = [];
                 localStorage.removeItem('studyMessages');
                 location.reload();
@@ -615,7 +3720,7 @@ HTML_TEMPLATE = """
             
             const chatText = messages.map(msg => 
                 `[${new Date(msg.timestamp).toLocaleString()}] ${msg.type.toUpperCase()}:\n${msg.content}\n`
-            ).join('\n---\n\n');
+            ).join('\\n---\\n\\n');
             
             const blob = new Blob([chatText], { type: 'text/plain' });
             const url = URL.createObjectURL(blob);
@@ -642,7 +3747,7 @@ HTML_TEMPLATE = """
 
         async function loadResources() {
             try {
-                const response = await fetch('/api/resources');
+                const response = await fetch('/api/resources?limit=50');
                 const resources = await response.json();
                 
                 const resourcesList = document.getElementById('resourcesList');
@@ -666,19 +3771,75 @@ HTML_TEMPLATE = """
             localStorage.setItem('studyMessages', JSON.stringify(messages));
         }
 
-        function loadMessages() {
-            const saved = localStorage.getItem('studyMessages');
-            if (saved) {
-                messages = JSON.parse(saved);
-                if (messages.length > 0) {
-                    document.getElementById('chatContainer').innerHTML = '';
-                    messages.forEach(msg => {
-                        addMessage(msg.content, msg.type);
-                    });
+        async function loadMessages() {
+            try {
+                renderHistory(await fetchHistory({}), false);
+            } catch (error) {
+                // Fall back to the copy kept in this browser
+                const saved = localStorage.getItem('studyMessages');
+                if (saved) {
+                    const savedMessages = JSON.parse(saved);
+                    messages = [];
+                    if (savedMessages.length > 0) {
+                        document.getElementById('chatContainer').innerHTML = '';
+                        savedMessages.forEach(msg => {
+                            addMessage(msg.content, msg.type, { timestamp: msg.timestamp });
+                        });
+                    }
                 }
             }
         }
 
+        async function loadEarlierMessages() {
+            try {
+                renderHistory(await fetchHistory({ before: historyBefore }), true);
+            } catch (error) {
+                console.error('Failed to load earlier messages:', error);
+            }
+        }
+
+        async function fetchHistory(extra) {
+            const params = new URLSearchParams({ limit: 20, ...extra });
+            const cleared = localStorage.getItem('studyHistoryCleared');
+            if (cleared) {
+                params.set('after', cleared);
+            }
+            const response = await fetch(`/api/history?${params}`);
+            if (!response.ok) {
+                throw new Error('Failed to load history');
+            }
+            return response.json();
+        }
+
+        function renderHistory(data, prepend) {
+            const chatContainer = document.getElementById('chatContainer');
+            const loadEarlier = document.getElementById('loadEarlier');
+            if (loadEarlier) {
+                loadEarlier.remove();
+            }
+            
+            const anchor = prepend ? chatContainer.firstElementChild : null;
+            let index = 0;
+            data.messages.forEach(row => {
+                const timestamp = row.created_at.replace(' ', 'T') + 'Z';
+                addMessage(row.question, 'user', { timestamp, before: anchor, index: index++ });
+                addMessage(row.answer, 'assistant', { timestamp, before: anchor, index: index++ });
+            });
+            
+            historyBefore = data.before;
+            if (data.has_more) {
+                const button = document.createElement('button');
+                button.id = 'loadEarlier';
+                button.className = 'block mx-auto text-xs text-blue-600 hover:underline';
+                button.textContent = 'Load earlier messages';
+                button.onclick = loadEarlierMessages;
+                chatContainer.insertBefore(button, chatContainer.firstElementChild);
+            }
+            if (!prepend) {
+                chatContainer.scrollTop = chatContainer.scrollHeight;
+            }
+        }
+
         // Initialize when DOM is loaded
         document.addEventListener('DOMContentLoaded', init);
     </script>
@@ -686,13 +3847,201 @@ HTML_TEMPLATE = """
 </html>
 """
 
+# Static page assets
+@dataclass
+class StaticAsset:
+    """A response body built once, with precompressed variants and a content-hash ETag"""
+    body: bytes
+    content_type: str
+    cache_control: str
+    etag: str = ''
+    gzip_body: bytes = b''
+    brotli_body: Optional[bytes] = None
+
+    def __post_init__(self):
+        self.etag = hashlib.sha256(self.body).hexdigest()[:20]
+        self.gzip_body = gzip.compress(self.body, compresslevel=9, mtime=0)
+        if brotli is not None:
+            self.brotli_body = brotli.compress(self.body, quality=11)
+
+def build_static_assets(app: Flask, template: str, split: bool = True) -> Dict[str, StaticAsset]:
+    """Render the page once; optionally move inline CSS/JS into fingerprinted files"""
+    with app.app_context():
+        html = render_template_string(template)
+    
+    assets: Dict[str, StaticAsset] = {}
+    if split:
+        immutable = 'public, max-age=31536000, immutable'
+        style = re.search(r'<style>(.*?)</style>', html, re.S)
+        script = re.search(r'<script>(.*?)</script>', html, re.S)
+        for match, ext, content_type, tag in (
+            (style, 'css', 'text/css; charset=utf-8', '<link rel="stylesheet" href="/assets/{name}">'),
+            (script, 'js', 'application/javascript; charset=utf-8', '<script src="/assets/{name}"></script>'),
+        ):
+            if match is None:
+                continue
+            asset = StaticAsset(match.group(1).encode('utf-8'), content_type, immutable)
+            name = f"app.{asset.etag[:12]}.{ext}"
+            assets[name] = asset
+            html = html.replace(match.group(0), tag.format(name=name), 1)
+    
+    assets['index.html'] = StaticAsset(html.encode('utf-8'), 'text/html; charset=utf-8', 'no-cache')
+    return assets
+
+def select_asset_variant(asset: StaticAsset, encodings) -> tuple:
+    """(body, content_encoding, etag) of the best precompressed variant for parsed Accept-Encoding"""
+    if asset.brotli_body is not None and encodings['br']:
+        body, encoding = asset.brotli_body, 'br'
+    elif encodings['gzip']:
+        body, encoding = asset.gzip_body, 'gzip'
+    else:
+        body, encoding = asset.body, None
+    return body, encoding, f"{asset.etag}-{encoding}" if encoding else asset.etag
+
+def serve_static_asset(asset: StaticAsset) -> Response:
+    """Send the best precompressed variant the client accepts, answering 304 on a matching ETag"""
+    body, encoding, etag = select_asset_variant(asset, request.accept_encodings)
+    
+    response = Response(body, content_type=asset.content_type)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.headers['Cache-Control'] = asset.cache_control
+    response.vary.add('Accept-Encoding')
+    response.set_etag(etag)
+    return response.make_conditional(request)
+
+# Helpers
+def new_session_id() -> str:
+    """Identifier for a new browser session: a 48-bit millisecond clock then 80 random bits,
+    so ids sort by creation time and cannot collide across threads or worker processes"""
+    return f"session_{time.time_ns() // 1_000_000:012x}{os.urandom(10).hex()}"
+
+def int_arg(args, name: str, default: Optional[int], minimum: int, maximum: int) -> Optional[int]:
+    """Read an integer query argument, or `default` when it is absent; raises ValueError naming the range"""
+    value = args.get(name)
+    if not value:
+        return default
+    if not (value.isascii() and value.isdigit()) or not minimum <= int(value) <= maximum:
+        raise ValueError(f'{name} must be an integer between {minimum} and {maximum}')
+    return int(value)
+
+def resource_page(args) -> tuple:
+    """(body, etag, next_cursor) for /api/resources query arguments; raises ValueError on bad input"""
+    return resource_catalog.page(
+        subject=args.get('subject') or None,
+        difficulty=args.get('difficulty') or None,
+        resource_type=args.get('type') or None,
+        limit=int_arg(args, 'limit', None, 1, ResourceCatalog.MAX_LIMIT),
+        cursor=args.get('cursor') or None
+    )
+
+def health_status() -> Dict:
+    """Body of the health check"""
+    breaker = ai_service.breaker.stats()
+    return {
+        'status': 'degraded' if breaker['state'] != CircuitBreaker.CLOSED else 'healthy',
+        'upstream': breaker,
+        'timestamp': datetime.now().isoformat(),
+        'version': '1.0.0',
+        'answer_cache': answer_cache.stats(),
+        'coalescing': ai_service.coalescing_stats(),
+        'conversation_writer': conversation_writer.stats(),
+        'admission': admission.stats(),
+        'sessions': session_tracker.stats(),
+        'retention': retention.stats(),
+        'similarity_index': similarity_index.stats() if similarity_index else None
+    }
+
+def save_conversation(session_id: str, question: str, response: Dict):
+    """Queue one answered question for the conversations table"""
+    conversation_writer.submit(session_id, question, response['answer'],
+                               response.get('detected_subject'), response.get('confidence'))
+
+def conversation_history(session_id: str, limit: int, before: Optional[tuple] = None,
+                         after: Optional[tuple] = None) -> List:
+    """Newest `limit` rows of a session, continuing into the archive once the hot table runs out"""
+    rows = list(db.get_history(session_id, limit, before, after))
+    if len(rows) < limit:
+        # Archived rows are all older than the rows still in the table
+        older_than = (rows[-1]['created_at'], rows[-1]['id']) if rows else before
+        rows.extend(conversation_archive.history(session_id, limit - len(rows), older_than, after))
+    return rows
+
+def load_context(session_id: str) -> List[sqlite3.Row]:
+    """Most recent turns of a session for prompt context, newest first
+    
+    The answer cache and single-flight keys include a digest of these turns, so only
+    sessions with the same recent history share an answer; a new session has none and
+    shares the context-free entries.
+    """
+    if current_app.config['CONTEXT_MAX_TURNS'] <= 0:
+        return []
+    return db.get_history(session_id, current_app.config['CONTEXT_MAX_TURNS'])
+
+def parse_export_time(value: Optional[str]) -> Optional[str]:
+    """ISO date or datetime from a query argument, in the created_at column's format"""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value).strftime('%Y-%m-%d %H:%M:%S')
+    except ValueError:
+        raise ValueError(f'Invalid date: {value}')
+
+def format_sse(event: str, data: Dict) -> str:
+    """Encode one Server-Sent Events frame"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+def admission_controlled(cost=None):
+    """Rate-limit the caller, then hold an admission slot until the response has been sent
+    
+    `cost` is an optional function returning how many rate-limit tokens the request spends.
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            try:
+                rate_limiter.check(session.get('session_id'), request.remote_addr, cost() if cost else 1)
+                with tracer.span('admission.wait'):
+                    slot = admission.acquire()
+            except Overloaded as e:
+                return jsonify({'error': e.message}), e.status, {'Retry-After': e.retry_after_header}
+            try:
+                response = current_app.make_response(view(*args, **kwargs))
+            except BaseException:
+                slot.release()
+                raise
+            if response.is_streamed:
+                # The upstream work happens while the body is sent; hold the slot until it is closed
+                response.call_on_close(slot.release)
+            else:
+                slot.release()
+            return response
+        return wrapper
+    return decorator
+
+def batch_cost() -> int:
+    """A batch spends one rate-limit token per question"""
+    questions = (request.get_json(silent=True) or {}).get('questions')
+    return len(questions) if isinstance(questions, list) and questions else 1
+
 # Routes
-@app.route('/')
+bp = Blueprint('study_assistant', __name__, cli_group=None)
+
+@bp.route('/')
 def index():
     """Main page"""
-    return render_template_string(HTML_TEMPLATE)
+    return serve_static_asset(static_assets['index.html'])
+
+@bp.route('/assets/<name>')
+def static_asset(name: str):
+    """Fingerprinted CSS/JS split out of the main page"""
+    asset = static_assets.get(name)
+    if asset is None or name == 'index.html':
+        return jsonify({'error': 'Not found'}), 404
+    return serve_static_asset(asset)
 
-@app.route('/api/ask', methods=['POST'])
+@bp.route('/api/ask', methods=['POST'])
+@admission_controlled()
 def ask_question():
     """Handle AI question requests"""
     try:
@@ -703,77 +4052,864 @@ def ask_question():
         if not question:
             return jsonify({'error': 'Question is required'}), 400
         
-        # Generate AI response
-        import asyncio
-        response = asyncio.run(ai_service.generate_response(question, subject))
-        
-        # Save conversation to database
+        # Generate AI response on the shared upstream loop
         session_id = session.get('session_id', 'default')
-        conn = sqlite3.connect(app.config['DATABASE_URL'])
-        cursor = conn.cursor()
+        with tracer.span('load_context'):
+            history = load_context(session_id)
+        with tracer.span('generate_response'):
+            response = upstream_client.run(ai_service.generate_response(question, subject, history))
         
-        cursor.execute('''
-            INSERT INTO conversations (session_id, question, answer, subject, confidence)
-            VALUES (?, ?, ?, ?, ?)
-        ''', (session_id, question, response['answer'], response.get('detected_subject'), response.get('confidence')))
-        
-        conn.commit()
-        conn.close()
+        # Save conversation to database
+        with tracer.span('save_conversation'):
+            save_conversation(session_id, question, response)
         
-        return jsonify(response)
+        with tracer.span('jsonify'):
+            return jsonify(response)
         
     except Exception as e:
         print(f"Error processing question: {e}")
         return jsonify({'error': 'Failed to process question'}), 500
 
-@app.route('/api/resources', methods=['GET'])
+@bp.route('/api/ask/stream', methods=['POST'])
+@admission_controlled()
+def ask_question_stream():
+    """Stream an AI answer to the browser as Server-Sent Events"""
+    data = request.get_json() or {}
+    question = data.get('question', '').strip()
+    subject = data.get('subject', '')
+    
+    if not question:
+        return jsonify({'error': 'Question is required'}), 400
+    
+    session_id = session.get('session_id', 'default')
+    history = load_context(session_id)
+    
+    def generate():
+        try:
+            for event, payload in upstream_client.iterate(ai_service.stream_response(question, subject, history)):
+                if event == 'done':
+                    # Persist before the final event so a disconnect cannot drop the row
+                    save_conversation(session_id, question, payload)
+                    yield format_sse('done', payload)
+                else:
+                    yield format_sse('token', {'text': payload})
+        except Exception as e:
+            print(f"Error streaming answer: {e}")
+            yield format_sse('error', {'error': 'Failed to process question'})
+    
+    return Response(stream_with_context(generate()), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no'
+    })
+
+@bp.route('/api/ask/batch', methods=['POST'])
+@admission_controlled(cost=batch_cost)
+def ask_batch():
+    """Answer a list of questions concurrently, streaming NDJSON results as each finishes"""
+    data = request.get_json(silent=True) or {}
+    questions = data.get('questions')
+    max_questions = current_app.config['BATCH_MAX_QUESTIONS']
+    
+    if not isinstance(questions, list) or not questions:
+        return jsonify({'error': 'questions must be a non-empty list'}), 400
+    if len(questions) > max_questions:
+        return jsonify({'error': f'At most {max_questions} questions per batch'}), 400
+    
+    items = []
+    for item in questions:
+        if isinstance(item, dict):
+            items.append((str(item.get('question') or '').strip(), item.get('subject') or ''))
+        else:
+            items.append((str(item or '').strip(), ''))
+    
+    session_id = session.get('session_id', 'default')
+    valid = [i for i, (question, _) in enumerate(items) if question]
+    
+    def generate():
+        records = []
+        failed = 0
+        try:
+            for index, (question, _) in enumerate(items):
+                if not question:
+                    failed += 1
+                    yield json.dumps({'index': index, 'error': 'Question is required'}) + '\n'
+            
+            batch = ai_service.generate_batch([items[i] for i in valid], current_app.config['BATCH_MAX_CONCURRENCY'])
+            for position, response, error in upstream_client.iterate(batch):
+                index = valid[position]
+                question = items[index][0]
+                if error is not None:
+                    print(f"Error answering batch question {index}: {error}")
+                    failed += 1
+                    yield json.dumps({'index': index, 'error': 'Failed to process question'}) + '\n'
+                    continue
+                records.append(ConversationWriter.make_record(
+                    session_id, question, response['answer'],
+                    response.get('detected_subject'), response.get('confidence')
+                ))
+                yield json.dumps({'index': index, 'question': question, **response}) + '\n'
+            
+            yield json.dumps({'done': True, 'answered': len(records), 'failed': failed}) + '\n'
+        finally:
+            # One transaction for the whole batch, even if the client went away
+            conversation_writer.write_now(records)
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+
+@bp.route('/api/resources', methods=['GET'])
 def get_resources():
-    """Get study resources"""
+    """Get study resources, filtered by subject/difficulty/type with keyset pagination"""
     try:
-        conn = sqlite3.connect(app.config['DATABASE_URL'])
-        cursor = conn.cursor()
-        
-        cursor.execute('''
-            SELECT title, description, subject, url, type, difficulty
-            FROM study_resources
-            ORDER BY created_at DESC
-        ''')
-        
-        resources = []
-        for row in cursor.fetchall():
-            resources.append({
-                'title': row[0],
-                'description': row[1],
-                'subject': row[2],
-                'url': row[3],
-                'type': row[4],
-                'difficulty': row[5]
-            })
+        try:
+            with tracer.span('resource_catalog.page'):
+                body, etag, next_cursor = resource_page(request.args)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
-        conn.close()
-        return jsonify(resources)
+        with tracer.span('build_response'):
+            response = Response(body, mimetype='application/json', headers={'Cache-Control': 'no-cache'})
+            if next_cursor:
+                response.headers['X-Next-Cursor'] = next_cursor
+            response.set_etag(etag)
+            return response.make_conditional(request)
         
     except Exception as e:
         print(f"Error fetching resources: {e}")
         return jsonify({'error': 'Failed to fetch resources'}), 500
 
-@app.route('/api/health', methods=['GET'])
+@bp.route('/api/history', methods=['GET'])
+def get_history():
+    """Page through the current session's conversation, newest first"""
+    try:
+        limit = int_arg(request.args, 'limit', 20, 1, 200)
+        before = decode_cursor(request.args['before']) if request.args.get('before') else None
+        after = decode_cursor(request.args['after']) if request.args.get('after') else None
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        session_id = session.get('session_id', 'default')
+        # Fetch one extra row to learn whether older rows remain in the window
+        rows = conversation_history(session_id, limit + 1, before, after)
+        has_more = len(rows) > limit
+        rows = list(reversed(rows[:limit]))
+        
+        return jsonify({
+            'messages': [dict(row) for row in rows],
+            'has_more': has_more,
+            'before': encode_cursor(rows[0]['created_at'], rows[0]['id']) if rows else None,
+            'latest': encode_cursor(rows[-1]['created_at'], rows[-1]['id']) if rows else request.args.get('after')
+        })
+        
+    except Exception as e:
+        print(f"Error fetching history: {e}")
+        return jsonify({'error': 'Failed to fetch history'}), 500
+
+@bp.route('/api/export', methods=['GET'])
+def export_conversations():
+    """Stream conversations as NDJSON or CSV, gzipped on the fly when the client accepts it"""
+    if request.args.get('mine') == '1':
+        session_id = session.get('session_id', 'default')
+    else:
+        denied = require_admin()
+        if denied:
+            return denied
+        session_id = request.args.get('session') or None
+    
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({'error': 'format must be ndjson or csv'}), 400
+    try:
+        start = parse_export_time(request.args.get('from'))
+        end = parse_export_time(request.args.get('to'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    subject = request.args.get('subject') or None
+    include_archived = request.args.get('archived') == '1'
+    batch_size = current_app.config['EXPORT_BATCH_SIZE']
+    compress = bool(request.accept_encodings['gzip'])
+    fields = ConversationArchive.FIELDS
+    
+    def rows():
+        if include_archived:
+            yield from conversation_archive.export(session_id, subject, start, end)
+        # Keyset batches instead of one long-lived cursor, so the export never pins an old WAL snapshot
+        after_id = 0
+        while True:
+            batch = db.export_conversations(after_id, batch_size, session_id, subject, start, end)
+            yield from batch
+            if len(batch) < batch_size:
+                return
+            after_id = batch[-1]['id']
+    
+    def generate():
+        buffer = io.StringIO()
+        writer = csv.writer(buffer) if export_format == 'csv' else None
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if compress else None
+        if writer is not None:
+            writer.writerow(fields)
+        exported = 0
+        for row in rows():
+            if writer is not None:
+                writer.writerow([row[field] for field in fields])
+            else:
+                buffer.write(json.dumps({field: row[field] for field in fields}) + '\n')
+            exported += 1
+            if buffer.tell() >= 65536:
+                data = buffer.getvalue().encode('utf-8')
+                buffer.seek(0)
+                buffer.truncate()
+                data = compressor.compress(data) if compressor else data
+                if data:
+                    yield data
+        data = buffer.getvalue().encode('utf-8')
+        yield compressor.compress(data) + compressor.flush() if compressor else data
+        metrics.inc('export_rows_total', (('format', export_format),), exported)
+    
+    extension = 'csv' if export_format == 'csv' else 'ndjson'
+    response = Response(stream_with_context(generate()),
+                        mimetype='text/csv' if export_format == 'csv' else 'application/x-ndjson',
+                        headers={
+                            'Content-Disposition': f'attachment; filename="conversations-{datetime.now():%Y%m%d}.{extension}"',
+                            'X-Accel-Buffering': 'no'
+                        })
+    if compress:
+        response.headers['Content-Encoding'] = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+@bp.route('/api/search', methods=['GET'])
+def search():
+    """Full-text search over past conversations and study resources"""
+    if not db.fts_enabled:
+        return jsonify({'error': 'Search is not available'}), 503
+    
+    match = Database.fts_query(request.args.get('q', ''))
+    if match is None:
+        return jsonify({'error': 'Query is required'}), 400
+    
+    scope = request.args.get('scope', 'all')
+    if scope not in ('all', 'conversations', 'resources'):
+        return jsonify({'error': 'scope must be all, conversations or resources'}), 400
+    try:
+        limit = int_arg(request.args, 'limit', 20, 1, 100)
+        offset = int_arg(request.args, 'offset', 0, 0, 1000)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    subject = request.args.get('subject') or None
+    # Conversations are private to their session; searching every session is admin-only
+    if request.args.get('all') == '1':
+        denied = require_admin()
+        if denied:
+            return denied
+        session_id = None
+    else:
+        session_id = session.get('session_id', 'default')
+    
+    try:
+        # Fetch one extra row per source to know whether another page exists
+        window = offset + limit + 1
+        results = []
+        if scope in ('all', 'conversations'):
+            for row in db.search_conversations(match, subject, session_id, window, 0):
+                results.append({'kind': 'conversation', **dict(row)})
+        if scope in ('all', 'resources'):
+            for row in db.search_resources(match, subject, window, 0):
+                results.append({'kind': 'resource', **dict(row)})
+        results.sort(key=lambda r: r['score'])
+        page = results[offset:offset + limit]
+        
+        return jsonify({
+            'results': page,
+            'next_offset': offset + limit if len(results) > offset + limit else None
+        })
+        
+    except Exception as e:
+        print(f"Error searching: {e}")
+        return jsonify({'error': 'Failed to search'}), 500
+
+@bp.route('/api/health', methods=['GET'])
 def health_check():
     """Health check endpoint"""
-    return jsonify({
-        'status': 'healthy',
-        'timestamp': datetime.now().isoformat(),
-        'version': '1.0.0'
-    })
+    return jsonify(health_status())
+
+@bp.route('/api/metrics', methods=['GET'])
+def get_metrics():
+    """Prometheus metrics"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@metrics.collector
+def collect_service_metrics():
+    """Point-in-time gauges read from the services at scrape time"""
+    writer = conversation_writer.stats()
+    cache = answer_cache.stats()
+    breaker = ai_service.breaker.stats()
+    coalescing = ai_service.coalescing_stats()
+    slots = admission.stats()
+    archived = retention.stats()
+    samples = [
+        ('conversation_writer_queue_depth', 'gauge', 'Conversation rows waiting to be written', (), writer['queue_depth']),
+        ('conversation_writer_rows_total', 'counter', 'Conversation rows written by the background writer', (), writer['rows_written']),
+        ('answer_cache_lookups_total', 'counter', 'Answer cache lookups by result', (('result', 'hit'),), cache['hits']),
+        ('answer_cache_lookups_total', 'counter', 'Answer cache lookups by result', (('result', 'miss'),), cache['misses']),
+        ('answer_cache_purged_total', 'counter', 'Expired answer cache rows deleted', (), cache['purged']),
+        ('upstream_circuit_open', 'gauge', '1 while the upstream circuit breaker is not closed', (), int(breaker['state'] != CircuitBreaker.CLOSED)),
+        ('upstream_timeout_seconds', 'gauge', 'Current adaptive upstream timeout', (), breaker['timeout_s']),
+        ('upstream_coalesced_calls_total', 'counter', 'Requests that shared another request\'s upstream call', (), coalescing['coalesced_calls']),
+        ('admission_active', 'gauge', 'Question requests holding an admission slot', (), slots['active']),
+        ('admission_queue_depth', 'gauge', 'Question requests waiting for an admission slot', (), slots['waiting']),
+        ('conversations_archived_total', 'counter', 'Conversation rows moved to archive segments', (), archived['rows_archived']),
+    ]
+    sessions = session_tracker.stats()
+    if sessions['total'] is not None:
+        samples.append(('sessions_total', 'gauge', 'Sessions recorded in the sessions table', (), sessions['total']))
+        for window, count in sessions['active'].items():
+            samples.append(('sessions_active', 'gauge', 'Sessions seen within the window, as of the last activity flush',
+                            (('window', window),), count))
+    return samples
+
+@bp.before_app_request
+def start_services():
+    """Start the background threads on the first request"""
+    current_app.extensions['study_assistant'].start()
+
+@bp.before_app_request
+def start_request_metrics():
+    """Track in-flight requests and start the latency clock"""
+    g.request_started = time.perf_counter()
+    metrics.inc('http_requests_in_flight')
+
+@bp.teardown_app_request
+def finish_request_metrics(error=None):
+    """Record request latency by route"""
+    started = g.pop('request_started', None)
+    if started is None:
+        return
+    metrics.inc('http_requests_in_flight', value=-1)
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    metrics.observe('http_request_duration_seconds', time.perf_counter() - started,
+                    (('route', route), ('method', request.method)))
+
+@bp.before_app_request
+def start_request_trace():
+    """Open a sampled trace and join a running cProfile capture"""
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    g.trace = tracer.start_trace(f'{request.method} {route}', route=route, method=request.method)
+    g.profile = profiler.request_started()
+
+@bp.teardown_app_request
+def finish_request_trace(error=None):
+    profiler.request_finished(g.pop('profile', None))
+    handle = g.pop('trace', None)
+    if handle is not None:
+        attributes = {'error': type(error).__name__} if error is not None else {}
+        tracer.finish_trace(handle, **attributes)
+
+def require_admin():
+    """Return an error response unless the request carries ADMIN_TOKEN"""
+    token = current_app.config['ADMIN_TOKEN']
+    if not token:
+        return jsonify({'error': 'Admin endpoints are disabled; set ADMIN_TOKEN'}), 404
+    if not hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token):
+        return jsonify({'error': 'Forbidden'}), 403
+    return None
 
-@app.before_request
+@bp.route('/api/admin/tracing', methods=['GET', 'POST'])
+def admin_tracing():
+    """Show or change the trace sample rate and export format"""
+    denied = require_admin()
+    if denied:
+        return denied
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            sample_rate = data.get('sample_rate')
+            tracer.configure(float(sample_rate) if sample_rate is not None else None, data.get('format'))
+        except (TypeError, ValueError) as e:
+            return jsonify({'error': str(e)}), 400
+    return jsonify(tracer.stats())
+
+@bp.route('/api/admin/profile', methods=['POST'])
+def admin_profile():
+    """Profile the live process for N seconds and return the report as text"""
+    denied = require_admin()
+    if denied:
+        return denied
+    data = request.get_json(silent=True) or {}
+    try:
+        seconds = float(data.get('seconds', request.args.get('seconds', 10)))
+        mode = data.get('mode', request.args.get('mode', 'sample'))
+        limit = int(data.get('limit', request.args.get('limit', 60)))
+        report = profiler.capture(seconds, mode, loop=upstream_client.loop, limit=limit)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except RuntimeError as e:
+        return jsonify({'error': str(e)}), 409
+    return Response(report, mimetype='text/plain')
+
+@bp.route('/api/admin/resources/import', methods=['POST'])
+def admin_import_resources():
+    """Stream a CSV or JSONL catalog into study_resources, reporting progress as NDJSON"""
+    denied = require_admin()
+    if denied:
+        return denied
+    import_format = request.args.get('format') or ('csv' if request.mimetype == 'text/csv' else 'jsonl')
+    if import_format not in ('csv', 'jsonl'):
+        return jsonify({'error': 'format must be csv or jsonl'}), 400
+    replace = request.args.get('replace') == '1'
+    force = request.args.get('force') == '1'
+    importer = ResourceImporter(db, batch_size=current_app.config['IMPORT_BATCH_SIZE'])
+    stream = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+    
+    def generate():
+        try:
+            for progress in importer.run(stream, import_format, replace, force):
+                yield json.dumps(progress) + '\n'
+        except (UnicodeDecodeError, csv.Error, sqlite3.Error) as e:
+            print(f"Error importing resources: {e}")
+            yield json.dumps({'error': f'Import failed: {e}'}) + '\n'
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson', headers={'X-Accel-Buffering': 'no'})
+
+# Probes and scrapers do not keep cookies; giving them sessions would only fill the sessions table
+UNTRACKED_ENDPOINTS = ('study_assistant.health_check', 'study_assistant.get_metrics')
+
+@bp.before_app_request
 def before_request():
-    """Initialize session"""
+    """Initialize session and note its activity"""
+    if request.endpoint in UNTRACKED_ENDPOINTS:
+        return
     if 'session_id' not in session:
-        session['session_id'] = f"session_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{hash(str(datetime.now()))}"
+        session['session_id'] = new_session_id()
+    session_tracker.touch(session['session_id'])
+
+@bp.cli.command('migrate')
+def migrate_command():
+    """Create or upgrade the database schema (run once per deployment when AUTO_MIGRATE is off)"""
+    try:
+        ran = db.migrate()
+    except MigrationError as e:
+        raise click.ClickException(str(e))
+    print(f"Database schema {'migrated to' if ran else 'already at'} version {Database.SCHEMA_VERSION}")
+
+@bp.cli.command('import-resources')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'import_format', type=click.Choice(['csv', 'jsonl']), default=None,
+              help='Input format (default: from the file extension)')
+@click.option('--replace', is_flag=True, help='Make the catalog exactly the imported rows instead of merging them in')
+@click.option('--force', is_flag=True, help='Replace even when some rows were invalid')
+def import_resources_command(path, import_format, replace, force):
+    """Bulk-load study resources from a CSV or JSONL file, optionally gzipped"""
+    name = path[:-3] if path.endswith('.gz') else path
+    import_format = import_format or ('csv' if name.endswith('.csv') else 'jsonl')
+    opener = gzip.open if path.endswith('.gz') else open
+    importer = ResourceImporter(db, batch_size=current_app.config['IMPORT_BATCH_SIZE'])
+    with opener(path, 'rt', encoding='utf-8', newline='') as f:
+        for progress in importer.run(f, import_format, replace, force):
+            print(f"{progress['rows_read']} rows read, {progress['rows_invalid']} invalid, "
+                  f"{progress['rows_per_second']} rows/s")
+    for error in progress['errors']:
+        print(f"  line {error['line']}: {error['error']}")
+    if 'error' in progress:
+        raise click.ClickException(progress['error'])
+    print(f"Catalog now has {progress['catalog_size']} resources: {progress['inserted']} added, "
+          f"{progress['updated']} updated, {progress['deleted']} removed in {progress['elapsed_s']}s")
+
+@bp.cli.command('archive')
+@click.option('--days', type=float, default=None, help='Archive rows older than this (default RETENTION_DAYS)')
+@click.option('--full-vacuum', is_flag=True, help='Switch an older database to incremental vacuum first; blocks writers while it runs')
+def archive_command(days, full_vacuum):
+    """Move old conversations to archive segments and shrink the database file"""
+    if full_vacuum:
+        with db.connection() as conn:
+            conn.execute('VACUUM')
+    if days is not None:
+        retention.max_age_days = days
+    if retention.max_age_days <= 0:
+        print("Nothing to archive: set RETENTION_DAYS or pass --days")
+        return
+    result = retention.run_once()
+    print(f"Archived {result['rows_archived']} rows older than {result['cutoff']} into "
+          f"{result['segments_written']} segments; freed {result['pages_vacuumed']} pages")
+
+# ASGI entry point
+class AsgiApp:
+    """ASGI server entry point sharing one create_app() instance's services
+    
+    /, /assets/*, /api/ask, /api/resources and /api/health are handled natively on the
+    server's event loop, so a request waiting on the upstream model holds no thread.
+    Every other route runs the Flask app on a bounded worker pool.
+    """
+
+    def __init__(self, app: Flask):
+        self.app = app
+        self.services: Services = app.extensions['study_assistant']
+        self.routes = {
+            ('GET', '/'): self.index,
+            ('POST', '/api/ask'): self.ask,
+            ('GET', '/api/resources'): self.resources,
+            ('GET', '/api/health'): self.health,
+        }
+        self._serializer = app.session_interface.get_signing_serializer(app)
+        self._executor = ThreadPoolExecutor(max_workers=app.config['ASGI_WSGI_THREADS'],
+                                            thread_name_prefix='asgi-wsgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self._lifespan(receive, send)
+        if scope['type'] != 'http':
+            return
+        self.services.upstream_client.attach(asyncio.get_running_loop())
+        self.services.start()
+        
+        method, path = scope['method'], scope['path']
+        handler = self.routes.get((method, path))
+        route = path
+        if handler is None and method == 'GET' and path.startswith('/assets/'):
+            handler, route = self.asset, '/assets/<name>'
+        if handler is None:
+            return await self._wsgi(scope, receive, send)
+        
+        started = time.perf_counter()
+        metrics.inc('http_requests_in_flight')
+        trace = tracer.start_trace(f'{method} {route}', route=route, method=method)
+        try:
+            with self.app.app_context():
+                await handler(AsgiRequest(scope, await self._read_body(receive)), self._with_cors(scope, send))
+        finally:
+            tracer.finish_trace(trace)
+            metrics.inc('http_requests_in_flight', value=-1)
+            metrics.observe('http_request_duration_seconds', time.perf_counter() - started,
+                            (('route', route), ('method', method)))
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.services.upstream_client.attach(asyncio.get_running_loop())
+                self.services.start()
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.services.upstream_client.aclose()
+                await asyncio.to_thread(self.services.close)
+                self._executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    @staticmethod
+    def _with_cors(scope, send):
+        """Wrap send to add the headers CORS(app) gives Flask responses; preflights fall through to Flask"""
+        origin = next((value for name, value in scope['headers'] if name == b'origin'), None)
+        # Like flask-cors with its defaults: any origin is allowed, echoed back when the request names one
+        cors_headers = [(b'access-control-allow-origin', origin or b'*')]
+        if origin:
+            cors_headers.append((b'vary', b'Origin'))
+
+        async def send_with_cors(message):
+            if message['type'] == 'http.response.start':
+                message = dict(message, headers=list(message.get('headers', ())) + cors_headers)
+            await send(message)
+        return send_with_cors
+
+    @staticmethod
+    async def _read_body(receive) -> bytes:
+        chunks = []
+        while True:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                break
+            chunks.append(message.get('body', b''))
+            if not message.get('more_body'):
+                break
+        return b''.join(chunks)
+
+    @staticmethod
+    async def _respond(send, status: int, body: bytes, content_type: Optional[str] = None,
+                       headers: Optional[List[tuple]] = None):
+        raw_headers = [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers or ()]
+        if content_type:
+            raw_headers.append((b'content-type', content_type.encode('latin-1')))
+        raw_headers.append((b'content-length', str(len(body)).encode('latin-1')))
+        await send({'type': 'http.response.start', 'status': status, 'headers': raw_headers})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def _json(self, send, payload, status: int = 200, headers: Optional[List[tuple]] = None):
+        await self._respond(send, status, json.dumps(payload).encode('utf-8'), 'application/json', headers)
+
+    def _session(self, request: 'AsgiRequest') -> Dict:
+        """Read the same signed session cookie the Flask routes use, once per request"""
+        if request.session is None:
+            request.session = {}
+            value = request.cookies.get(self.app.config['SESSION_COOKIE_NAME'])
+            if value and self._serializer is not None:
+                try:
+                    request.session = dict(self._serializer.loads(
+                        value, max_age=int(self.app.permanent_session_lifetime.total_seconds())
+                    ))
+                except Exception:
+                    pass
+        return request.session
+
+    def _touch_session(self, request: 'AsgiRequest'):
+        """Note activity for the request's session, as before_request does for Flask routes"""
+        session_id = self._session(request).get('session_id')
+        if session_id:
+            self.services.session_tracker.touch(session_id)
+
+    def _session_cookie(self, data: Dict) -> tuple:
+        config = self.app.config
+        return ('Set-Cookie', dump_cookie(
+            config['SESSION_COOKIE_NAME'], self._serializer.dumps(data),
+            path=config['SESSION_COOKIE_PATH'] or '/', domain=config['SESSION_COOKIE_DOMAIN'],
+            secure=config['SESSION_COOKIE_SECURE'], httponly=config['SESSION_COOKIE_HTTPONLY'],
+            samesite=config['SESSION_COOKIE_SAMESITE']
+        ))
+
+    async def _send_asset(self, request: 'AsgiRequest', send, asset: StaticAsset):
+        body, encoding, etag = select_asset_variant(asset, parse_accept_header(request.headers.get('accept-encoding')))
+        headers = [('Cache-Control', asset.cache_control), ('Vary', 'Accept-Encoding'), ('ETag', f'"{etag}"')]
+        if parse_etags(request.headers.get('if-none-match')).contains(etag):
+            return await self._respond(send, 304, b'', headers=headers)
+        if encoding:
+            headers.append(('Content-Encoding', encoding))
+        await self._respond(send, 200, body, asset.content_type, headers)
+
+    async def index(self, request: 'AsgiRequest', send):
+        self._touch_session(request)
+        await self._send_asset(request, send, self.services.static_assets['index.html'])
+
+    async def asset(self, request: 'AsgiRequest', send):
+        name = request.path[len('/assets/'):]
+        asset = self.services.static_assets.get(name)
+        if asset is None or name == 'index.html':
+            return await self._json(send, {'error': 'Not found'}, 404)
+        await self._send_asset(request, send, asset)
+
+    async def _admit(self, session_id: str, client_ip: str) -> AdmissionSlot:
+        """The admission_controlled() checks for a native route; raises Overloaded"""
+        limiter = self.services.rate_limiter
+        if limiter.shared:
+            await asyncio.to_thread(limiter.check, session_id, client_ip)
+        else:
+            limiter.check(session_id, client_ip)
+        with tracer.span('admission.wait'):
+            return await self.services.admission.acquire_async()
+
+    async def ask(self, request: 'AsgiRequest', send):
+        try:
+            data = json.loads(request.body or b'{}')
+        except ValueError:
+            return await self._json(send, {'error': 'Invalid JSON'}, 400)
+        try:
+            question = (data.get('question') or '').strip()
+            subject = data.get('subject', '')
+            if not question:
+                return await self._json(send, {'error': 'Question is required'}, 400)
+            
+            headers = []
+            session_data = self._session(request)
+            if 'session_id' not in session_data:
+                session_data['session_id'] = new_session_id()
+                headers.append(self._session_cookie(session_data))
+            session_id = session_data['session_id']
+            self.services.session_tracker.touch(session_id)
+            
+            try:
+                slot = await self._admit(session_id, request.client_ip)
+            except Overloaded as e:
+                return await self._json(send, {'error': e.message}, e.status,
+                                        headers + [('Retry-After', e.retry_after_header)])
+            try:
+                with tracer.span('load_context'):
+                    history = await asyncio.to_thread(load_context, session_id)
+                with tracer.span('generate_response'):
+                    response = await self.services.ai_service.generate_response(question, subject, history)
+                with tracer.span('save_conversation'):
+                    # The writer falls back to a synchronous insert when its queue is full
+                    await asyncio.to_thread(save_conversation, session_id, question, response)
+            finally:
+                slot.release()
+            await self._json(send, response, headers=headers)
+        except Exception as e:
+            print(f"Error processing question: {e}")
+            await self._json(send, {'error': 'Failed to process question'}, 500)
+
+    async def resources(self, request: 'AsgiRequest', send):
+        self._touch_session(request)
+        try:
+            try:
+                with tracer.span('resource_catalog.page'):
+                    body, etag, next_cursor = await asyncio.to_thread(resource_page, request.args)
+            except ValueError as e:
+                return await self._json(send, {'error': str(e)}, 400)
+            headers = [('Cache-Control', 'no-cache'), ('ETag', f'"{etag}"')]
+            if next_cursor:
+                headers.append(('X-Next-Cursor', next_cursor))
+            if parse_etags(request.headers.get('if-none-match')).contains(etag):
+                return await self._respond(send, 304, b'', headers=headers)
+            await self._respond(send, 200, body, 'application/json', headers)
+        except Exception as e:
+            print(f"Error fetching resources: {e}")
+            await self._json(send, {'error': 'Failed to fetch resources'}, 500)
+
+    async def health(self, request: 'AsgiRequest', send):
+        await self._json(send, health_status())
+
+    def _environ(self, scope, body: bytes) -> Dict:
+        server = scope.get('server') or ('localhost', 80)
+        client = scope.get('client') or ('', 0)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+            'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope.get('query_string', b'').decode('latin-1'),
+            'CONTENT_LENGTH': str(len(body)),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope.get('http_version', '1.1')}",
+            'REMOTE_ADDR': client[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': io.BytesIO(body),
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+        }
+        for name, value in scope.get('headers', ()):
+            name = name.decode('latin-1').upper().replace('-', '_')
+            value = value.decode('latin-1')
+            if name == 'CONTENT_TYPE':
+                environ[name] = value
+            elif name in ('CONTENT_LENGTH', 'TRANSFER_ENCODING'):
+                # The body has already been read in full
+                continue
+            else:
+                key = f'HTTP_{name}'
+                environ[key] = f"{environ[key]},{value}" if key in environ else value
+        return environ
+
+    async def _wsgi(self, scope, receive, send):
+        """Run the Flask app for this request on the worker pool, streaming its body back
+        
+        One pool thread calls the app and iterates its body, so stream_with_context
+        generators always resume on the thread that pushed their request context.
+        """
+        loop = asyncio.get_running_loop()
+        environ = self._environ(scope, await self._read_body(receive))
+        events: asyncio.Queue = asyncio.Queue()
+        disconnected = threading.Event()
+
+        def put(kind: str, value=None):
+            loop.call_soon_threadsafe(events.put_nowait, (kind, value))
+
+        def start_response(status, headers, exc_info=None):
+            put('start', (int(status.split(' ', 1)[0]),
+                          [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]))
+            return lambda data: None
+
+        def run():
+            body = None
+            try:
+                body = self.app(environ, start_response)
+                for chunk in body:
+                    if disconnected.is_set():
+                        break
+                    if chunk:
+                        put('body', chunk)
+            except Exception as e:
+                put('error', e)
+            finally:
+                if hasattr(body, 'close'):
+                    body.close()
+                put('end')
+
+        self._executor.submit(run)
+        response_started = False
+        try:
+            while True:
+                kind, value = await events.get()
+                if kind == 'start':
+                    status, headers = value
+                    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+                    response_started = True
+                elif kind == 'body':
+                    await send({'type': 'http.response.body', 'body': value, 'more_body': True})
+                elif kind == 'error':
+                    print(f"Error serving {scope['path']}: {value}")
+                else:
+                    break
+            if response_started:
+                await send({'type': 'http.response.body', 'body': b''})
+            else:
+                await self._json(send, {'error': 'Internal server error'}, 500)
+        finally:
+            disconnected.set()
+
+class AsgiRequest:
+    """The parts of an ASGI HTTP scope the native handlers read"""
+
+    def __init__(self, scope, body: bytes):
+        self.path = scope['path']
+        self.client_ip = (scope.get('client') or ('',))[0]
+        self.body = body
+        self.headers = {}
+        for name, value in scope.get('headers', ()):
+            self.headers[name.decode('latin-1').lower()] = value.decode('latin-1')
+        self.args = MultiDict(parse_qsl(scope.get('query_string', b'').decode('latin-1'), keep_blank_values=True))
+        self.cookies = parse_cookie(self.headers.get('cookie', ''))
+        self.session: Optional[Dict] = None
+
+def create_asgi_app(config=None) -> AsgiApp:
+    """ASGI app factory: `uvicorn --factory ai_study_assistant:create_asgi_app`"""
+    return AsgiApp(create_app(config))
+
+# Application factory
+def create_app(config=None) -> Flask:
+    """Build the Flask app and its services; `config` is an object or dict overriding Config"""
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    if isinstance(config, dict):
+        app.config.update(config)
+    elif config is not None:
+        app.config.from_object(config)
+    CORS(app)
+    
+    tracer.export_dir = app.config['TRACE_EXPORT_DIR']
+    tracer.max_bytes = app.config['TRACE_MAX_BYTES']
+    tracer.keep_files = app.config['TRACE_KEEP_FILES']
+    tracer.configure(app.config['TRACE_SAMPLE_RATE'], app.config['TRACE_FORMAT'])
+    profiler.max_seconds = app.config['PROFILE_MAX_SECONDS']
+    
+    services = Services(app)
+    atexit.register(services.close)
+    app.extensions['study_assistant'] = services
+    app.register_blueprint(bp)
+    return app
+
+_default_app: Optional[Flask] = None
+_default_asgi_app: Optional[AsgiApp] = None
+_default_app_lock = threading.Lock()
+
+def __getattr__(name: str):
+    """Build the default app on first access, so `ai_study_assistant:app` (WSGI) and
+    `ai_study_assistant:asgi_app` (ASGI) work as server targets"""
+    global _default_app, _default_asgi_app
+    if name not in ('app', 'asgi_app'):
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    with _default_app_lock:
+        if _default_app is None:
+            _default_app = create_app()
+        if name == 'app':
+            return _default_app
+        if _default_asgi_app is None:
+            _default_asgi_app = AsgiApp(_default_app)
+        return _default_asgi_app
 
 # Main execution
 if __name__ == '__main__':
+    app = create_app()
     print("🚀 Starting AI Study Assistant...")
     print("📚 Features:")
     print("   • AI-powered study assistance")
@@ -785,8 +4921,17 @@ if __name__ == '__main__':
     print("🌐 Access the app at: http://localhost:5000")
     print("🔧 API Documentation:")
     print("   • POST /api/ask - Ask questions")
+    print("   • POST /api/ask/stream - Ask questions (Server-Sent Events)")
+    print("   • POST /api/ask/batch - Ask many questions (NDJSON)")
     print("   • GET /api/resources - Get study resources")
+    print("   • GET /api/history - Conversation history for this session")
+    print("   • GET /api/export - Stream conversations as NDJSON/CSV")
+    print("   • GET /api/search - Search conversations and resources")
     print("   • GET /api/health - Health check")
+    print("   • GET /api/metrics - Prometheus metrics")
+    print("   • GET/POST /api/admin/tracing - Trace sampling (requires ADMIN_TOKEN)")
+    print("   • POST /api/admin/profile - Profile the live process (requires ADMIN_TOKEN)")
+    print("   • POST /api/admin/resources/import - Bulk-load resources from CSV/JSONL (requires ADMIN_TOKEN)")
     print()
     
     # Create required directories
@@ -0,0 +1,11 @@
+"""
+Benchmarks for the AI Study Assistant
+
+    python -m benchmarks.fake_llm            local OpenAI-compatible /chat/completions stub
+    python -m benchmarks.load                concurrent load against a live server
+    python -m benchmarks.micro               micro-benchmarks of hot functions
+    python -m benchmarks.detect_subject      subject classifier against the original keyword scan
+    python -m benchmarks.compare A B         diff two saved result files
+
+Results are written as JSON under benchmarks/results/ so runs can be compared.
+"""
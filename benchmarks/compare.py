@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+"""
+Compare two saved benchmark result files
+
+Prints every numeric result present in both files with the relative change.
+"""
+
+import sys
+import json
+import argparse
+
+
+def flatten(value, prefix: str = '') -> dict:
+    """{'a.b.c': number} for every numeric leaf"""
+    if isinstance(value, dict):
+        items = {}
+        for key, child in value.items():
+            items.update(flatten(child, f"{prefix}.{key}" if prefix else str(key)))
+        return items
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return {prefix: value}
+    return {}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    args = parser.parse_args(argv)
+
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.candidate, encoding='utf-8') as f:
+        candidate = json.load(f)
+    if baseline.get('benchmark') != candidate.get('benchmark'):
+        print(f"warning: comparing {baseline.get('benchmark')} with {candidate.get('benchmark')}", file=sys.stderr)
+
+    print(f"baseline  {baseline.get('git_commit')} {baseline.get('timestamp')}")
+    print(f"candidate {candidate.get('git_commit')} {candidate.get('timestamp')}")
+    old, new = flatten(baseline.get('results', {})), flatten(candidate.get('results', {}))
+    for name in sorted(old.keys() & new.keys()):
+        before, after = old[name], new[name]
+        change = f"{(after - before) / before * 100:+.1f}%" if before else 'n/a'
+        print(f"{name:<60} {before:>12g} -> {after:>12g}  {change}")
+
+
+if __name__ == '__main__':
+    main()
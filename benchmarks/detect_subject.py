@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Subject detection benchmark
+
+Compares SubjectClassifier against the original first-match keyword scan on
+questions of growing size with the keyword near the end. Every call gets a text
+it has not seen before, so the figures are cold per-call times.
+"""
+
+import time
+import random
+import argparse
+from typing import List
+
+from ai_study_assistant import DEFAULT_SUBJECT_KEYWORDS, SubjectClassifier
+from benchmarks.common import save_results
+
+FILLER = (
+    "please help me understand how this works in practice because my lecture notes "
+    "skip several steps and the textbook example uses different notation than our "
+    "professor so i am confused about the overall approach and the final result"
+).split()
+
+SIZES = (100, 1_000, 10_000, 50_000)
+
+
+def legacy_detect_subject(question: str) -> str:
+    """The original first-match substring scan"""
+    lower_question = question.lower()
+    for subject, keywords in DEFAULT_SUBJECT_KEYWORDS.items():
+        if any(keyword in lower_question for keyword in keywords):
+            return subject
+    return 'default'
+
+
+def make_question(size: int, seed: int = 42) -> str:
+    """Build a pasted question of roughly `size` bytes with a keyword near the end"""
+    rng = random.Random(seed)
+    words = []
+    length = 0
+    while length < size:
+        word = rng.choice(FILLER)
+        words.append(word)
+        length += len(word) + 1
+    words.append('thermodynamics in chemical engineering')
+    return ' '.join(words)
+
+
+def bench(func, corpus: List[str]) -> float:
+    """Microseconds per call, each text seen once so nothing is warm from an earlier call"""
+    started = time.perf_counter()
+    for text in corpus:
+        func(text)
+    return (time.perf_counter() - started) / len(corpus) * 1e6
+
+
+def run(texts: int, rounds: int) -> dict:
+    classifier = SubjectClassifier(DEFAULT_SUBJECT_KEYWORDS)
+    results = {}
+    for size in SIZES:
+        count = max(10, texts * 100 // size)
+        legacy, compiled = [], []
+        for round_number in range(rounds):
+            # A fresh corpus of distinct texts per round and per function
+            seed = (size * rounds + round_number) * 2 * count
+            legacy.append(bench(legacy_detect_subject, [make_question(size, seed + i) for i in range(count)]))
+            compiled.append(bench(classifier.classify, [make_question(size, seed + count + i) for i in range(count)]))
+        sample = make_question(size)
+        results[f'{size}_bytes'] = {
+            'texts': count,
+            'legacy_us': round(min(legacy), 2),
+            'classifier_us': round(min(compiled), 2),
+            'legacy_result': legacy_detect_subject(sample),
+            'classifier_result': list(classifier.classify(sample)),
+        }
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--texts', type=int, default=2000,
+                        help='distinct 100-byte texts per round; larger sizes get proportionally fewer (at least 10)')
+    parser.add_argument('--rounds', type=int, default=3, help='rounds per size; the best is reported')
+    parser.add_argument('--output', help='result file (default benchmarks/results/detect_subject-<time>.json)')
+    args = parser.parse_args(argv)
+
+    results = run(args.texts, args.rounds)
+    for name, row in results.items():
+        print(f"{name:>14}  legacy {row['legacy_us']:>9.2f} us  "
+              f"classifier {row['classifier_us']:>9.2f} us  -> {row['classifier_result']}")
+    path = save_results('detect_subject', {'texts': args.texts, 'rounds': args.rounds}, results, args.output)
+    print(f"saved {path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,149 @@
+#!/usr/bin/env python3
+"""
+Local OpenAI-compatible stub for /chat/completions
+
+Answers after a configurable latency, streams tokens at a configurable rate
+when "stream" is requested, and fails a configurable fraction of requests.
+Point the app at it with AI_BASE_URL=http://127.0.0.1:<port>.
+"""
+
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+WORDS = (
+    "the key idea is to break the problem into smaller steps and check each "
+    "result against the definition before moving on to the next part"
+).split()
+
+
+class FakeLLMServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # Accept bursts of simultaneous connections from high-concurrency runs
+    request_queue_size = 1024
+
+    def __init__(self, address, latency: float = 0.2, jitter: float = 0.0, tokens_per_second: float = 50.0,
+                 answer_tokens: int = 60, error_rate: float = 0.0, error_status: int = 500, seed: int = None):
+        super().__init__(address, FakeLLMHandler)
+        self.latency = latency
+        self.jitter = jitter
+        self.tokens_per_second = tokens_per_second
+        self.answer_tokens = answer_tokens
+        self.error_rate = error_rate
+        self.error_status = error_status
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+
+    def draw(self):
+        """Return (delay, fail) for one request"""
+        with self.random_lock:
+            self.requests += 1
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            fail = self.random.random() < self.error_rate
+            if fail:
+                self.errors += 1
+            return delay, fail
+
+    def answer_words(self, question: str) -> list:
+        words = [WORDS[i % len(WORDS)] for i in range(self.answer_tokens)]
+        return [f"About '{question[:40]}':"] + words
+
+
+class FakeLLMHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            body = json.loads(self.rfile.read(length) or b'{}')
+        except ValueError:
+            return self._send_json(400, {'error': {'message': 'invalid JSON'}})
+        if not self.path.rstrip('/').endswith('/chat/completions'):
+            return self._send_json(404, {'error': {'message': 'not found'}})
+
+        delay, fail = self.server.draw()
+        time.sleep(delay)
+        if fail:
+            return self._send_json(self.server.error_status, {'error': {'message': 'injected failure'}})
+
+        messages = body.get('messages') or [{}]
+        words = self.server.answer_words(str(messages[-1].get('content', '')))
+        if body.get('stream'):
+            return self._stream(words)
+        self._send_json(200, {
+            'object': 'chat.completion',
+            'model': body.get('model', 'fake'),
+            'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': ' '.join(words)},
+                         'finish_reason': 'stop'}],
+            'usage': {'completion_tokens': len(words)}
+        })
+
+    def _send_json(self, status: int, payload: dict):
+        out = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(out)))
+        self.end_headers()
+        self.wfile.write(out)
+
+    def _chunk(self, data: bytes):
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def _stream(self, words: list):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        interval = 1.0 / self.server.tokens_per_second if self.server.tokens_per_second > 0 else 0.0
+        for word in words:
+            event = {'choices': [{'index': 0, 'delta': {'content': word + ' '}}]}
+            self._chunk(f"data: {json.dumps(event)}\n\n".encode('utf-8'))
+            if interval:
+                time.sleep(interval)
+        self._chunk(b'data: [DONE]\n\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--latency', type=float, default=0.2, help='seconds before the first byte')
+    parser.add_argument('--jitter', type=float, default=0.0, help='+/- seconds of uniform latency jitter')
+    parser.add_argument('--tokens-per-second', type=float, default=50.0, help='streaming speed (0 = no delay)')
+    parser.add_argument('--answer-tokens', type=int, default=60, help='words per answer')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='fraction of requests that fail')
+    parser.add_argument('--error-status', type=int, default=500, help='status code for injected failures')
+    parser.add_argument('--seed', type=int, default=None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8900)
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+    server = FakeLLMServer(
+        (args.host, args.port), latency=args.latency, jitter=args.jitter,
+        tokens_per_second=args.tokens_per_second, answer_tokens=args.answer_tokens,
+        error_rate=args.error_rate, error_status=args.error_status, seed=args.seed
+    )
+    print(f"Fake LLM listening on http://{args.host}:{server.server_address[1]}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        print(f"Served {server.requests} requests ({server.errors} injected errors)", file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
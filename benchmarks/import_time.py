@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Import-time budget for ai_study_assistant
+
+Each sample runs a fresh interpreter that imports Flask first, then times
+`import ai_study_assistant` on its own and `create_app()` in a temporary
+directory. Exits non-zero when the median module import exceeds the budget.
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import subprocess
+from statistics import median
+
+from benchmarks.common import REPO_ROOT, save_results
+
+# Milliseconds `import ai_study_assistant` may add on top of importing Flask; asyncio, which
+# is imported eagerly because lazy module loading is not thread-safe, accounts for about half
+IMPORT_BUDGET_MS = 50.0
+
+PROBE = """
+import json, os, sys, time
+sys.path.insert(0, sys.argv[1])
+started = time.perf_counter()
+import flask, flask_cors
+framework = time.perf_counter() - started
+started = time.perf_counter()
+import ai_study_assistant
+module = time.perf_counter() - started
+started = time.perf_counter()
+ai_study_assistant.create_app()
+factory = time.perf_counter() - started
+print(json.dumps({'framework_ms': framework * 1000, 'module_ms': module * 1000, 'create_app_ms': factory * 1000}))
+sys.stdout.flush()
+os._exit(0)
+"""
+
+
+def sample() -> dict:
+    with tempfile.TemporaryDirectory(prefix='study-assistant-import-') as workdir:
+        output = subprocess.check_output([sys.executable, '-c', PROBE, REPO_ROOT], cwd=workdir, text=True)
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=15)
+    parser.add_argument('--budget-ms', type=float, default=IMPORT_BUDGET_MS)
+    parser.add_argument('--output', help='result file (default benchmarks/results/import_time-<time>.json)')
+    args = parser.parse_args(argv)
+
+    # Compile bytecode up front so the first sample is not charged for it
+    subprocess.check_call([sys.executable, '-m', 'py_compile', os.path.join(REPO_ROOT, 'ai_study_assistant.py')])
+    samples = [sample() for _ in range(args.runs)]
+    results = {
+        key: {'median_ms': round(median(s[key] for s in samples), 2),
+              'max_ms': round(max(s[key] for s in samples), 2)}
+        for key in ('framework_ms', 'module_ms', 'create_app_ms')
+    }
+    results['budget_ms'] = args.budget_ms
+    results['within_budget'] = results['module_ms']['median_ms'] <= args.budget_ms
+
+    for key in ('framework_ms', 'module_ms', 'create_app_ms'):
+        print(f"{key:<14} median {results[key]['median_ms']:>8.2f} ms  max {results[key]['max_ms']:>8.2f} ms")
+    path = save_results('import_time', {'runs': args.runs, 'budget_ms': args.budget_ms}, results, args.output)
+    print(f"saved {path}")
+    if not results['within_budget']:
+        print(f"module import {results['module_ms']['median_ms']} ms is over the {args.budget_ms} ms budget")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
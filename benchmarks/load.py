@@ -0,0 +1,281 @@
+#!/usr/bin/env python3
+"""
+Load benchmark for the AI Study Assistant
+
+Starts the fake LLM stub and the app in subprocesses (or targets --url), drives
+the chosen endpoint with concurrent clients, and reports throughput, latency
+percentiles, database write rate and answer sources.
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import shutil
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import Counter
+from typing import Dict, List, Optional
+
+import httpx
+
+from benchmarks.common import REPO_ROOT, latency_summary, save_results
+from benchmarks.fake_llm import add_arguments as add_fake_llm_arguments
+
+QUESTIONS = [
+    ("How do I solve a quadratic equation with the quadratic formula?", "Mathematics"),
+    ("Explain Newton's second law of motion with an example", "Physics"),
+    ("What happens in an acid base neutralization reaction?", "Chemistry"),
+    ("What is the time complexity of binary search and why?", "Computer Science"),
+    ("How does a truss distribute load in civil engineering?", "Engineering"),
+    ("Describe the stages of cell division in mitosis", "Biology"),
+    ("Why does the derivative of sine equal cosine?", ""),
+    ("How do hash tables handle collisions?", ""),
+]
+
+APP_BOOT = (
+    "import sys\n"
+    "from ai_study_assistant import create_app\n"
+    "create_app().run(host=sys.argv[1], port=int(sys.argv[2]), threaded=True, debug=False)\n"
+)
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def wait_for(url: str, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if httpx.get(url, timeout=2.0).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    raise RuntimeError(f"{url} did not become ready within {timeout:.0f}s")
+
+
+def scrape_metrics(base_url: str) -> Dict[str, float]:
+    """Parse /api/metrics into {'name{labels}': value}; empty if the endpoint is unavailable"""
+    try:
+        response = httpx.get(f"{base_url}/api/metrics", timeout=10.0)
+    except httpx.HTTPError:
+        return {}
+    if response.status_code != 200:
+        return {}
+    samples = {}
+    for line in response.text.splitlines():
+        if line and not line.startswith('#'):
+            name, _, value = line.rpartition(' ')
+            try:
+                samples[name] = float(value)
+            except ValueError:
+                pass
+    return samples
+
+
+def question_for(n: int, distinct: int) -> tuple:
+    """The n-th question; unique per request unless `distinct` caps the pool"""
+    if distinct:
+        n %= distinct
+    text, subject = QUESTIONS[n % len(QUESTIONS)]
+    if n >= len(QUESTIONS):
+        text = f"{text} (case {n})"
+    return text, subject
+
+
+class LoadRun:
+    """Closed-loop clients: each thread sends its next request as soon as the previous one finishes"""
+
+    def __init__(self, base_url: str, endpoint: str, concurrency: int, distinct: int = 0):
+        self.base_url = base_url
+        self.endpoint = endpoint
+        self.concurrency = concurrency
+        self.distinct = distinct
+        self._counter = 0
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Drop recorded results, e.g. after a warmup run"""
+        self.latencies: List[float] = []
+        self.first_byte: List[float] = []
+        self.statuses: Counter = Counter()
+
+    def _next_index(self) -> int:
+        with self._lock:
+            self._counter += 1
+            return self._counter
+
+    def _send(self, client: httpx.Client) -> tuple:
+        """Return (status, latency, time_to_first_byte) for one request"""
+        started = time.perf_counter()
+        if self.endpoint == 'resources':
+            response = client.get('/api/resources')
+            return response.status_code, time.perf_counter() - started, None
+        question, subject = question_for(self._next_index(), self.distinct)
+        payload = {'question': question, 'subject': subject}
+        if self.endpoint == 'stream':
+            first_byte = None
+            with client.stream('POST', '/api/ask/stream', json=payload) as response:
+                for _ in response.iter_bytes():
+                    if first_byte is None:
+                        first_byte = time.perf_counter() - started
+            return response.status_code, time.perf_counter() - started, first_byte
+        response = client.post('/api/ask', json=payload)
+        return response.status_code, time.perf_counter() - started, None
+
+    def _worker(self, stop_at: float):
+        latencies, first_bytes, statuses = [], [], Counter()
+        with httpx.Client(base_url=self.base_url, timeout=120.0) as client:
+            while time.monotonic() < stop_at:
+                try:
+                    status, latency, first_byte = self._send(client)
+                except httpx.HTTPError as e:
+                    status, latency, first_byte = type(e).__name__, None, None
+                statuses[status] += 1
+                if latency is not None:
+                    latencies.append(latency)
+                if first_byte is not None:
+                    first_bytes.append(first_byte)
+        with self._lock:
+            self.latencies.extend(latencies)
+            self.first_byte.extend(first_bytes)
+            self.statuses.update(statuses)
+
+    def run(self, duration: float) -> float:
+        """Drive load for `duration` seconds; return the elapsed time including the final requests"""
+        started = time.monotonic()
+        stop_at = started + duration
+        threads = [threading.Thread(target=self._worker, args=(stop_at,), daemon=True)
+                   for _ in range(self.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # In-flight requests finish after stop_at, so measure to the real end
+        return time.monotonic() - started
+
+
+def start_stack(args, workdir: str) -> tuple:
+    """Start the fake LLM and the app; return (base_url, processes)"""
+    llm_port, app_port = free_port(), free_port()
+    fake_llm = subprocess.Popen(
+        [sys.executable, '-m', 'benchmarks.fake_llm', '--port', str(llm_port),
+         '--latency', str(args.latency), '--jitter', str(args.jitter),
+         '--tokens-per-second', str(args.tokens_per_second), '--answer-tokens', str(args.answer_tokens),
+         '--error-rate', str(args.error_rate), '--error-status', str(args.error_status)]
+        + (['--seed', str(args.seed)] if args.seed is not None else []),
+        cwd=REPO_ROOT, stdout=subprocess.DEVNULL
+    )
+    env = dict(
+        os.environ,
+        PYTHONPATH=REPO_ROOT,
+        AI_BASE_URL=f"http://127.0.0.1:{llm_port}",
+        AI_API_KEY='benchmark',
+        DEBUG='false',
+        SIMILARITY_ENABLED='true' if args.similarity else 'false',
+        # Every benchmark client shares one IP; measure throughput, not the rate limiter
+        RATE_LIMIT_SESSION_PER_MINUTE='0',
+        RATE_LIMIT_IP_PER_MINUTE='0',
+    )
+    app = subprocess.Popen(
+        [sys.executable, '-c', APP_BOOT, '127.0.0.1', str(app_port)],
+        cwd=workdir, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    base_url = f"http://127.0.0.1:{app_port}"
+    try:
+        wait_for(f"{base_url}/api/health")
+    except RuntimeError:
+        for process in (app, fake_llm):
+            process.terminate()
+        raise
+    return base_url, [app, fake_llm]
+
+
+def delta(after: Dict[str, float], before: Dict[str, float], prefix: str) -> Dict[str, float]:
+    return {name: after[name] - before.get(name, 0.0) for name in after if name.startswith(prefix)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', help='benchmark an already running server instead of starting one')
+    parser.add_argument('--endpoint', choices=('ask', 'stream', 'resources'), default='ask')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=20.0, help='measured seconds')
+    parser.add_argument('--warmup', type=float, default=3.0, help='seconds of load before measuring')
+    parser.add_argument('--distinct', type=int, default=0,
+                        help='cycle through this many questions (0 = every question unique, no cache hits)')
+    parser.add_argument('--similarity', action='store_true', help='keep the similarity index enabled')
+    parser.add_argument('--output', help='result file (default benchmarks/results/load-<time>.json)')
+    add_fake_llm_arguments(parser)
+    args = parser.parse_args(argv)
+
+    workdir, processes = None, []
+    try:
+        if args.url:
+            base_url = args.url.rstrip('/')
+        else:
+            workdir = tempfile.mkdtemp(prefix='study-assistant-bench-')
+            base_url, processes = start_stack(args, workdir)
+
+        run = LoadRun(base_url, args.endpoint, args.concurrency, args.distinct)
+        if args.warmup > 0:
+            run.run(args.warmup)
+            run.reset()
+            # Let warmup rows flush so they are not counted as measured writes
+            time.sleep(1.5)
+        before = scrape_metrics(base_url)
+        elapsed = run.run(args.duration)
+        # Let the write-behind conversation writer drain before reading its counters
+        time.sleep(1.5)
+        after = scrape_metrics(base_url)
+    finally:
+        for process in processes:
+            process.terminate()
+            try:
+                process.wait(10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        if workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    completed = sum(run.statuses.values())
+    ok = sum(count for status, count in run.statuses.items() if status == 200)
+    rows_written = delta(after, before, 'conversation_writer_rows_total').get('conversation_writer_rows_total')
+    results = {
+        'requests': completed,
+        'ok': ok,
+        'errors': completed - ok,
+        'statuses': {str(status): count for status, count in run.statuses.items()},
+        'elapsed_s': round(elapsed, 3),
+        'throughput_rps': round(completed / elapsed, 2) if elapsed else 0.0,
+        'latency': latency_summary(run.latencies),
+        'db_rows_written': rows_written,
+        'db_write_rate_rows_s': round(rows_written / elapsed, 2) if rows_written is not None and elapsed else None,
+        'answers_by_source': delta(after, before, 'answers_total'),
+    }
+    if run.first_byte:
+        results['time_to_first_byte'] = latency_summary(run.first_byte)
+
+    params = {key: value for key, value in vars(args).items() if key != 'output'}
+    path = save_results('load', params, results, args.output)
+    latency = results['latency']
+    print(f"{args.endpoint}: {completed} requests in {elapsed:.1f}s = {results['throughput_rps']} req/s, "
+          f"{results['errors']} errors")
+    if latency.get('count'):
+        print(f"latency p50 {latency['p50_ms']} ms  p95 {latency['p95_ms']} ms  p99 {latency['p99_ms']} ms")
+    if results['db_write_rate_rows_s'] is not None:
+        print(f"db writes {results['db_write_rate_rows_s']} rows/s")
+    print(json.dumps(results['answers_by_source']))
+    print(f"saved {path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for hot functions: subject detection, fallback answers and
+resource serialization
+
+The app module is imported inside a temporary working directory so its SQLite
+database and instance files do not touch the checkout.
+"""
+
+import os
+import sys
+import json
+import argparse
+import tempfile
+import timeit
+
+from benchmarks.common import REPO_ROOT, save_results
+
+QUESTIONS = {
+    'short': "What is an integral?",
+    'medium': "Can you explain how the second law of thermodynamics applies to a heat engine "
+              "and why no engine can reach one hundred percent efficiency?",
+    'no_match': "I have an exam next week and I am not sure how to plan my revision time well",
+    'long': ' '.join(["my notes skip several steps and the example uses different notation"] * 150)
+            + " so what is a derivative",
+}
+
+
+def bench(func, number: int, repeat: int = 5) -> dict:
+    """Best and median microseconds per call over `repeat` runs of `number` calls"""
+    runs = sorted(timer / number * 1e6 for timer in timeit.repeat(func, number=number, repeat=repeat))
+    return {'best_us': round(runs[0], 3), 'median_us': round(runs[len(runs) // 2], 3), 'calls': number}
+
+
+def run(number: int) -> dict:
+    sys.path.insert(0, REPO_ROOT)
+    from ai_study_assistant import create_app
+
+    services = create_app().extensions['study_assistant']
+    service = services.ai_service
+    db = services.db
+    catalog = services.resource_catalog
+    results = {}
+
+    for name, question in QUESTIONS.items():
+        calls = max(50, number // 10) if name == 'long' else number
+        # A distinct text per call, so nothing is warm from timing the same string again
+        texts = iter([f"{question} (variant {i})" for i in range(calls * 5)])
+        results[f'detect_subject[{name}]'] = bench(lambda: service.detect_subject(next(texts)), calls)
+
+    for subject in ('Mathematics', 'Computer Science', 'default'):
+        results[f'generate_fallback_response[{subject}]'] = bench(
+            lambda: service.generate_fallback_response(QUESTIONS['medium'], subject), number
+        )
+
+    fields = catalog.PUBLIC_FIELDS
+    rows = db.get_resources()
+    results['resources.serialize_rows'] = bench(
+        lambda: json.dumps([{field: row[field] for field in fields} for row in rows]), number
+    )
+    results['resources.query_and_serialize'] = bench(
+        lambda: json.dumps([{field: row[field] for field in fields} for row in db.get_resources()]),
+        max(50, number // 10)
+    )
+    results['resources.catalog_page_cached'] = bench(lambda: catalog.page(), number)
+    results['resources.row_count'] = len(rows)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--number', type=int, default=2000, help='calls per timing run')
+    parser.add_argument('--output', help='result file (default benchmarks/results/micro-<time>.json)')
+    args = parser.parse_args(argv)
+
+    workdir = tempfile.mkdtemp(prefix='study-assistant-micro-')
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        results = run(args.number)
+    finally:
+        os.chdir(cwd)
+
+    for name, value in results.items():
+        if isinstance(value, dict):
+            print(f"{name:<48} best {value['best_us']:>10.3f} us  median {value['median_us']:>10.3f} us")
+    path = save_results('micro', {'number': args.number}, results, args.output)
+    print(f"saved {path}")
+    # Background writer and index threads belong to the imported app; do not wait for them
+    os._exit(0)
+
+
+if __name__ == '__main__':
+    main()